@@ -55,8 +55,10 @@ class McSAS3_cli_optimize(object):
             optDict = yaml.safe_load(f)
         if self.nThreads > 0:
             optDict["nCores"] = self.nThreads
+        # a fresh random seed unless set in the configuration, recorded with the results:
+        optDict.setdefault("seed", None)
         # run the Monte Carlo method
-        mh = mc_hat.McHat(seed=None, resultIndex=self.resultIndex, **optDict)
+        mh = mc_hat.McHat(resultIndex=self.resultIndex, **optDict)
         md = mds.measData.copy()
         mh.run(md, self.resultFile, resultIndex=self.resultIndex)
 
@@ -396,6 +396,13 @@ class McAnalysis:
         with h5py.File(inputFile, "r") as h5f:
             for key in h5f[str(self.resultIndex.nxsEntryPoint / "model")].keys():
                 if "repetition" in key:
+                    # skip checkpoints of optimizations that have not finished (yet):
+                    finished = h5f.get(
+                        str(self.resultIndex.nxsEntryPoint / "optimization" / key / "finished")
+                    )
+                    if (finished is not None) and not finished[()]:
+                        print(f"skipping unfinished {key}")
+                        continue
                     self._repetitionList.append(int(key.strip("repetition")))
         print(f"{len(self._repetitionList)} repetitions found in McSAS file {inputFile}")
 
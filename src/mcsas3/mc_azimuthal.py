@@ -0,0 +1,84 @@
+# src/mcsas3/mc_azimuthal.py
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas
+
+from .mc_data import binnedStatistics
+
+# pixel-to-bin maps by detector geometry (hash of the Q arrays) and number of bins, so that
+# repeated frames of the same detector reuse them. The least recently used map is dropped first:
+BIN_MAP_CACHE = OrderedDict()
+BIN_MAP_CACHE_SIZE = 4  # number of maps kept, each holds two 8-byte values per pixel
+BIN_MAP_LOCK = threading.Lock()
+
+
+def geometryKey(Qx: np.ndarray, Qy: np.ndarray, nBins: int) -> str:
+    """identifies a detector geometry and binning, by the content of its Q arrays"""
+    digest = hashlib.sha1()
+    for Q in (Qx, Qy):
+        Q = np.ascontiguousarray(Q)
+        digest.update("{}{}".format(Q.shape, Q.dtype.str).encode())
+        digest.update(Q.data)
+    digest.update(str(nBins).encode())
+    return digest.hexdigest()
+
+
+def radialBinMap(Qx: np.ndarray, Qy: np.ndarray, nBins: int) -> tuple:
+    """(|Q| bin of every pixel, |Q| of every pixel), for nBins linear bins over the |Q| range of
+    the detector. Pixels without a valid Q are in bin -1. Cached per geometry, read-only"""
+    key = geometryKey(Qx, Qy, nBins)
+    with BIN_MAP_LOCK:
+        if key in BIN_MAP_CACHE:
+            BIN_MAP_CACHE.move_to_end(key)
+            return BIN_MAP_CACHE[key]
+    Q = np.sqrt(np.asarray(Qx, dtype=float) ** 2 + np.asarray(Qy, dtype=float) ** 2)
+    QMin, QMax = np.nanmin(Q), np.nanmax(Q)
+    assert QMax > QMin, "the detector must cover a range of |Q| for azimuthal averaging"
+    # linear bins, the index follows directly from |Q|. The largest |Q| is in the last bin:
+    with np.errstate(invalid="ignore"):
+        binIndex = np.minimum((Q - QMin) * (nBins / (QMax - QMin)), nBins - 1)
+    # native integers, which np.bincount takes without conversion:
+    binIndex = np.where(np.isnan(Q), -1, binIndex).astype(np.intp)
+    for array in (binIndex, Q):
+        array.setflags(write=False)
+    with BIN_MAP_LOCK:
+        BIN_MAP_CACHE[key] = (binIndex, Q)
+        while len(BIN_MAP_CACHE) > BIN_MAP_CACHE_SIZE:
+            BIN_MAP_CACHE.popitem(last=False)
+    return binIndex, Q
+
+
+def azimuthalAverage(rawData2D: dict, nBins: int) -> pandas.DataFrame:
+    """
+    Azimuthal average of a 2D detector image (as read into McData.rawData2D by from_nexus, with
+    I, ISigma, Qx, Qy and optionally mask) into nBins linear |Q| bins, for isotropic samples.
+    Masked pixels (mask != 0) are left out, as are infinite intensities and zero uncertainties,
+    as in McData2D.clip. Every bin is at the mean |Q| of its pixels. Its uncertainty is the
+    largest of the standard error on the mean intensity and the propagated uncertainty, a single
+    pixel keeps its own. Empty bins are dropped. Returns a dataframe with Q, I and ISigma.
+    """
+    binIndex, Q = radialBinMap(rawData2D["Qx"], rawData2D["Qy"], nBins)
+    Int = np.asarray(rawData2D["I"], dtype=float)
+    ISigma = np.asarray(rawData2D["ISigma"], dtype=float)
+    valid = (binIndex >= 0) & np.isfinite(Int) & np.isfinite(ISigma) & (ISigma != 0)
+    if "mask" in rawData2D.keys():
+        valid &= ~np.asarray(rawData2D["mask"]).astype(bool)
+    index = binIndex[valid]
+    nPixels, IMean, IStd = binnedStatistics(index, Int[valid], nBins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        QMean = np.bincount(index, weights=Q[valid], minlength=nBins) / nPixels
+        ISEM = IStd / np.sqrt(nPixels)  # standard error on the mean intensity
+        # propagated uncertainty of the mean intensity:
+        IError = np.sqrt(np.bincount(index, weights=ISigma[valid] ** 2, minlength=nBins)) / nPixels
+    kept = nPixels > 0
+    return pandas.DataFrame(
+        data={
+            "Q": QMean[kept],
+            "I": IMean[kept],
+            "ISigma": np.where(nPixels > 1, np.maximum(ISEM, IError), IError)[kept],
+        }
+    )
@@ -0,0 +1,192 @@
+# src/mcsas3/mc_cache.py
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas
+
+CACHE_VERSION = 1  # changes when the prepared data or their format change, invalidating entries
+# the prepared data of a McData instance that are cached, everything the optimization and the
+# result file (McData.store) use:
+CACHED_DATA = ["rawData", "rawData2D", "clippedData", "binnedData", "measData"]
+
+
+def fileDigest(filename: Path) -> str:
+    """sha256 of the content of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def packValue(value, arrays: dict) -> dict:
+    """description of a (nested) value, its arrays are added to arrays under generated names"""
+    if value is None:
+        return {"type": "None"}
+    if isinstance(value, pandas.DataFrame):
+        return {
+            "type": "DataFrame",
+            "index": packValue(value.index.values, arrays),
+            "columns": [[str(key), packValue(value[key].values, arrays)] for key in value.keys()],
+        }
+    if isinstance(value, dict):
+        return {"type": "dict", "items": [[str(k), packValue(v, arrays)] for k, v in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return {"type": type(value).__name__, "items": [packValue(v, arrays) for v in value]}
+    name = "a{}".format(len(arrays))
+    arrays[name] = np.asarray(value)
+    assert arrays[name].dtype.kind != "O", "cannot cache values of type {}".format(type(value))
+    return {"type": "array", "name": name, "scalar": not isinstance(value, np.ndarray)}
+
+
+def unpackValue(description: dict, arrays) -> object:
+    """the value of a description made by packValue, with its arrays"""
+    kind = description["type"]
+    if kind == "None":
+        return None
+    if kind == "DataFrame":
+        return pandas.DataFrame(
+            data={key: unpackValue(v, arrays) for key, v in description["columns"]},
+            index=unpackValue(description["index"], arrays),
+        )
+    if kind == "dict":
+        return {key: unpackValue(v, arrays) for key, v in description["items"]}
+    if kind in ["list", "tuple"]:
+        items = [unpackValue(v, arrays) for v in description["items"]]
+        return items if kind == "list" else tuple(items)
+    value = arrays[description["name"]]
+    return value.item() if description["scalar"] else value
+
+
+class McDataCache:
+    """
+    On-disk cache of prepared data (read, clipped, omitted and rebinned, see McData.prepare),
+    so that the same input file read with the same settings is prepared only once, e.g. for
+    parameter sweeps. Entries are content-addressed: the key is a hash of the content of the
+    input file and of the settings that affect the prepared data (McData.cacheKeys). Each entry
+    is an uncompressed .npz file of the arrays, with a JSON description of their structure.
+
+    The total size of the entries is limited to maxBytes, the least recently used entries (by
+    their modification time, renewed on use) are removed first. Enabled in McData by setting
+    cacheDir (and optionally cacheSize), e.g. in the read configuration. The cache can be
+    inspected and purged with the mcsas3-cache command.
+    """
+
+    cacheDir = None  # directory of the cache entries
+    maxBytes = 2**30  # size limit of all entries together, in bytes
+
+    def __init__(self, cacheDir: Path, maxBytes: int = 2**30) -> None:
+        self.cacheDir = Path(cacheDir)
+        self.maxBytes = maxBytes
+
+    def key(self, mcData) -> str:
+        """identifies the prepared data of mcData, by its input file and settings"""
+        settings = {key: getattr(mcData, key, None) for key in mcData.cacheKeys}
+        description = json.dumps(
+            [CACHE_VERSION, type(mcData).__name__, settings],
+            sort_keys=True,
+            default=lambda o: np.asarray(o).tolist(),
+        )
+        digest = hashlib.sha256(description.encode())
+        digest.update(fileDigest(mcData.filename).encode())
+        return digest.hexdigest()
+
+    def entryPath(self, key: str) -> Path:
+        return self.cacheDir / "{}.npz".format(key)
+
+    def restore(self, mcData, key: str) -> bool:
+        """sets the prepared data of mcData from the entry with key, False if there is none"""
+        path = self.entryPath(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                manifest = json.loads(entry["manifest"].item())
+                arrays = {name: entry[name] for name in entry.files}
+            os.utime(path)  # most recently used
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return False  # not cached, removed meanwhile or unreadable
+        for name, description in manifest["data"].items():
+            setattr(mcData, name, unpackValue(description, arrays))
+        return True
+
+    def store(self, mcData, key: str) -> None:
+        """adds the prepared data of mcData as the entry with key, then removes the least recently
+        used entries beyond the size limit. Data that cannot be stored as arrays are not cached"""
+        arrays = {}
+        try:
+            data = {name: packValue(getattr(mcData, name, None), arrays) for name in CACHED_DATA}
+        except AssertionError as e:
+            logging.warning(f"not caching the data of {mcData.filename}: {e}")
+            return
+        filename = str(Path(mcData.filename).absolute())
+        manifest = dict(data=data, filename=filename, stored=time.time())
+        arrays["manifest"] = np.array(json.dumps(manifest))
+        self.cacheDir.mkdir(parents=True, exist_ok=True)
+        # written next to the entry and renamed, so that other processes never see partial ones:
+        handle, tempName = tempfile.mkstemp(dir=self.cacheDir, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tempName, self.entryPath(key))
+        except BaseException:
+            Path(tempName).unlink(missing_ok=True)
+            raise
+        self.evict()
+
+    def entries(self) -> list:
+        """the entries, least recently used first, with their key, size, time of last use,
+        time of storage and input filename"""
+        entries = []
+        for path in self.cacheDir.glob("*.npz"):
+            try:
+                stat = path.stat()
+                with np.load(path, allow_pickle=False) as entry:
+                    manifest = json.loads(entry["manifest"].item())
+            except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+                continue  # removed meanwhile, or not an entry
+            entries += [
+                dict(
+                    key=path.stem,
+                    size=stat.st_size,
+                    lastUsed=stat.st_mtime,
+                    stored=manifest["stored"],
+                    filename=manifest["filename"],
+                )
+            ]
+        return sorted(entries, key=lambda entry: entry["lastUsed"])
+
+    def remove(self, key: str) -> None:
+        self.entryPath(key).unlink(missing_ok=True)
+
+    def evict(self, maxBytes: Optional[int] = None) -> list:
+        """removes the least recently used entries until the rest fit in maxBytes (default: the
+        size limit of the cache), returns the removed entries"""
+        if maxBytes is None:
+            maxBytes = self.maxBytes
+        entries = self.entries()
+        totalSize = sum(entry["size"] for entry in entries)
+        removed = []
+        for entry in entries:
+            if totalSize <= maxBytes:
+                break
+            self.remove(entry["key"])
+            totalSize -= entry["size"]
+            removed += [entry]
+        return removed
+
+    def purge(self, olderThan: Optional[float] = None) -> list:
+        """removes all entries, or those not used for olderThan seconds, returns them"""
+        removed = []
+        for entry in self.entries():
+            if (olderThan is None) or (time.time() - entry["lastUsed"] > olderThan):
+                self.remove(entry["key"])
+                removed += [entry]
+        return removed
@@ -0,0 +1,290 @@
+# src/mcsas3/mc_cluster.py
+
+import multiprocessing
+import os
+import pickle
+import queue
+import socket
+import sys
+import threading
+import time
+from multiprocessing.managers import SyncManager
+from typing import Callable, Optional, Union
+
+from .mc_cpu import limitThreads
+
+HEARTBEAT_INTERVAL = 1.0  # seconds between the heartbeats of the agents
+BOARD = None  # the McTaskBoard, in the server process
+
+
+class McTaskBoard:
+    """
+    The tasks of a McClusterPool, in its McJobServer process: the queued tasks, the tasks in
+    flight per agent, and the finished ones. The agents send heartbeats while they are connected.
+    The tasks of an agent whose heartbeats stop (e.g. because it died) are queued again, see
+    requeue, so that another agent runs them. Only the first result of a task is kept.
+    """
+
+    def __init__(self) -> None:
+        self._queued = queue.Queue()  # (task ID, pickled (function, arguments)) tasks
+        self._done = queue.Queue()  # (task ID, success, return value or exception)
+        self._inFlight = {}  # (agent ID, pickled task) by task ID
+        self._finished = set()  # IDs of the finished tasks
+        self._heartbeats = {}  # time of the last heartbeat by agent ID
+        self._lock = threading.Lock()
+
+    def put(self, taskId: int, task: bytes) -> None:
+        self._queued.put((taskId, task))
+
+    def heartbeat(self, agentId: str) -> None:
+        with self._lock:
+            self._heartbeats[agentId] = time.time()
+
+    def claim(self, agentId: str, timeout: float) -> Optional[tuple]:
+        """the next (task ID, pickled task) for the agent, None if there is none within timeout"""
+        self.heartbeat(agentId)
+        try:
+            taskId, task = self._queued.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            self._inFlight[taskId] = (agentId, task)
+        return taskId, task
+
+    def finish(self, taskId: int, success: bool, value) -> None:
+        with self._lock:
+            self._inFlight.pop(taskId, None)
+            if taskId in self._finished:
+                return  # also finished by another agent, after being queued again
+            self._finished.add(taskId)
+        self._done.put((taskId, success, value))
+
+    def collect(self, timeout: float = 0) -> list:
+        """the results finished since the last call, waiting up to timeout for the first one"""
+        results = []
+        try:
+            results += [self._done.get(timeout=timeout) if timeout > 0 else self._done.get_nowait()]
+            while True:
+                results += [self._done.get_nowait()]
+        except queue.Empty:
+            return results
+
+    def requeue(self, heartbeatTimeout: float) -> int:
+        """queues the tasks of the agents without a heartbeat for heartbeatTimeout seconds
+        again, returns the number of these tasks"""
+        with self._lock:
+            lost = [
+                agentId
+                for agentId, beat in self._heartbeats.items()
+                if time.time() - beat > heartbeatTimeout
+            ]
+            for agentId in lost:
+                del self._heartbeats[agentId]
+            tasks = [
+                (taskId, task)
+                for taskId, (agentId, task) in self._inFlight.items()
+                if (agentId in lost) or (agentId not in self._heartbeats)
+            ]
+            for taskId, task in tasks:
+                del self._inFlight[taskId]
+                self._queued.put((taskId, task))
+        return len(tasks)
+
+    def nAgents(self) -> int:
+        """the number of connected agents, with a recent heartbeat"""
+        with self._lock:
+            return len(self._heartbeats)
+
+
+def getBoard() -> McTaskBoard:
+    global BOARD
+    if BOARD is None:
+        BOARD = McTaskBoard()
+    return BOARD
+
+
+class McJobServer(SyncManager):
+    """
+    Manager server process hosting the task queues of a McClusterPool, and the queues and events
+    the repetitions use to send their results and progress, and to be cancelled (see McHatPool).
+    Worker agents on this or other machines connect to it at its address, a (host, port) tuple
+    for TCP or a path for a Unix socket, using the same authkey, see runAgent.
+    """
+
+
+McJobServer.register("board", callable=getBoard)
+
+
+class McClusterResult:
+    """the result of a task submitted to a McClusterPool, as a multiprocessing AsyncResult"""
+
+    def __init__(self, pool: "McClusterPool", taskId: int) -> None:
+        self._pool = pool
+        self._taskId = taskId
+
+    def ready(self) -> bool:
+        self._pool.collect()
+        return self._taskId in self._pool.finished
+
+    def get(self, timeout: Optional[float] = None):
+        """the return value of the task, raises a multiprocessing.TimeoutError if it has not
+        finished within timeout seconds (None: waits as long as it takes)"""
+        deadline = None if timeout is None else time.time() + timeout
+        while not self.ready():
+            if (deadline is not None) and (time.time() > deadline):
+                raise multiprocessing.TimeoutError(
+                    "task {} did not finish within {} s, {} worker agents connected".format(
+                        self._taskId, timeout, self._pool.nAgents()
+                    )
+                )
+            self._pool.collect(timeout=0.5)  # waits for the next result
+        success, value = self._pool.finished[self._taskId]
+        if not success:
+            raise value
+        return value
+
+
+class McClusterPool:
+    """
+    Distributes function calls to the worker agents connected to a McJobServer, with the
+    apply_async interface of a multiprocessing Pool, so that it can be used by McHatPool. The
+    functions and arguments are pickled, they must be available to the agents (e.g. McHat.runOnce)
+    and may contain proxies of queues and events of the server (see McHatPool).
+
+    The address must be reachable by the agents, e.g. (hostname, port) rather than
+    ("0.0.0.0", port). With port 0, a free port is chosen, see address. The tasks of agents
+    that have not sent a heartbeat for heartbeatTimeout seconds, e.g. because they died or lost
+    their connection, are run by the other agents, see McTaskBoard.
+    """
+
+    server = None  # the McJobServer, started by this pool
+    finished = None  # dict with (success, return value or exception) per finished task ID
+    heartbeatTimeout = 30.0  # seconds without a heartbeat, after which an agent is given up
+    _board = None  # proxy of the McTaskBoard of the server
+    _nextTaskId = 0  # ID of the next submitted task
+
+    def __init__(
+        self, address: Union[tuple, str], authkey: bytes, heartbeatTimeout: float = 30.0
+    ) -> None:
+        self.server = McJobServer(address=address, authkey=authkey)
+        self.server.start()
+        self.finished = {}
+        self.heartbeatTimeout = heartbeatTimeout
+        self._board = self.server.board()
+        self._nextTaskId = 0
+
+    @property
+    def address(self) -> Union[tuple, str]:
+        """the address the agents should connect to"""
+        return self.server.address
+
+    def apply_async(self, func: Callable, args: tuple = ()) -> McClusterResult:
+        taskId, self._nextTaskId = self._nextTaskId, self._nextTaskId + 1
+        # pickled here, the server only passes the task on: it would replace the proxies of its
+        # own objects in there by the (unpicklable) objects themselves when unpickling
+        self._board.put(taskId, pickle.dumps((func, args)))
+        return McClusterResult(self, taskId)
+
+    def collect(self, timeout: float = 0) -> None:
+        """fetches the results of the tasks finished by the agents, waiting up to timeout for
+        the first one, and queues the tasks of lost agents again"""
+        requeued = self._board.requeue(self.heartbeatTimeout)
+        if requeued > 0:
+            print("{} tasks of lost worker agents are queued again".format(requeued))
+        for taskId, success, value in self._board.collect(timeout):
+            self.finished[taskId] = (success, value)
+
+    def nAgents(self) -> int:
+        """the number of connected worker agents"""
+        return self._board.nAgents()
+
+    def close(self) -> None:
+        pass  # the agents disconnect when the server is shut down
+
+    def terminate(self) -> None:
+        pass
+
+    def join(self) -> None:
+        pass
+
+
+def agentId() -> str:
+    """identifies this agent among those of all machines"""
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def sendHeartbeats(board, agent: str, stop: threading.Event) -> None:
+    """tells the server that the agent is alive, until stopped or the server has shut down"""
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            board.heartbeat(agent)
+        except (EOFError, OSError):
+            return
+
+
+def runAgent(address: Union[tuple, str], authkey: bytes, threadsPerWorker: int = 1) -> None:
+    """runs the tasks of a McClusterPool, until its server shuts down"""
+    # used for the connections of the proxies in the tasks as well:
+    multiprocessing.current_process().authkey = authkey
+    server = McJobServer(address=address, authkey=authkey)
+    server.connect()
+    board, agent = server.board(), agentId()
+    if threadsPerWorker > 0:
+        limitThreads(threadsPerWorker)
+    # also while a task runs, from a thread of its own (with its own connection):
+    stop = threading.Event()
+    threading.Thread(target=sendHeartbeats, args=(board, agent, stop), daemon=True).start()
+    try:
+        while True:
+            try:
+                claimed = board.claim(agent, HEARTBEAT_INTERVAL)
+            except (EOFError, OSError):
+                return  # the server has shut down
+            if claimed is None:
+                continue
+            taskId, task = claimed
+            stdout, stderr = sys.stdout, sys.stderr  # in case the task replaces these
+            try:
+                func, args = pickle.loads(task)
+                result = (taskId, True, func(*args))
+            except Exception as e:
+                try:
+                    pickle.dumps(e)
+                except Exception:
+                    e = RuntimeError("{}: {}".format(type(e).__name__, e))
+                result = (taskId, False, e)
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+            try:
+                board.finish(*result)
+            except (EOFError, OSError):
+                return
+    finally:
+        stop.set()
+
+
+def startAgents(
+    address: Union[tuple, str], authkey: bytes, nWorkers: int = 1, threadsPerWorker: int = 1
+) -> list:
+    """starts nWorkers worker agent processes on this machine, returns the Process instances"""
+    agents = [
+        multiprocessing.Process(target=runAgent, args=(address, authkey, threadsPerWorker))
+        for _ in range(nWorkers)
+    ]
+    for agent in agents:
+        agent.start()
+    return agents
+
+
+def parseAddress(address: str) -> Union[tuple, str]:
+    """(host, port) from "host:port", otherwise the path of a Unix socket"""
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+def formatAddress(address: Optional[Union[tuple, str]]) -> str:
+    if isinstance(address, tuple):
+        return "{}:{}".format(*address)
+    return str(address)
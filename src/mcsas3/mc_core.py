@@ -1,15 +1,17 @@
 # src/mcsas3/mccore.py
 
+import time
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
 import numpy as np
 
 # import scipy.optimize
-from mcsas3.mc_hdf import ResultIndex
+from mcsas3.mc_hdf import ResultIndex, storeKV
 
-from .mc_model import McModel
+from .mc_model import MODEL_LOCK, McModel
 from .mc_opt import McOpt
+from .mc_timing import McTiming
 from .osb import optimizeScalingAndBackground
 
 
@@ -36,6 +38,9 @@ class McCore:
         volume-weighting / compensation factor for the contributions
     nContrib:
         number of contributions
+    resume:
+        continue the optimization from the state in model and opt, e.g. loaded from a checkpoint,
+        instead of starting a new one
 
     """
 
@@ -44,6 +49,13 @@ class McCore:
     _opt = None  # instance of McOpt
     _OSB = None  # optimizeScalingAndBackground instance for this data
     _outputFilename = None  # store output data in here (HDF5)
+    _contribI = None  # (nContrib x nQ) array with the intensity of every contribution
+    _pickI = None  # intensity of the latest pick, moved into _contribI on acceptance
+    _deltaI = None  # change in total intensity when replacing the contribution with the pick
+    _acceptsSinceResync = 0  # number of accepted picks since modelI was last recalculated
+    _driftEstimate = 0.0  # estimated relative round-off drift of modelI since then
+    _timing = None  # McTiming instance with the wall times per phase, if recordTiming is set
+    cancelPollInterval = 0.1  # seconds between calls of the cancel callback of optimize
 
     def __init__(
         self,
@@ -53,6 +65,7 @@ class McCore:
         loadFromFile: Optional[Path] = None,
         loadFromRepetition: Optional[int] = None,
         resultIndex: int = 1,
+        resume: bool = False,
     ):
         # make sure we reset state:
         self._measData = None
@@ -60,6 +73,12 @@ class McCore:
         self._opt = None
         self._OSB = None
         self._outputFilename = None
+        self._contribI = None
+        self._pickI = None
+        self._deltaI = None
+        self._acceptsSinceResync = 0
+        self._driftEstimate = 0.0
+        self._timing = None
 
         assert measData is not None, "measurement data must be provided to McCore"
         assert isinstance(
@@ -74,6 +93,10 @@ class McCore:
         if loadFromFile is not None:
             self.load(loadFromFile, loadFromRepetition, resultIndex=resultIndex)
             testGof, testX0 = self._opt.gof, self._opt.x0
+        elif resume:
+            self._model = model
+            self._opt = opt  # McOpt instance with the running variables to continue from
+            testGof, testX0 = self._opt.gof, self._opt.x0
         else:
             self._model = model
             self._opt = opt  # McOpt instance
@@ -81,13 +104,23 @@ class McCore:
             self._opt.accepted = 0  # number of accepted iterations
             self._opt.acceptedSteps = []
             self._opt.acceptedGofs = []
+            self._opt.resyncSteps = []
+            self._opt.resyncDrifts = []
 
-        self._OSB = optimizeScalingAndBackground(measData["I"], measData["ISigma"])
+        self._OSB = optimizeScalingAndBackground(
+            measData["I"], measData["ISigma"], engine=self._opt.osbEngine
+        )
+        if self._opt.recordTiming:
+            self._timing = McTiming()
 
         # set default parameters:
         self._model.func.info.parameters.defaults.update(self._model.staticParameters)
         # generate kernel
-        self._model.kernel = self._model.func.make_kernel(self._measData["Q"])
+        with MODEL_LOCK:  # every repetition gets its own kernel instance
+            self._model.kernel = self._model.func.make_kernel(self._measData["Q"])
+        if self._model.tabulate:
+            # serve picks by interpolation, the table is only (re)built if Q has changed:
+            self._model.tabulateIV(self._measData["Q"])
         # calculate scattering intensity by combining intensities from all contributions
         self.initModelI()
         self._opt.gof = (
@@ -95,6 +128,10 @@ class McCore:
         )  # calculate initial GOF measure, initial happens when x0 is None
         # store the initial background and scaling optimization as new initial guess:
         self._opt.x0 = self._opt.testX0
+        if resume:
+            # continue exactly where we stopped, from the modelI recalculated at the checkpoint:
+            self._opt.gof, self._opt.x0 = testGof, testX0
+            return
 
         self._opt.acceptedSteps += [0]
         self._opt.acceptedGofs += [self._opt.gof]
@@ -123,103 +160,228 @@ class McCore:
 
     def initModelI(self) -> None:
         """calculate the total intensity from all contributions"""
-        # set initial shape:
-        I, V = self._model.calcModelIV(self._model.parameterSet.loc[0].to_dict())
-        # zero-out all previously stored values for intensity and volume
-        self._opt.modelI = np.zeros(I.shape)
+        # zero-out all previously stored values for volume
         self._model.volumes = np.zeros(self._model.nContrib)
         # add the intensity of every contribution
         for contribi in range(self._model.nContrib):
-            I, V = self._model.calcModelIV(self._model.parameterSet.loc[contribi].to_dict())
-            # V = self.returnModelV()
-            # intensity is added, NOT normalized by number of contributions.
+            I, V = self._model.calcModelIV(self._model.contribParameters(contribi))
+            if contribi == 0:
+                # set shape of the per-contribution intensity cache from the first contribution:
+                self._contribI = np.empty((self._model.nContrib, I.size), dtype=I.dtype)
             # volume normalization is already done in SasModels (!),
             # so we have volume-weighted intensities from there...
-            self._opt.modelI += I  # / self._model.nContrib
+            self._contribI[contribi] = I
             # we store the volumes anyway since we may want to use them later
             # for showing alternatives of number-weighted, or volume-squared weighted histograms
             self._model.volumes[contribi] = V
+        # intensity is added, NOT normalized by number of contributions.
+        self._opt.modelI = self.compensatedSum(self._contribI)
+        # (re-)set the weighted model sums for incremental evaluation of single changes:
+        self._OSB.setModel(self._opt.modelI)
+        self._acceptsSinceResync, self._driftEstimate = 0, 0.0
+
+    @staticmethod
+    def compensatedSum(rows: np.ndarray) -> np.ndarray:
+        """sum over the rows (first axis) in double precision,
+        with Neumaier's compensated summation to minimize round-off errors"""
+        total = np.zeros(rows.shape[1:], dtype=np.float64)
+        compensation = np.zeros_like(total)
+        for row in rows:
+            newTotal = total + row
+            compensation += np.where(
+                np.abs(total) >= np.abs(row), (total - newTotal) + row, (row - newTotal) + total
+            )
+            total = newTotal
+        return total + compensation
+
+    def resyncDue(self) -> bool:
+        """whether modelI should be recalculated from the per-contribution intensities,
+        based on the number of accepted picks or the estimated round-off drift"""
+        if (self._opt.resyncInterval > 0) and (
+            self._acceptsSinceResync >= self._opt.resyncInterval
+        ):
+            return True
+        return (self._opt.resyncTolerance > 0) and (self._driftEstimate > self._opt.resyncTolerance)
+
+    def resyncModelI(self) -> None:
+        """recalculates modelI exactly from the cached per-contribution intensities (without
+        kernel calls), bounding the drift of the running updates. The measured drift is logged"""
+        exactI = self.compensatedSum(self._contribI)
+        drift = np.max(np.abs(self._opt.modelI - exactI)) / max(np.max(np.abs(exactI)), 1e-300)
+        self._opt.resyncSteps += [self._opt.step]
+        self._opt.resyncDrifts += [drift]
+        self._opt.modelI = exactI
+        self._OSB.setModel(self._opt.modelI)
+        self._acceptsSinceResync, self._driftEstimate = 0, 0.0
 
     def evaluate(
         self, testData: Optional[dict] = None
-    ) -> (
-        float
-    ):  # , initial: bool = True):  # takes 20 ms! initial is taken care of in osb when x0 is None
+    ) -> float:  # , initial: bool = True):  # initial is taken care of in osb when x0 is None
         """scale and calculate goodness-of-fit (GOF) from all contributions"""
         if testData is None:
             testData = self._opt.modelI
 
-        # this function takes quite a while:
+        # closed-form by default, the scipy engine takes quite a while (20 ms):
         self._opt.testX0, gof = self._OSB.match(testData, self._opt.x0)
         return gof
 
-    def contribIndex(self) -> int:
-        return self._opt.step % self._model.nContrib
+    def contribIndex(self, offset: int = 0) -> int:
+        return (self._opt.step + offset) % self._model.nContrib
 
     def reEvaluate(self) -> float:
         """replace single contribution with new contribution, recalculate intensity and GOF"""
 
-        # calculate old intensity to subtract:
-        Iold, dummy = self._model.calcModelIV(
-            self._model.parameterSet.loc[self.contribIndex()].to_dict()
-        )
+        # old intensity to subtract was cached when the contribution was accepted:
+        Iold = self._contribI[self.contribIndex()]
 
         # calculate new intensity to add:
+        t = self.lap()
         Ipick, Vpick = self._model.calcModelIV(self._model.pickParameters)
+        t = self.lap("kernel", t)
 
         # remove intensity from contribi from modelI
         # add intensity from Pick
-        self._opt.testModelI = self._opt.modelI + (Ipick - Iold)
+        self._deltaI = Ipick - Iold
 
-        # store pick volume in temporary location
+        # store pick intensity and volume in temporary location
+        self._pickI = Ipick
         self._opt.testModelV = Vpick
-        # recalculate reduced chi-squared for this option
-        return self.evaluate(self._opt.testModelI)
+        # recalculate reduced chi-squared for this option, updated from the change only
+        self._opt.testX0, gof = self._OSB.matchDelta(self._deltaI, self._opt.x0)
+        self.lap("match", t)
+        return gof
+
+    def lap(self, phase: Optional[str] = None, since: int = 0) -> int:
+        """adds the time since the given time to the phase, if timing is enabled in McOpt.
+        Returns the current time in ns, to be used as start of the next timed phase"""
+        if self._timing is None:
+            return 0
+        return self._timing.lap(phase, since)
 
     def reject(self) -> None:
         """reject pick"""
         # nothing to do. Can be used to fish out a running rejection/acceptance ratio later
         pass
 
-    def accept(self) -> None:
-        """accept pick"""
+    def accept(self, offset: int = 0) -> None:
+        """accept pick, offset is the position of the accepted pick in a batch"""
+        contribi = self.contribIndex(offset)
         # store parameters of accepted pick:
-        self._model.parameterSet.loc[self.contribIndex()] = self._model.pickParameters
-        # store calculated intensity as new total intensity:
-        self._opt.modelI = self._opt.testModelI
+        self._model.setContribParameters(contribi, self._model.pickParameters)
+        # update the cached intensity of the replaced contribution:
+        self._contribI[contribi] = self._pickI
+        # store updated intensity as new total intensity:
+        self._opt.modelI = self._opt.modelI + self._deltaI
+        self._acceptsSinceResync += 1
+        if self._opt.resyncTolerance > 0:
+            # round-off in the intensity change accumulates with every update:
+            self._driftEstimate += (
+                np.finfo(self._deltaI.dtype).eps
+                * np.max(np.abs(self._deltaI))
+                / max(np.max(np.abs(self._opt.modelI)), 1e-300)
+            )
+        if self.resyncDue():
+            self.resyncModelI()
+        else:
+            self._OSB.setModel(self._opt.modelI)
         # store new pick volume to the set of volumes:
-        self._model.volumes[self.contribIndex()] = self._opt.testModelV
+        self._model.volumes[contribi] = self._opt.testModelV
         # store latest scaling and background values as new initial guess:
         self._opt.x0 = self._opt.testX0
-        self._opt.acceptedSteps += [self._opt.step]  # step at which we accepted
+        self._opt.acceptedSteps += [self._opt.step + offset]  # step at which we accepted
         self._opt.acceptedGofs += [self._opt.gof]  # gof at which we accepted
         # add one to the accepted moves counter:
         self._opt.accepted += 1
 
     def iterate(self) -> None:
         """pick, re-evaluate and accept/reject"""
+        if self._opt.batchSize > 1:
+            return self.iterateBatch()
         # pick new model parameters:
+        t = self.lap()
         self._model.pick()  # 3 µs
+        self.lap("pick", t)
         # calculate GOF for the new total set:
         newGof = self.reEvaluate()  # 2 ms
         # if this is an improvement:
         if newGof < self._opt.gof:
             # accept the move:
+            t = self.lap()
             self.accept()  # 500 µs
+            self.lap("accept", t)
             # and store the new GOF as current:
             self._opt.gof = newGof
         # increment step counter in either case:
         self._opt.step += 1
 
-    def optimize(self) -> None:
-        """iterate until target GOF or maxiter reached"""
-        print("Optimization of repetition {} started:".format(self._opt.repetition))
-        print(
-            "chiSqr: {}, N accepted: {} / {}".format(
-                self._opt.gof, self._opt.accepted, self._opt.step
-            )
+    def iterateBatch(self) -> None:
+        """pick a batch of candidates for the next contributions in line, evaluate them together
+        and accept the best candidate if it is an improvement. Counts as one step per pick."""
+        nPicks = int(
+            min(self._opt.batchSize, self._model.nContrib, self._opt.maxIter - self._opt.step)
+        )
+        nPicks = max(nPicks, 1)
+        indices = [self.contribIndex(offset) for offset in range(nPicks)]
+        # timed per batch:
+        t = self.lap()
+        self._model.pickBatch(nPicks)
+        t = self.lap("pick", t)
+        Ipicks, Vpicks = self._model.calcModelIVBatch(self._model.pickParametersBatch)
+        t = self.lap("kernel", t)
+        deltaI = Ipicks - self._contribI[indices]
+        testX0s, newGofs = self._OSB.matchDeltaBatch(deltaI, self._opt.x0)
+        self.lap("match", t)
+        best = int(np.argmin(newGofs))
+        if newGofs[best] < self._opt.gof:
+            # move the best candidate into the single-pick locations used by accept():
+            self._model.pickParameters = {
+                key: val[best] for key, val in self._model.pickParametersBatch.items()
+            }
+            self._pickI, self._deltaI = Ipicks[best], deltaI[best]
+            self._opt.testModelV, self._opt.testX0 = Vpicks[best], testX0s[best]
+            t = self.lap()
+            self.accept(offset=best)
+            self.lap("accept", t)
+            self._opt.gof = newGofs[best]
+        self._opt.step += nPicks
+
+    def checkpointDue(self, lastStep: int, lastTime: float) -> bool:
+        """whether the running state should be stored, according to the checkpoint settings"""
+        if (self._opt.checkpointSteps > 0) and (
+            self._opt.step - lastStep >= self._opt.checkpointSteps
+        ):
+            return True
+        return (self._opt.checkpointInterval > 0) and (
+            time.time() - lastTime >= self._opt.checkpointInterval
         )
 
+    def prepareCheckpoint(self) -> None:
+        """recalculates modelI exactly, as will be done when resuming from the stored state, so
+        that a resumed optimization continues identically to an uninterrupted one"""
+        self._opt.modelI = self.compensatedSum(self._contribI)
+        self._OSB.setModel(self._opt.modelI)
+        self._acceptsSinceResync, self._driftEstimate = 0, 0.0
+        self._opt.finished = False
+
+    def optimize(
+        self,
+        checkpoint: Optional[Callable[[], None]] = None,
+        cancel: Optional[Callable[[], bool]] = None,
+        progress: Optional[Callable[[dict], None]] = None,
+    ) -> None:
+        """iterate until target GOF or maxiter reached. If the checkpoint settings of McOpt are
+        set, checkpoint is called to store the running state whenever one is due. cancel is
+        polled every cancelPollInterval seconds, the optimization stops unfinished when it
+        returns True. progress is called with a progressEvent every progressInterval seconds
+        (set in McOpt), and at the start and end, by default the progress is printed."""
+        if progress is None:
+            progress = self.printProgress
+        print("Optimization of repetition {} started:".format(self._opt.repetition))
+        startStep, startAccepted, startTime = self._opt.step, self._opt.accepted, time.time()
+        lastCheckpointStep, lastCheckpointTime = startStep, startTime
+        lastCancelPoll, lastProgress = startTime, startTime
+        progress(self.progressEvent("running", startTime))
+
         # continue optimizing until we reach any of these targets:
         while (
             (self._opt.accepted < self._opt.maxAccept)  # max accepted moves
@@ -227,26 +389,64 @@ class McCore:
             & (self._opt.gof > self._opt.convCrit)  # max number of tries
         ):  # convergence criterion reached
             self.iterate()
-            # show me every 1000 steps where you are in the optimization:
-            if self._opt.step % 1000 == 1:
-                print(
-                    "chiSqr: {}, N accepted: {} / {}".format(
-                        self._opt.gof, self._opt.accepted, self._opt.step
-                    )
-                )
+            now = time.time()
+            if now - lastProgress >= self._opt.progressInterval:
+                lastProgress = now
+                progress(self.progressEvent("running", startTime))
+            if (checkpoint is not None) and self.checkpointDue(
+                lastCheckpointStep, lastCheckpointTime
+            ):
+                self.prepareCheckpoint()
+                checkpoint()
+                lastCheckpointStep, lastCheckpointTime = self._opt.step, time.time()
+            if (cancel is not None) and (now - lastCancelPoll >= self.cancelPollInterval):
+                lastCancelPoll = now
+                if cancel():
+                    print("Optimization of repetition {} cancelled".format(self._opt.repetition))
+                    progress(self.progressEvent("cancelled", startTime))
+                    return
+        self._opt.finished = True
+        progress(self.progressEvent("finished", startTime))
+
+        # record the acceptance rate and throughput, e.g. for comparing batch sizes:
+        nSteps = self._opt.step - startStep
+        if nSteps > 0:
+            self._opt.acceptanceRate = (self._opt.accepted - startAccepted) / nSteps
+            self._opt.pickRate = nSteps / max(time.time() - startTime, 1e-9)
+        if self._timing is not None:
+            print("Mean time per call, {}".format(self._timing.summary()))
+
+    def progressEvent(self, state: str, startTime: float) -> dict:
+        """the progress of the optimization: repetition, step, accepted, gof, the elapsed time
+        since startTime in seconds, and its state: "running", "finished" or "cancelled" """
+        return dict(
+            repetition=self._opt.repetition,
+            step=self._opt.step,
+            accepted=self._opt.accepted,
+            gof=float(self._opt.gof),
+            elapsed=time.time() - startTime,
+            state=state,
+        )
+
+    @staticmethod
+    def printProgress(event: dict) -> None:
+        print(
+            "chiSqr: {}, N accepted: {} / {}".format(event["gof"], event["accepted"], event["step"])
+        )
 
     def store(self, filename: Path) -> None:
         """stores the resulting model parameter-set of a single repetition in the NXcanSAS object,
         ready for histogramming"""
 
         self._outputFilename = filename
+        path = self.resultIndex.nxsEntryPoint / "optimization" / f"repetition{self._opt.repetition}"
+        t = self.lap()
         self._model.store(filename=self._outputFilename, repetition=self._opt.repetition)
-        self._opt.store(
-            filename=self._outputFilename,
-            path=self.resultIndex.nxsEntryPoint
-            / "optimization"
-            / f"repetition{self._opt.repetition}",
-        )
+        self._opt.store(filename=self._outputFilename, path=path)
+        if self._timing is not None:
+            # includes the time taken for this store, but not for storing the timing itself:
+            self.lap("store", t)
+            storeKV(self._outputFilename, path=path / "timing", value=self._timing.asDict())
 
     def load(self, loadFromFile: Path, loadFromRepetition: int, resultIndex: int = 1) -> None:
         """loads the configuration and set-up from the extended NXcanSAS file"""
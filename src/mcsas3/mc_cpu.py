@@ -0,0 +1,143 @@
+# src/mcsas3/mc_cpu.py
+
+import math
+import multiprocessing
+import os
+from pathlib import Path
+from typing import Optional
+
+# environment variables limiting the threads of the native libraries used by NumPy and SciPy:
+THREAD_LIMIT_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "BLIS_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+def allowedCpus() -> list:
+    """the CPUs this process may run on, according to its affinity mask where supported"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not available on Windows and macOS
+        return list(range(multiprocessing.cpu_count()))
+
+
+def cgroupCpuLimit(
+    root: Path = Path("/sys/fs/cgroup"), procCgroup: Path = Path("/proc/self/cgroup")
+) -> Optional[float]:
+    """the CPU quota of the control group of this process in (fractional) CPUs, as set for
+    containers, e.g. by Kubernetes. The smallest quota along the cgroup hierarchy applies.
+    Supports cgroup v2 (cpu.max) and v1 (cpu.cfs_quota_us, cpu.cfs_period_us), None: no quota"""
+    limits = []
+    try:
+        cgroups = [line.strip().split(":", 2) for line in procCgroup.read_text().splitlines()]
+    except OSError:
+        cgroups = []
+    for _, controllers, cgroupPath in cgroups or [("0", "", "/")]:
+        if controllers == "":  # cgroup v2, unified hierarchy
+            for directory in parentDirectories(root, cgroupPath):
+                limits += [readCpuMax(directory / "cpu.max")]
+        elif "cpu" in controllers.split(","):  # cgroup v1, cpu controller
+            # mounted at its own name, e.g. cpu,cpuacct, often with a symbolic link named cpu:
+            for mountPoint in dict.fromkeys([root / controllers, root / "cpu"]):
+                for directory in parentDirectories(mountPoint, cgroupPath):
+                    limits += [readCfsQuota(directory)]
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if len(limits) > 0 else None
+
+
+def parentDirectories(mountPoint: Path, cgroupPath: str) -> list:
+    """the directories of a cgroup and of its parents below the mount point. Within a container,
+    the cgroup of the process is usually mounted at the mount point itself."""
+    parts = [part for part in cgroupPath.split("/") if part != ""]
+    directories = [mountPoint.joinpath(*parts[:n]) for n in range(len(parts), -1, -1)]
+    return [directory for directory in directories if directory.is_dir()]
+
+
+def readCpuMax(filename: Path) -> Optional[float]:
+    """CPU quota from a cgroup v2 cpu.max file, containing the quota and period, max: no quota"""
+    try:
+        quota, period = filename.read_text().split()[:2]
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return int(quota) / int(period)
+
+
+def readCfsQuota(directory: Path) -> Optional[float]:
+    """CPU quota from the cgroup v1 cpu.cfs_quota_us and cpu.cfs_period_us files, -1: no quota"""
+    try:
+        quota = int((directory / "cpu.cfs_quota_us").read_text())
+        period = int((directory / "cpu.cfs_period_us").read_text())
+    except (OSError, ValueError):
+        return None
+    if (quota <= 0) or (period <= 0):
+        return None
+    return quota / period
+
+
+def effectiveCpuCount() -> int:
+    """the number of CPUs this process can actually use: the CPUs it may run on, limited by the
+    CPU quota of its control group (rounded up, as a partial CPU can still run a worker)"""
+    nCpus = len(allowedCpus())
+    limit = cgroupCpuLimit()
+    if limit is not None:
+        nCpus = min(nCpus, math.ceil(limit))
+    return max(nCpus, 1)
+
+
+def limitThreads(nThreads: int) -> None:
+    """limits the number of threads of the native libraries (BLAS, OpenMP) of this process. The
+    environment variables apply to libraries loaded afterwards, e.g. with the spawn start method.
+    Libraries that are already loaded are limited using threadpoolctl, if installed."""
+    for variable in THREAD_LIMIT_VARIABLES:
+        os.environ[variable] = str(nThreads)
+    try:
+        import threadpoolctl
+    except ImportError:
+        return
+    threadpoolctl.threadpool_limits(limits=nThreads)
+
+
+def scopedThreadLimits(nThreads: int):
+    """limits the number of threads of the native libraries (BLAS, OpenMP) already loaded in this
+    process, using threadpoolctl if installed, until restore_original_limits() is called on the
+    returned object. Unlike limitThreads, the environment is left as it is. None: not limited"""
+    if nThreads <= 0:
+        return None
+    try:
+        import threadpoolctl
+    except ImportError:
+        return None
+    return threadpoolctl.threadpool_limits(limits=nThreads)
+
+
+def initWorker(
+    workerCounter: multiprocessing.Value, cpus: Optional[list], threadsPerWorker: int
+) -> None:
+    """initializer of the worker processes of a McHatPool: limits the threads per worker, and,
+    if a list of CPUs is given, pins every worker to the next one"""
+    if threadsPerWorker > 0:
+        limitThreads(threadsPerWorker)
+    if cpus:
+        with workerCounter.get_lock():
+            index = workerCounter.value
+            workerCounter.value += 1
+        os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+
+
+def cpuLayout(nWorkers: int, threadsPerWorker: int, pinWorkers: bool) -> dict:
+    """description of the CPU budget and of its use by the workers, for the result file"""
+    limit = cgroupCpuLimit()
+    return {
+        "allowedCpus": allowedCpus(),
+        "cgroupCpuLimit": -1.0 if limit is None else limit,  # -1: no quota
+        "effectiveCpuCount": effectiveCpuCount(),
+        "nWorkers": nWorkers,
+        "threadsPerWorker": threadsPerWorker,
+        "pinWorkers": pinWorkers,
+    }
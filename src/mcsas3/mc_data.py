@@ -9,11 +9,49 @@ import h5py
 import numpy as np
 import pandas
 
+from mcsas3.mc_cache import McDataCache
 from mcsas3.mc_hdf import ResultIndex, loadKV, storeKVPairs
 
 # todo use attrs to @define a McData dataclass
 
 
+def binnedStatistics(binIndex: np.ndarray, values: np.ndarray, nBins: int) -> tuple:
+    """(count, mean, standard deviation) of the values in each of nBins bins, in a single pass
+    over the data. binIndex holds the bin of every value. As with pandas, NaN values are skipped,
+    and the standard deviation (ddof=1) is NaN for bins with fewer than two values"""
+    finite = ~np.isnan(values)
+    count = np.bincount(binIndex[finite], minlength=nBins)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.bincount(binIndex, weights=np.where(finite, values, 0.0), minlength=nBins) / count
+        # from the deviations of the bin means, which is more accurate than from the sum of squares:
+        deviation = np.where(finite, values - mean[binIndex], 0.0)
+        std = np.sqrt(np.bincount(binIndex, weights=deviation**2, minlength=nBins) / (count - 1))
+    std[count < 2] = np.nan
+    return count, mean, std
+
+
+def readDataset(dataset: h5py.Dataset, selection: tuple = (), memoryMap: bool = False):
+    """reads a selection (e.g. a hyperslab) of an HDF5 dataset. With memoryMap, a contiguous and
+    uncompressed dataset is memory-mapped instead, so that only the parts of the file that are
+    used are read, when they are used. Other datasets are read as usual"""
+    if (
+        memoryMap
+        and (dataset.chunks is None)
+        and (dataset.compression is None)
+        and (dataset.dtype.kind in "biuf")
+        and (dataset.id.get_offset() is not None)  # None: not allocated in the file
+    ):
+        mapped = np.memmap(
+            dataset.file.filename,
+            mode="r",
+            dtype=dataset.dtype,
+            shape=dataset.shape,
+            offset=dataset.id.get_offset(),
+        )
+        return mapped[selection]
+    return dataset[selection]
+
+
 @attrs.define
 class McData:
     """
@@ -52,6 +90,9 @@ class McData:
         default=None
     )  # , validator=attrs.validators.optional(attrs.validators.instance_of(float)))
     omitQRanges: Optional[list] = attrs.field(default=None)
+    memoryMap: bool = attrs.field(default=False, validator=attrs.validators.instance_of(bool))
+    cacheDir: Optional[Path] = attrs.field(default=None)
+    cacheSize: int = attrs.field(default=2**30, validator=attrs.validators.instance_of(int))
     resultIndex: ResultIndex = attrs.field(
         default=ResultIndex(1), validator=attrs.validators.instance_of(ResultIndex)
     )
@@ -72,6 +113,9 @@ class McData:
         "loader",
         "qNudge",
         "omitQRanges",
+        "memoryMap",
+        "cacheDir",
+        "cacheSize",
     ]
     loadKeys = (
         {  # keys to store in an HDF5 output file, values are types to cast to using _HDFLoadKV.
@@ -84,8 +128,21 @@ class McData:
             "csvargs": "dict",
             "loader": "str",
             "omitQRanges": list,  # not sure if this works?
+            "memoryMap": bool,
         }
     )
+    cacheKeys = [  # settings that affect the prepared data, part of the key of McDataCache entries
+        "loader",
+        "measDataLink",
+        "nbins",
+        "IEmin",
+        "binning",
+        "dataRange",
+        "pathDict",
+        "csvargs",
+        "qNudge",
+        "omitQRanges",
+    ]
 
     def __init__(
         self,
@@ -119,6 +176,9 @@ class McData:
         # in particular visible in 2D data...
         self.omitQRanges = None  # to skip or omit unwanted data ranges, for example with sharp
         # XRD peaks, must be a list of [[qmin, qmax], ...] pairs
+        self.memoryMap = False  # memory-map contiguous, uncompressed datasets of NeXus files
+        self.cacheDir = None  # directory of an McDataCache of prepared data, None: not cached
+        self.cacheSize = 2**30  # size limit of the McDataCache in bytes
 
         # make sure we store and read from the right place.
         self.resultIndex = ResultIndex(resultIndex)  # defines the HDF5 root path
@@ -148,15 +208,12 @@ class McData:
 
         if (self.filename.suffix == ".pdh") or (self.loader == "from_pdh"):
             self.loader = "from_pdh"  # ensure this is set
-            self.from_pdh(self.filename)
         elif (self.filename.suffix in [".csv", ".dat", ".txt"]) or (self.loader == "from_csv"):
             self.loader = "from_csv"  # ensure this is set
-            self.from_csv(self.filename)
         elif (self.filename.suffix in [".h5", ".hdf5", ".nx", ".nxs"]) or (
             self.loader == "from_nexus"
         ):
             self.loader = "from_nexus"
-            self.from_nexus(self.filename)
             # load first, then find out if 1D or 2D
         else:
             assert False, (
@@ -165,6 +222,16 @@ class McData:
                 " input"
             )
 
+        cache = None
+        if self.cacheDir is not None:
+            cache = McDataCache(self.cacheDir, self.cacheSize)
+            cacheKey = cache.key(self)
+            if cache.restore(self, cacheKey):
+                return
+        getattr(self, self.loader)(self.filename)
+        if cache is not None:
+            cache.store(self, cacheKey)
+
     def from_pandas(self, df: pandas.DataFrame = None) -> None:
         assert False, "defined in 1D and 2D subclasses"
         pass
@@ -197,6 +264,8 @@ class McData:
             self.filename = filename  # reset to new source if not already set
         self.rawData = {}
 
+        # first find the paths of the datasets, they are read below:
+        paths = {}
         if self.pathDict is not None:
             assert isinstance(
                 self.pathDict, dict
@@ -204,11 +273,7 @@ class McData:
             assert all(
                 [j in self.pathDict.keys() for j in ["Q", "I", "ISigma"]]
             ), "provided path must be dict with keys 'Q', 'I', and 'ISigma'"
-            with h5py.File(filename, "r") as h5f:
-                [
-                    self.rawData.update({key: h5f[f"{val}"][()].squeeze()})
-                    for key, val in self.pathDict.items()
-                ]
+            paths = {key: f"{val}" for key, val in self.pathDict.items()}
 
         else:
             sigPath = "/"
@@ -227,30 +292,17 @@ class McData:
                 # if isinstance(signalLabel, bytes): signalLabel = signalLabel.decode("utf-8")
                 sigPathI = sigPath + signalLabel
                 # extract intensity along qDim... sorry, don't know how (qDim is found below):
-                self.rawData.update({"I": h5f[sigPathI][()].squeeze()})
+                paths["I"] = sigPathI
                 # and ISigma:
-                uncertaintiesAvailable = False
-                maskAvailable = False
                 if f"{signalLabel}_uncertainty" in h5f[sigPath].attrs:
                     uncLabel = objBytesToStr(h5f[sigPath].attrs[f"{signalLabel}_uncertainty"])
-                    uncertaintiesAvailable = True
+                    paths["ISigma"] = sigPath + uncLabel
                 elif "uncertainties" in h5f[sigPathI].attrs:
                     uncLabel = objBytesToStr(h5f[sigPathI].attrs["uncertainties"])
-                    uncertaintiesAvailable = True
-                else:
-                    # some default:
-                    self.rawData.update({"ISigma": self.rawData["I"] * 0.001})
+                    paths["ISigma"] = sigPath + uncLabel
                 if "mask" in h5f[sigPath].attrs:
                     maskLabel = objBytesToStr(h5f[sigPath].attrs["mask"])
-                    maskAvailable = True
-
-                if uncertaintiesAvailable:  # load them
-                    # if isinstance(uncLabel, bytes): uncLabel = uncLabel.decode("utf-8")
-                    sigPathISigma = sigPath + uncLabel
-                    self.rawData.update({"ISigma": h5f[sigPathISigma][()].squeeze()})
-                if maskAvailable:  # load them
-                    sigPathMask = sigPath + maskLabel
-                    self.rawData.update({"mask": h5f[sigPathMask][()].squeeze()})
+                    paths["mask"] = sigPath + maskLabel
 
                 # now we have I, we search for Q in the "axes" attribute:
                 axesLabel = None
@@ -272,16 +324,38 @@ class McData:
                 # this is what our q label is in the axes attribute:
                 qLabel = ques[np.argwhere(np.array(quesTest)).squeeze()]
                 # if isinstance(qLabel, bytes): qLabel = qLabel.decode("utf-8")
-                self.rawData.update({"Q": h5f[sigPath + qLabel][()].squeeze()})
+                paths["Q"] = sigPath + qLabel
+
+        with h5py.File(filename, "r") as h5f:
+            # Q first: for 2D data, only the crop envelope of the images needs to be read
+            Q = readDataset(h5f[paths["Q"]], memoryMap=self.memoryMap).squeeze()
+            window, mask = None, None
+            if Q.ndim > 1:
+                if "mask" in paths:
+                    mask = readDataset(h5f[paths["mask"]], memoryMap=self.memoryMap).squeeze()
+                window = self.cropWindow(*self.QxQy(Q), mask)
+            for key, path in paths.items():
+                if key == "Q":
+                    value = Q
+                elif (key == "mask") and (mask is not None):
+                    # already read for the crop window:
+                    value = mask if window is None else mask[(...,) + window]
+                elif (window is not None) and (h5f[path].shape[-2:] == Q.shape[-2:]):
+                    # a hyperslab of the images, read from the file:
+                    value = readDataset(h5f[path], (...,) + window, memoryMap=self.memoryMap)
+                else:
+                    value = readDataset(h5f[path], memoryMap=self.memoryMap)
+                self.rawData.update({key: value.squeeze()})
+        if window is not None:
+            self.rawData["Q"] = self.rawData["Q"][(...,) + window]
+        if "ISigma" not in self.rawData:
+            # some default:
+            self.rawData.update({"ISigma": self.rawData["I"] * 0.001})
         if self.rawData["Q"].ndim > 1:
             # we have a three-dimensional Q array, in the order of [dim, y, x]
-            # find out which dimensions are nonzero (the remainder is Qz):
-            QxyIndices = np.argwhere(
-                [self.rawData["Q"][i, :, :].any() for i in range(self.rawData["Q"].shape[0])]
-            )
-            self.rawData["Q"] = self.rawData["Q"][QxyIndices, :, :].squeeze()
-            self.rawData["Qx"] = self.rawData["Q"][QxyIndices[1], :, :].squeeze()
-            self.rawData["Qy"] = self.rawData["Q"][QxyIndices[0], :, :].squeeze()
+            self.rawData["Qx"], self.rawData["Qy"] = self.QxQy(self.rawData["Q"])
+            # the Q components that are nonzero (the remainder is Qz):
+            self.rawData["Q"] = np.stack([self.rawData["Qy"], self.rawData["Qx"]])
             self.rawData2D = self.rawData.copy()  # intermediate storage of original data
             # but we also need to prepare a Pandas-compatible list-format data
             del self.rawData["Q"]
@@ -291,6 +365,20 @@ class McData:
         self.rawData = pandas.DataFrame(data=self.rawData)
         self.prepare()
 
+    @staticmethod
+    def QxQy(Q: np.ndarray) -> tuple:
+        """(Qx, Qy) images from a three-dimensional Q array, in the order of [dim, y, x]. The
+        dimensions that are not all zero are Qy and Qx, the remainder is Qz"""
+        QxyIndices = [i for i in range(Q.shape[0]) if Q[i].any()]
+        return Q[QxyIndices[1]], Q[QxyIndices[0]]
+
+    def cropWindow(
+        self, Qx: np.ndarray, Qy: np.ndarray, mask: Optional[np.ndarray]
+    ) -> Optional[tuple]:
+        """(slice along y, slice along x) of the part of 2D detector images that can be used,
+        so that only this part is read from the file, None: the full images"""
+        return None
+
     def is2D(self) -> bool:
         return self.rawData2D is not None
 
@@ -306,11 +394,15 @@ class McData:
         assert False, "defined in 1D and 2D subclasses"
         pass
 
+    def needsReBin(self) -> bool:
+        """whether prepare rebins the clipped data, nbins = 0: no rebinning"""
+        return self.nbins != 0
+
     def prepare(self) -> None:
         """runs the clipping and binning (in that order), populates clippedData and binnedData"""
         self.clip()
         self.omit()
-        if self.nbins != 0:
+        if self.needsReBin():
             self.reBin()
         else:
             self.binnedData = self.clippedData.copy()
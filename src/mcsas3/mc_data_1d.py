@@ -6,7 +6,8 @@ from typing import Optional
 import numpy as np
 import pandas
 
-from .mc_data import McData
+from .mc_azimuthal import azimuthalAverage
+from .mc_data import McData, binnedStatistics
 
 
 class McData1D(McData):
@@ -16,6 +17,11 @@ class McData1D(McData):
     dataRange = None  # min-max for data range to fit
     qNudge = None  # nudge in case of misaligned centers. Applied to measData
     omitQRanges = None  # to skip or omit unwanted data ranges, for example with sharp XRD peaks
+    nRadialBins = 1000  # number of |Q| bins of the azimuthal average of 2D detector images
+
+    storeKeys = McData.storeKeys + ["nRadialBins"]
+    loadKeys = dict(McData.loadKeys, nRadialBins=int)
+    cacheKeys = McData.cacheKeys + ["nRadialBins"]
 
     def __init__(
         self,
@@ -24,6 +30,8 @@ class McData1D(McData):
         resultIndex: int = 1,
         **kwargs: dict,
     ) -> None:
+        # reset before the settings are loaded from loadFromFile:
+        self.nRadialBins = 1000  # number of |Q| bins of the azimuthal average of 2D images
         super().__init__(loadFromFile=loadFromFile, resultIndex=resultIndex, **kwargs)
         self.csvargs = {
             "sep": r"\s+",
@@ -62,6 +70,13 @@ class McData1D(McData):
             ISigma=measDataObj.ISigma.values,
         )
 
+    def prepare(self) -> None:
+        """as McData.prepare. A 2D detector image read by from_nexus (for an isotropic sample) is
+        azimuthally averaged into nRadialBins |Q| bins first, see mc_azimuthal.azimuthalAverage"""
+        if self.is2D() and ("Q" not in self.rawData.keys()):
+            self.rawData = azimuthalAverage(self.rawData2D, self.nRadialBins)
+        super().prepare()
+
     def from_pdh(self, filename: Path) -> None:
         """reads from a PDH file, re-uses Ingo Bressler's code from the notebook example"""
         assert filename is not None, "from_pdh requires an input filename of a PDH file"
@@ -123,7 +138,8 @@ class McData1D(McData):
         self, nbins: Optional[int] = None, IEmin: Optional[float] = None, QEMin: float = 0.01
     ) -> None:
         """Unweighted rebinning funcionality with extended uncertainty estimation,
-        adapted from the datamerge methods, as implemented in Paulina's notebook of spring 2020
+        adapted from the datamerge methods, as implemented in Paulina's notebook of spring 2020.
+        All bins are computed at once, from the bin index of every datapoint (np.bincount)
         """
         if nbins is None:
             nbins = self.nbins
@@ -136,102 +152,62 @@ class McData1D(McData):
 
         # prepare bin edges:
         binEdges = np.logspace(np.log10(qMin), np.log10(qMax), num=nbins + 1)
-        binDat = pandas.DataFrame(
-            data={
-                "Q": np.full(nbins, np.nan),  # mean Q
-                "I": np.full(nbins, np.nan),  # mean intensity
-                "IStd": np.full(nbins, np.nan),  # standard deviation of the mean intensity
-                "ISEM": np.full(
-                    nbins, np.nan
-                ),  # standard error on mean of the mean intensity (maybe, but weighted is hard.)
-                "IError": np.full(nbins, np.nan),  # Propagated errors of the intensity
-                "ISigma": np.full(nbins, np.nan),  # Combined error estimate of the intensity
-                "QStd": np.full(nbins, np.nan),  # standard deviation of the mean Q
-                "QSEM": np.full(nbins, np.nan),  # standard error on the mean Q
-                "QError": np.full(nbins, np.nan),  # Propagated errors on the mean Q
-                "QSigma": np.full(nbins, np.nan),  # Combined error estimate on the mean Q
-            }
-        )
-
         # add a little to the end to ensure the last datapoint is captured:
         binEdges[-1] = binEdges[-1] + 1e-3 * (binEdges[-1] - binEdges[-2])
 
-        # now do the binning per bin.
-        for binN in range(len(binEdges) - 1):
-            dfRange = self.clippedData.query(
-                "{} <= Q < {}".format(binEdges[binN], binEdges[binN + 1])
-            ).copy()
-            if len(dfRange) == 0:
-                # no datapoints in the range
-                pass
-
-            elif len(dfRange) == 1:
-                # only one datapoint in the range
-                # might not be necessary to do this..
-                # can't do stats on this:
-                # FutureWarning fix:
-                binDat.loc[binN, "Q"] = float(dfRange.Q.iloc[0])
-                binDat.loc[binN, "QStd"] = binDat.loc[binN, "Q"] * QEMin
-                binDat.loc[binN, "QSEM"] = binDat.loc[binN, "Q"] * QEMin
-                binDat.loc[binN, "QError"] = binDat.loc[binN, "Q"] * QEMin
-
-                binDat.loc[binN, "I"] = float(dfRange.I.iloc[0])
-                binDat.loc[binN, "IStd"] = float(dfRange.ISigma.iloc[0])
-                binDat.loc[binN, "ISEM"] = float(dfRange.ISigma.iloc[0])
-                binDat.loc[binN, "IError"] = float(dfRange.ISigma.iloc[0])
-                binDat.loc[binN, "ISigma"] = np.max(
-                    [binDat.loc[binN, "ISEM"], float(dfRange.I.iloc[0]) * IEmin]
-                )
-
-                if "QSigma" in dfRange.keys():
-                    binDat.loc[binN, "QError"] = float(dfRange.QSigma.iloc[0])
-                    binDat.loc[binN, "QStd"] = float(dfRange.QSigma.iloc[0])
-                    binDat.loc[binN, "QSEM"] = float(dfRange.QSigma.iloc[0])
-
-                binDat.loc[binN, "QSigma"] = np.max(
-                    [
-                        binDat.loc[binN, "QSEM"],
-                        binDat.loc[binN, "QError"],
-                        binDat.loc[binN, "Q"] * QEMin,
-                    ]
-                )
-
-                # binDat.QSigma.loc[binN] = np.max(
-                #     [float(binDat.QSEM.loc[binN]), float(dfRange.Q.iloc[0]) * QEMin]
-                # )
-
-            else:
-                # multiple datapoints in the range
-                # fixing FutureWarning
-                binDat.loc[binN, "I"] = dfRange.I.mean(skipna=True)
-                binDat.loc[binN, "IStd"] = dfRange.I.std(ddof=1, skipna=True)
-                binDat.loc[binN, "ISEM"] = dfRange.I.sem(ddof=1, skipna=True)
-                binDat.loc[binN, "IError"] = np.sqrt(((dfRange.ISigma) ** 2).sum()) / len(dfRange)
-                binDat.loc[binN, "ISigma"] = np.max(
-                    [
-                        binDat.loc[binN, "ISEM"],
-                        binDat.loc[binN, "IError"],
-                        binDat.loc[binN, "I"] * IEmin,
-                    ]
-                )
-
-                binDat.loc[binN, "Q"] = dfRange.Q.mean(skipna=True)
-                binDat.loc[binN, "QStd"] = dfRange.Q.std(ddof=1, skipna=True)
-                binDat.loc[binN, "QSEM"] = dfRange.Q.sem(ddof=1, skipna=True)
-                binDat.loc[binN, "QError"] = binDat.loc[binN, "Q"] * QEMin
-
-                if "QSigma" in dfRange.keys():
-                    binDat.loc[binN, "QError"] = np.sqrt(((dfRange.QSigma) ** 2).sum()) / len(
-                        dfRange
-                    )
-
-                binDat.loc[binN, "QSigma"] = np.max(
-                    [
-                        binDat.loc[binN, "QSEM"],
-                        binDat.loc[binN, "QError"],
-                        binDat.loc[binN, "Q"] * QEMin,
-                    ]
-                )
+        # all bins at once: the bin of every datapoint, with binEdges[i] <= Q < binEdges[i + 1]
+        Q = self.clippedData.Q.to_numpy(dtype=float)
+        binIndex = np.searchsorted(binEdges, Q, side="right") - 1
+        inRange = (binIndex >= 0) & (binIndex < nbins) & ~np.isnan(Q)
+        binIndex, Q = binIndex[inRange], Q[inRange]
+        Int = self.clippedData.I.to_numpy(dtype=float)[inRange]
+        ISigma = self.clippedData.ISigma.to_numpy(dtype=float)[inRange]
+        QSigma = None
+        if "QSigma" in self.clippedData.keys():
+            QSigma = self.clippedData.QSigma.to_numpy(dtype=float)[inRange]
+
+        nPoints = np.bincount(binIndex, minlength=nbins)
+        ICount, IMean, IStd = binnedStatistics(binIndex, Int, nbins)
+        QCount, QMean, QStd = binnedStatistics(binIndex, Q, nbins)
+
+        def propagated(sigma: np.ndarray) -> np.ndarray:
+            # propagated uncertainty of the mean, NaN values are skipped in the sum:
+            squares = np.where(np.isnan(sigma), 0.0, sigma**2)
+            return np.sqrt(np.bincount(binIndex, weights=squares, minlength=nbins)) / nPoints
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            binDat = pandas.DataFrame(
+                data={
+                    "Q": QMean,  # mean Q
+                    "I": IMean,  # mean intensity
+                    "IStd": IStd,  # standard deviation of the mean intensity
+                    # standard error on mean of the mean intensity (maybe, but weighted is hard.)
+                    "ISEM": IStd / np.sqrt(ICount),
+                    "IError": propagated(ISigma),  # Propagated errors of the intensity
+                    "ISigma": np.nan,  # Combined error estimate of the intensity
+                    "QStd": QStd,  # standard deviation of the mean Q
+                    "QSEM": QStd / np.sqrt(QCount),  # standard error on the mean Q
+                    # Propagated errors on the mean Q:
+                    "QError": QMean * QEMin if QSigma is None else propagated(QSigma),
+                    "QSigma": np.nan,  # Combined error estimate on the mean Q
+                }
+            )
+
+        # only one datapoint in the bin, can't do stats on this:
+        single = nPoints == 1
+        point = np.zeros(nbins, dtype=int)
+        point[binIndex] = np.arange(len(binIndex))  # the datapoint of each single-point bin
+        point = point[single]
+        binDat.loc[single, "Q"] = Q[point]
+        for key in ["QStd", "QSEM", "QError"]:
+            binDat.loc[single, key] = Q[point] * QEMin if QSigma is None else QSigma[point]
+        binDat.loc[single, "I"] = Int[point]
+        for key in ["IStd", "ISEM", "IError"]:
+            binDat.loc[single, key] = ISigma[point]
+
+        # the combined uncertainties are the largest of the estimates (NaN if any is NaN):
+        binDat["ISigma"] = np.maximum(np.maximum(binDat.ISEM, binDat.IError), binDat.I * IEmin)
+        binDat["QSigma"] = np.maximum(np.maximum(binDat.QSEM, binDat.QError), binDat.Q * QEMin)
 
         # remove empty bins
         binDat.dropna(thresh=4, inplace=True)
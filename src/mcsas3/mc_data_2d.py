@@ -7,7 +7,7 @@ from typing import Optional
 import numpy as np
 import pandas
 
-from .mc_data import McData
+from .mc_data import McData, binnedStatistics
 
 
 # @define
@@ -27,6 +27,12 @@ class McData2D(McData):
         0,
         0,
     ]  # nudge in direction 0 and 1 in case of misaligned centers. Applied to measData
+    binFactor = 1  # rebinning into blocks of binFactor x binFactor pixels, 1: no block averaging
+    nAzimuthalBins = 0  # rebinning into nbins |Q| x nAzimuthalBins psi bins, 0: not in (|Q|, psi)
+
+    storeKeys = McData.storeKeys + ["binFactor", "nAzimuthalBins"]
+    loadKeys = dict(McData.loadKeys, binFactor=int, nAzimuthalBins=int)
+    cacheKeys = McData.cacheKeys + ["binFactor", "nAzimuthalBins", "orthoQ0Range", "orthoQ1Range"]
 
     def __init__(self, df=None, loadFromFile=None, resultIndex: int = 1, **kwargs: dict) -> None:
         super().__init__(resultIndex=resultIndex, **kwargs)
@@ -37,6 +43,8 @@ class McData2D(McData):
         self.orthoQ1Range = [0, np.inf]
         self.orthoQ0Range = [0, np.inf]
         self.qNudge = [0, 0]  # nudge in case of misaligned centers. Applied to measData
+        self.binFactor = 1  # rebinning into blocks of binFactor x binFactor pixels
+        self.nAzimuthalBins = 0  # rebinning into nbins |Q| x nAzimuthalBins psi bins
         self.processKwargs(**kwargs)
 
         # load from dataframe if provided
@@ -78,6 +86,31 @@ class McData2D(McData):
         assert False, "2D data from_csv not implemented yet"
         pass
 
+    def withinLimits(self, Q1: np.ndarray, Q0: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        """the unmasked pixels within dataRange and the orthogonal Q ranges"""
+        return (
+            (np.abs(Q1) > self.orthoQ1Range[0])
+            & (np.abs(Q1) < self.orthoQ1Range[1])
+            & (np.abs(Q0) > self.orthoQ0Range[0])
+            & (np.abs(Q0) < self.orthoQ0Range[1])
+            & (np.sqrt(Q1**2 + Q0**2) > self.dataRange[0])
+            & (np.sqrt(Q1**2 + Q0**2) < self.dataRange[1])
+        ).astype(bool) * np.invert(mask)
+
+    def cropWindow(
+        self, Qx: np.ndarray, Qy: np.ndarray, mask: Optional[np.ndarray]
+    ) -> Optional[tuple]:
+        """(slice along y, slice along x) of the crop envelope of the pixels within the limits,
+        for reading only this part of the images. It includes the last row and column of the
+        envelope, so that clip finds the same crop limits in the window"""
+        withinLimits = self.withinLimits(
+            Qx, Qy, np.zeros(Qx.shape, dtype=bool) if mask is None else mask.astype(bool)
+        )
+        rows, cols = np.argwhere(withinLimits.any(axis=1)), np.argwhere(withinLimits.any(axis=0))
+        if (len(rows) == 0) or (len(cols) == 0):
+            return None  # clip reports this
+        return slice(rows.min(), rows.max() + 1), slice(cols.min(), cols.max() + 1)
+
     def clip(self) -> None:
         # copied from a jupyter notebook:
         # test with directly imported data
@@ -91,14 +124,7 @@ class McData2D(McData):
             mask = np.zeros(Int.shape)
         newMask = mask.astype(bool)
 
-        withinLimits = (
-            (np.abs(Q1) > self.orthoQ1Range[0])
-            & (np.abs(Q1) < self.orthoQ1Range[1])
-            & (np.abs(Q0) > self.orthoQ0Range[0])
-            & (np.abs(Q0) < self.orthoQ0Range[1])
-            & (np.sqrt(Q1**2 + Q0**2) > self.dataRange[0])
-            & (np.sqrt(Q1**2 + Q0**2) < self.dataRange[1])
-        ).astype(bool) * np.invert(newMask)
+        withinLimits = self.withinLimits(Q1, Q0, newMask)
 
         # find crop envelope:
         Q0Lim = (
@@ -150,13 +176,105 @@ class McData2D(McData):
     def reconstruct2D(self, modelI1D: np.ndarray) -> np.ndarray:
         """Reconstructs a masked 2D data array from the (1D) model intensity, skipping the masked
         and clipped pixels (left as NaN). This function can be used to plot the resulting model
-        intensity and comparing it with self.clippedData["I2D"].
+        intensity and comparing it with self.clippedData["I2D"]. For rebinned data, every pixel
+        gets the intensity of its bin.
         """
         # RMI = reconstructedModelI
         RMI = np.full(self.clippedData["I2D"].shape, np.nan)
-        RMI[np.where(self.clippedData["invMask"])] = modelI1D
+        if (self.measDataLink == "binnedData") and ("pixelBin" in self.binnedData):
+            pixelBin = self.binnedData["pixelBin"]
+            RMI[pixelBin >= 0] = np.asarray(modelI1D)[pixelBin[pixelBin >= 0]]
+        else:
+            RMI[np.where(self.clippedData["invMask"])] = modelI1D
         return RMI
 
-    def reBin(self, nbins: Optional[int] = None, IEmin: float = 0.01, QEMin: float = 0.01) -> None:
-        print("2D data rebinning not implemented, binnedData = clippedData for now")
-        self.binnedData = self.clippedData
+    def needsReBin(self) -> bool:
+        """the blocks of binFactor x binFactor pixels do not depend on nbins, they are also
+        averaged with nbins = 0"""
+        return (self.nbins != 0) or (self.binFactor > 1) or (self.nAzimuthalBins > 0)
+
+    def reBin(
+        self, nbins: Optional[int] = None, IEmin: Optional[float] = None, QEMin: float = 0.01
+    ) -> None:
+        """Reduces the number of datapoints (and therefore the cost of every model evaluation)
+        by averaging the unmasked pixels in blocks of binFactor x binFactor pixels of the cropped
+        image, or, with nAzimuthalBins, in nbins logarithmically spaced |Q| ranges times
+        nAzimuthalBins azimuthal (psi) sectors. The uncertainty of the intensity is estimated as
+        for 1D data: the largest of the standard error on the mean, the propagated uncertainty
+        and IEmin times the intensity. Without either setting, binnedData = clippedData.
+        """
+        if nbins is None:
+            nbins = self.nbins
+
+        if IEmin is None:
+            IEmin = self.IEmin
+
+        assert self.binFactor >= 1, "binFactor must be a positive integer"
+        assert self.nAzimuthalBins >= 0, "nAzimuthalBins cannot be negative"
+        assert (self.nAzimuthalBins == 0) or (
+            nbins > 0
+        ), "rebinning into nAzimuthalBins psi bins needs nbins > 0 |Q| bins"
+        if (self.binFactor == 1) and (self.nAzimuthalBins == 0):
+            self.binnedData = self.clippedData
+            return
+
+        clipped = self.clippedData
+        Q0, Q1 = clipped["Q0Crop2D"], clipped["Q1Crop2D"]
+        valid = clipped["invMask"].astype(bool).copy()
+        if self.nAzimuthalBins > 0:
+            # bins in (|Q|, psi), with logarithmic |Q| bins as in 1D:
+            Q = np.sqrt(Q0**2 + Q1**2)
+            binEdges = np.logspace(np.log10(Q[valid].min()), np.log10(Q[valid].max()), nbins + 1)
+            binEdges[-1] = binEdges[-1] + 1e-3 * (binEdges[-1] - binEdges[-2])
+            QBin = np.searchsorted(binEdges, Q, side="right") - 1
+            valid &= (QBin >= 0) & (QBin < nbins)
+            psi = np.arctan2(Q0, Q1)  # -pi .. pi
+            psiBin = np.floor((psi + np.pi) / (2 * np.pi) * self.nAzimuthalBins).astype(int)
+            pixelBin = QBin * self.nAzimuthalBins + np.clip(psiBin, 0, self.nAzimuthalBins - 1)
+            nBins = nbins * self.nAzimuthalBins
+        else:
+            # blocks of pixels:
+            rows, cols = np.indices(Q0.shape)
+            nBlockCols = -(-Q0.shape[1] // self.binFactor)  # rounded up
+            pixelBin = (rows // self.binFactor) * nBlockCols + cols // self.binFactor
+            nBins = -(-Q0.shape[0] // self.binFactor) * nBlockCols
+
+        binIndex = pixelBin[valid]
+        Int, ISigma = clipped["I2D"][valid], clipped["ISigma2D"][valid]
+        nPixels = np.bincount(binIndex, minlength=nBins)
+        ICount, IMean, IStd = binnedStatistics(binIndex, Int, nBins)
+        _, Q0Mean, _ = binnedStatistics(binIndex, Q0[valid], nBins)
+        _, Q1Mean, _ = binnedStatistics(binIndex, Q1[valid], nBins)
+        if self.nAzimuthalBins > 0:
+            # the mean |Q| in the mean direction, the mean Q vector is shorter for wide sectors:
+            _, QMean, _ = binnedStatistics(binIndex, Q[valid], nBins)
+            psiMean = np.arctan2(Q0Mean, Q1Mean)
+            Q0Mean, Q1Mean = QMean * np.sin(psiMean), QMean * np.cos(psiMean)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ISEM = IStd / np.sqrt(ICount)  # standard error on the mean intensity
+            # propagated uncertainty of the mean intensity:
+            IError = np.sqrt(np.bincount(binIndex, weights=ISigma**2, minlength=nBins)) / nPixels
+        # a single pixel has no spread, its own uncertainty applies:
+        ISigmaBinned = np.where(nPixels > 1, np.maximum(ISEM, IError), IError)
+        ISigmaBinned = np.maximum(ISigmaBinned, IMean * IEmin)
+
+        # only the bins containing pixels, numbered consecutively:
+        kept = nPixels > 0
+        newIndex = np.cumsum(kept) - 1
+        self.binnedData = {
+            key: clipped[key]
+            for key in ["I2D", "mask2D", "ISigma2D", "Q0Crop2D", "Q1Crop2D", "kansas", "invMask"]
+        }
+        # the bin of every pixel of the cropped image, -1 for pixels that are not in a bin:
+        self.binnedData["pixelBin"] = np.full(pixelBin.shape, -1)
+        self.binnedData["pixelBin"][valid] = newIndex[binIndex]
+        self.binnedData["nPixels"] = nPixels[kept]
+        self.binnedData["I"] = IMean[kept]
+        self.binnedData["ISigma"] = ISigmaBinned[kept]
+        self.binnedData["Q"] = [Q0Mean[kept], Q1Mean[kept]]
+        self.binnedData["Qextent"] = [
+            (self.binnedData["Q"][0]).min(),
+            (self.binnedData["Q"][0]).max(),
+            (self.binnedData["Q"][1]).min(),
+            (self.binnedData["Q"][1]).max(),
+        ]
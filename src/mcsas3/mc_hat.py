@@ -1,25 +1,36 @@
 # src/mcsas3/mc_hat.py
 
+import copy
+import functools
+import multiprocessing
+import multiprocessing.pool
+import os
+import queue
 import sys
+import threading
 import time
-from io import StringIO
+from io import BytesIO, StringIO
 from pathlib import Path, PurePosixPath
-from typing import Optional
+from typing import Optional, Union
 
+import h5py
 import numpy as np
 
-from mcsas3.mc_hdf import ResultIndex, loadKVPairs, storeKVPairs
+from mcsas3.mc_hdf import KVBuffer, ResultIndex, loadKV, loadKVPairs, storeKVPairs
 
+from .mc_cluster import McClusterPool, formatAddress
 from .mc_core import McCore
+from .mc_cpu import (
+    allowedCpus,
+    cpuLayout,
+    effectiveCpuCount,
+    initWorker,
+    scopedThreadLimits,
+)
 from .mc_model import McModel
 from .mc_opt import McOpt
-
-STORE_LOCK = None
-
-
-def initStoreLock(lock):
-    global STORE_LOCK
-    STORE_LOCK = lock
+from .mc_progress import McProgress
+from .mc_shared import SharedMeasData
 
 
 # TODO: use attrs to @define a mchatataclass
@@ -36,12 +47,31 @@ class McHat:
     nCores = 0  # number of cores to use for parallelization,
     # 0: autodetect, 1: without multiprocessing
     nRep = 10  # number of independent repetitions to opitimize
+    nSpare = 0  # number of additional repetitions to start, the first nRep to finish are kept
+    threadsPerWorker = 1  # limit of the BLAS/OpenMP threads per worker process, 0: no limit
+    pinWorkers = False  # pin every worker process to a single CPU
+    cpuLayout = None  # dict describing the CPU budget and the workers used, see mc_cpu.cpuLayout
+    executor = "processes"  # run parallel repetitions in "processes" or in "threads"
 
     storeKeys = [  # keys to store in an output file
         "nCores",
         "nRep",
+        "nSpare",
+        "threadsPerWorker",
+        "pinWorkers",
+        "cpuLayout",
+        "executor",
+    ]
+    loadKeys = [  # keys to load from a previous run
+        "nCores",
+        "nRep",
+    ]
+    optionalLoadKeys = [  # also loaded if available, not present in files from older versions
+        "nSpare",
+        "threadsPerWorker",
+        "pinWorkers",
+        "executor",
     ]
-    loadKeys = storeKeys
 
     def __init__(
         self, loadFromFile: Optional[Path] = None, resultIndex: int = 1, **kwargs: dict
@@ -57,6 +87,11 @@ class McHat:
         self.nCores = 0  # number of cores to use for parallelization,
         # 0: autodetect, 1: without multiprocessing
         self.nRep = 10  # number of independent repetitions to opitimize
+        self.nSpare = 0  # number of additional repetitions to start, the first nRep are kept
+        self.threadsPerWorker = 1  # limit of the BLAS/OpenMP threads per worker, 0: no limit
+        self.pinWorkers = False  # pin every worker process to a single CPU
+        self.cpuLayout = None  # dict describing the CPU budget and the workers used
+        self.executor = "processes"  # run parallel repetitions in "processes" or in "threads"
 
         """kwargs accepts all parameters from McModel and McOpt."""
         # make sure we store and read from the right place.
@@ -76,6 +111,11 @@ class McHat:
             assert key in self.storeKeys, "Key {} is not a valid option".format(key)
             setattr(self, key, value)
         assert self.nRep > 0, "Must optimize for at least one repetition"
+        assert self.nSpare >= 0, "The number of spare repetitions cannot be negative"
+        assert self.executor in [
+            "processes",
+            "threads",
+        ], "executor must be processes or threads, run on a McHatPool for other executors"
 
     def fillFitParameterLimits(self, measData: dict) -> None:
         for key, val in self._modelArgs["fitParameterLimits"].items():
@@ -93,40 +133,182 @@ class McHat:
                     np.pi / np.min(measData["Q"]),
                 ]
 
-    def run(self, measData: dict, filename: Path, resultIndex: int = 1) -> None:
+    def tabulateModel(self, measData: dict) -> None:
+        """builds the model interpolation table for this data, and adds it to the model settings
+        so that the repetitions (also in other processes) do not need to rebuild it"""
+        model = McModel(**self._modelArgs)
+        model.func.info.parameters.defaults.update(model.staticParameters)
+        model.kernel = model.func.make_kernel(measData["Q"])
+        model.tabulateIV(measData["Q"])
+        try:
+            model.kernel.release()
+        except AttributeError:
+            pass  # can happen with a simulation model
+        self._modelArgs["ivTable"] = model.ivTable
+        print(
+            "Tabulated model with {} points, relative interpolation error {:.2e}".format(
+                len(model.ivTable["grid"]), model.ivTable["error"]
+            )
+        )
+
+    def run(
+        self,
+        measData: dict,
+        filename: Path,
+        resultIndex: int = 1,
+        pool: Optional["McHatPool"] = None,
+    ) -> None:
         """runs the full sequence: multiple repetitions of optimizations, to be parallelized.
-        This probably needs to be taken out of core, and into a new parent"""
+        This probably needs to be taken out of core, and into a new parent.
+        With nSpare, nRep + nSpare repetitions are started, the run completes when the first nRep
+        have finished, the others are cancelled, see McHatJob.
+        The repetitions run on the given McHatPool if any (e.g. with workers on several machines),
+        otherwise as set up by nCores and executor."""
+
+        if pool is not None:
+            pool.submit(self, measData, filename, resultIndex=resultIndex)
+            for output in filter(None, pool.wait()):
+                print(output)
+            return
+        self.prepare(measData)
+        self.runRepetitions(
+            measData,
+            filename,
+            range(self.nRep + self.nSpare),
+            resultIndex=resultIndex,
+            nNeeded=self.nRep,
+        )
 
+    def prepare(self, measData: dict) -> None:
+        """completes the model settings for this data, before running the repetitions"""
+        if ("seed" in self._modelArgs) and (self._modelArgs["seed"] is None):
+            # a fresh seed for this run, recorded with every repetition to reproduce it:
+            self._modelArgs["seed"] = int(np.random.default_rng().integers(2**63))
         # ensure the fit parameter limits are filled in based on the data limits if auto
-        self.fillFitParameterLimits(measData)
+        if "fitParameterLimits" in self._modelArgs:
+            self.fillFitParameterLimits(measData)
+        if self._modelArgs.get("tabulate", False):
+            # build the interpolation table once, to be shared by all repetitions
+            self.tabulateModel(measData)
 
-        if (self.nCores == 1) or (self.nRep == 1):
-            for rep in range(self.nRep):
-                self.runOnce(measData, filename, rep, resultIndex=resultIndex)
+    def resume(self, measData: dict, filename: Path, resultIndex: int = 1) -> None:
+        """continues an interrupted run stored in filename: repetitions with a checkpoint of an
+        unfinished optimization continue from there, repetitions that have not been stored at all
+        are started anew. For the latter, the McHat should be set up as for the original run"""
+        if ("seed" in self._modelArgs) and (self._modelArgs["seed"] is None):
+            # the seed drawn for the original run, for the streams of the repetitions to start:
+            self._modelArgs["seed"] = self.storedSeed(filename)
+        self.prepare(measData)
+        cancelled = loadKV(
+            filename, self.resultIndex.nxsEntryPoint / "optimization" / "cancelledRepetitions"
+        )
+        cancelled = [] if cancelled is None else np.atleast_1d(cancelled).tolist()
+        resumeReps, newReps, nFinished = [], [], 0
+        for rep in range(self.nRep + self.nSpare):
+            finished = self.storedFinished(filename, rep)
+            if rep in cancelled:
+                continue
+            elif finished is None:
+                newReps += [rep]
+            elif finished:
+                nFinished += 1
+            else:
+                resumeReps += [rep]
+        nNeeded = self.nRep - nFinished
+        if nNeeded <= 0:
+            return
+        print("Resuming repetitions {}, starting repetitions {}".format(resumeReps, newReps))
+        if len(newReps) > 0:
+            assert "fitParameterLimits" in self._modelArgs, (
+                "The model settings of the original run must be provided to start the repetitions"
+                " that have not been stored yet"
+            )
+        self.runRepetitions(
+            measData,
+            filename,
+            sorted(resumeReps + newReps),
+            resultIndex=resultIndex,
+            resume=True,
+            nNeeded=nNeeded,
+        )
+
+    def storedFinished(self, filename: Path, repetition: int) -> Optional[bool]:
+        """whether the optimization of a repetition stored in filename has finished, None if it
+        has not been stored. Files from older versions only contain finished optimizations."""
+        path = self.resultIndex.nxsEntryPoint / "optimization" / f"repetition{repetition}"
+        if loadKV(filename, path / "step", default=None) is None:
+            return None
+        return bool(loadKV(filename, path / "finished", default=True))
+
+    def storedSeed(self, filename: Path) -> Optional[int]:
+        """the random seed of the run stored in filename, None if no repetition has been stored"""
+        path = self.resultIndex.nxsEntryPoint / "model"
+        for rep in range(self.nRep + self.nSpare):
+            seed = loadKV(filename, path / f"repetition{rep}" / "seed", default=None)
+            if seed is not None:
+                return int(seed)
+        return None
+
+    def runRepetitions(
+        self,
+        measData: dict,
+        filename: Path,
+        repetitions: list,
+        resultIndex: int = 1,
+        resume: bool = False,
+        nNeeded: Optional[int] = None,
+    ) -> None:
+        """runs the optimization of the given repetitions, in parallel if set up. With resume,
+        repetitions with a stored checkpoint continue from there. With nNeeded, only the first
+        nNeeded repetitions to finish are kept, the others are cancelled"""
+        if (nNeeded is not None) and (self.nCores == 1):
+            # without parallel processing, the first nNeeded are the first to finish:
+            repetitions = list(repetitions)[:nNeeded]
+        if len(repetitions) == 0:
+            return
+        if (self.nCores == 1) or (len(repetitions) == 1):
+            # the threads of the native libraries are not limited in this process:
+            self.cpuLayout = cpuLayout(1, 0, False)
+            for rep in repetitions:
+                resumeFrom = None
+                if resume and (self.storedFinished(filename, rep) is False):
+                    resumeFrom = self.storedRepetition(filename, rep)
+                self.runOnce(
+                    measData, filename, rep, resultIndex=resultIndex, resumeFrom=resumeFrom
+                )
         # elif self.nCores == 2:
         #     print([(measData, filename, r) for r in range(self.nRep)])
         else:
-            import multiprocessing
-
             if self.nCores == 0:
-                # don't run more processes than we need...
-                self.nCores = np.minimum(multiprocessing.cpu_count(), self.nRep)
+                # don't run more processes than we need, nor than the CPUs we may use...
+                self.nCores = int(np.minimum(effectiveCpuCount(), len(repetitions)))
             start = time.time()
-            lock = multiprocessing.Lock()
-            pool = multiprocessing.Pool(self.nCores, initializer=initStoreLock, initargs=(lock,))
-            runArgs = [(measData, filename, r, True, resultIndex) for r in range(self.nRep)]
-            outputs = pool.starmap(self.runOnce, runArgs)
-            pool.close()
-            pool.join()
+            with McHatPool(
+                nCores=self.nCores,
+                threadsPerWorker=self.threadsPerWorker,
+                pinWorkers=self.pinWorkers,
+                executor=self.executor,
+            ) as pool:
+                pool.submitRepetitions(
+                    self,
+                    measData,
+                    filename,
+                    repetitions,
+                    resultIndex=resultIndex,
+                    resume=resume,
+                    nNeeded=nNeeded,
+                )
+                outputs = pool.wait()
             print(
                 "McSAS analysis with {} repetitions took {:.1f}s with {} threads.".format(
-                    self.nRep, time.time() - start, min(self.nCores, self.nRep)
+                    len(repetitions), time.time() - start, min(self.nCores, len(repetitions))
                 )
             )
             # for args in runArgs:
             #    buf = args[-1]
             #    print(buf, buf.getvalue()) # last argument is stdio buffer
-            for output in sorted(outputs, key=lambda x: x[0]):
+            # buffered output of the worker processes, threads have printed theirs already:
+            for output in sorted(filter(None, outputs), key=lambda x: x[0]):
                 print(output)
 
     def runOnce(
@@ -136,21 +318,55 @@ class McHat:
         repetition: int = 0,
         bufferStdIO: bool = False,
         resultIndex: int = 1,
+        resumeFrom: Optional[BytesIO] = None,
+        resultQueue: Optional[queue.Queue] = None,
+        cancelEvent: Optional[threading.Event] = None,
+        progressQueue: Optional[queue.Queue] = None,
     ) -> None:
         """runs the full sequence: multiple repetitions of optimizations, to be parallelized.
-        This probably needs to be taken out of core, and into a new parent"""
+        This probably needs to be taken out of core, and into a new parent.
+        With resumeFrom, the repetition continues from the checkpoint stored therein, see
+        storedRepetition. With resultQueue, the results are sent there instead of being stored
+        in filename directly, see collectResults. When cancelEvent is set, the optimization
+        stops, and its results are not stored. With progressQueue, the progress events of the
+        optimization are sent there (see McProgress) instead of being printed."""
         if bufferStdIO:
             # buffer stdout/err in an individual StringIO object for each repetition
             sys.stderr = sys.stdout = StringIO()
+        if (cancelEvent is not None) and cancelEvent.is_set():
+            # cancelled before it was started
+            print("Repetition {} cancelled".format(repetition))
+            return sys.stdout.getvalue() if bufferStdIO else None
+        if isinstance(measData, SharedMeasData):
+            measData = measData.measData  # zero-copy views of the data in shared memory
+        resume = resumeFrom is not None
+        if resume:
+            # stored state, updated with the settings of this instance:
+            self._opt = McOpt(
+                loadFromFile=resumeFrom, loadFromRepetition=repetition, **self._optArgs
+            )
+            self._model = McModel(
+                loadFromFile=resumeFrom, loadFromRepetition=repetition, **self._modelArgs
+            )
         if self._opt is None:
             self._opt = McOpt(**self._optArgs)
-        if self._model is None:
-            self._model = McModel(**self._modelArgs)
+        if not resume:
+            # a new model, with the random stream of this repetition spawned from the seed of the
+            # run, for the same result wherever (and after whichever) it runs:
+            self._model = McModel(**dict(self._modelArgs, spawnKey=repetition))
 
         self._opt.repetition = repetition
-        self._model.resetParameterSet()
-        mc = McCore(measData, model=self._model, opt=self._opt, resultIndex=resultIndex)
-        mc.optimize()
+        mc = McCore(
+            measData, model=self._model, opt=self._opt, resultIndex=resultIndex, resume=resume
+        )
+        progress = None
+        if progressQueue is not None:
+            progress = functools.partial(sendProgress, progressQueue, filename)
+        mc.optimize(
+            checkpoint=lambda: self.storeResults(mc, filename, resultQueue),
+            cancel=None if cancelEvent is None else cancelEvent.is_set,
+            progress=progress,
+        )
         try:
             self._model.kernel.release()
         except AttributeError:
@@ -159,23 +375,53 @@ class McHat:
             print(f"{mc}: {e}: {str(e)}\n")
         print("Final chiSqr: {}, N accepted: {}".format(self._opt.gof, self._opt.accepted))
 
-        # storing the results
-        if STORE_LOCK is not None:
-            # prevent multiple threads writing HDF5 file simultaneously
-            STORE_LOCK.acquire()
-        try:
-            mc.store(filename=filename)
-            self.store(filename=filename)
-        except Exception as e:
-            print(f"{mc}: {e}: {str(e)}\n")
-        finally:
-            if STORE_LOCK is not None:
-                STORE_LOCK.release()
+        # storing the results, unless cancelled
+        if self._opt.finished:
+            self.storeResults(mc, filename, resultQueue)
 
         if bufferStdIO:  # return buffered output if desired
             return sys.stdout.getvalue()
         return
 
+    def storeResults(
+        self, mc: McCore, filename: Path, resultQueue: Optional[queue.Queue] = None
+    ) -> None:
+        """stores the (running or final) state of a single repetition, and the settings.
+        With a resultQueue, the key-value pairs to store are collected and sent there instead,
+        together with their HDF5 root, the repetition and whether its optimization has finished."""
+        try:
+            target = filename if resultQueue is None else KVBuffer()
+            mc.store(filename=target)
+            self.store(filename=target)
+            if resultQueue is not None:
+                resultQueue.put(
+                    (
+                        filename,
+                        str(self.resultIndex.nxsEntryPoint),
+                        target.pairs,
+                        self._opt.repetition,
+                        self._opt.finished,
+                    )
+                )
+        except Exception as e:
+            print(f"{mc}: {e}: {str(e)}\n")
+
+    def storedRepetition(self, filename: Path, repetition: int) -> BytesIO:
+        """in-memory HDF5 copy of the stored model and optimization state of a single repetition,
+        to resume from without accessing the result file, which is being written to meanwhile"""
+        stored = BytesIO()
+        root = self.resultIndex.nxsEntryPoint
+        with h5py.File(filename, "r") as h5f, h5py.File(stored, "w") as h5c:
+            for key, item in h5f[str(root / "model")].items():
+                # model settings, and the parameters of this repetition only:
+                if (not key.startswith("repetition")) or (key == f"repetition{repetition}"):
+                    h5c.require_group(str(root / "model")).copy(item, key)
+            key = f"repetition{repetition}"
+            h5c.require_group(str(root / "optimization")).copy(
+                h5f[str(root / "optimization" / key)], key
+            )
+        return stored
+
     # same as in McOpt
     def store(self, filename: Path, path: Optional[PurePosixPath] = None) -> None:
         """stores the settings in an output file (HDF5)"""
@@ -189,3 +435,415 @@ class McHat:
             path = self.resultIndex.nxsEntryPoint / "optimization"
         for key, value in loadKVPairs(filename, path, self.loadKeys):
             setattr(self, key, value)
+        for key in self.optionalLoadKeys:
+            value = loadKV(filename, path / key, default=None)
+            if value is not None:
+                setattr(self, key, value)
+
+
+class McHatJob:
+    """
+    Bookkeeping of speculatively started repetitions of a single McHat run: only the first nNeeded
+    repetitions to finish are kept. Once these have finished, cancelEvent is set to stop the
+    others, their results are no longer stored, and record removes their stored checkpoints.
+    """
+
+    filename = None  # result file of the run
+    root = None  # HDF5 root path of the results
+    repetitions = None  # list of the started repetitions
+    nNeeded = None  # number of repetitions to keep
+    cancelEvent = None  # Event to signal the remaining repetitions to stop
+    finished = None  # list of the finished repetitions, in the order they finished
+
+    def __init__(
+        self,
+        filename: Path,
+        root: PurePosixPath,
+        repetitions: list,
+        nNeeded: int,
+        cancelEvent: threading.Event,
+    ) -> None:
+        self.filename = Path(filename)
+        self.root = root
+        self.repetitions = list(repetitions)
+        self.nNeeded = nNeeded
+        self.cancelEvent = cancelEvent
+        self.finished = []
+
+    @property
+    def cancelled(self) -> list:
+        """the repetitions that were (or are being) cancelled"""
+        if len(self.finished) < self.nNeeded:
+            return []
+        return [rep for rep in self.repetitions if rep not in self.finished]
+
+    def matches(self, filename: Path, root: str, repetition: int) -> bool:
+        return (
+            (Path(filename) == self.filename)
+            and (PurePosixPath(root) == self.root)
+            and (repetition in self.repetitions)
+        )
+
+    def accept(self, repetition: int, finished: bool) -> bool:
+        """whether to store the results of a repetition, keeps track of the finished ones"""
+        if len(self.finished) >= self.nNeeded:
+            return False  # done, the remaining repetitions are cancelled
+        if finished and (repetition in self.finished):
+            return False  # also run by another worker, e.g. a requeued task of the cluster
+        if finished:
+            self.finished += [repetition]
+            if len(self.finished) >= self.nNeeded:
+                self.cancelEvent.set()
+        return True
+
+    def record(self) -> None:
+        """removes any stored checkpoints of the cancelled repetitions from the result file, and
+        adds them to the list of cancelled repetitions in there"""
+        if len(self.cancelled) == 0:
+            return
+        path = self.root / "optimization" / "cancelledRepetitions"
+        previous = loadKV(self.filename, path, default=[])
+        with h5py.File(self.filename, "a") as h5f:
+            for rep in self.cancelled:
+                for group in ("model", "optimization"):
+                    if str(self.root / group / f"repetition{rep}") in h5f:
+                        del h5f[str(self.root / group / f"repetition{rep}")]
+        storeKVPairs(
+            self.filename,
+            path.parent,
+            [("cancelledRepetitions", sorted(np.atleast_1d(previous).tolist() + self.cancelled))],
+        )
+        print(
+            "Kept repetitions {}, cancelled repetitions {}".format(
+                sorted(self.finished), self.cancelled
+            )
+        )
+
+
+def collectResults(
+    resultQueue: queue.Queue,
+    asyncResults: list,
+    jobs: list = (),
+    progressQueue: Optional[queue.Queue] = None,
+    progress: Optional[McProgress] = None,
+    timeout: Optional[float] = None,
+) -> None:
+    """stores the (filename, HDF5 root, key-value pairs, repetition, finished) results sent by the
+    workers as they arrive, until all workers are done. As the only process writing the result
+    files, no locking is needed. The results of repetitions cancelled by one of the McHatJobs are
+    skipped, as are any results of a repetition after its final ones (a repetition may run twice
+    on the cluster, when the task of an agent that seemed lost is queued again).
+    Meanwhile, the events on the progressQueue are passed on to progress. Raises a
+    multiprocessing.TimeoutError if the workers are not done within timeout seconds."""
+    deadline = None if timeout is None else time.time() + timeout
+    finishedRepetitions = set()  # (filename, root, repetition) of the finished repetitions
+    while not (all(result.ready() for result in asyncResults) and resultQueue.empty()):
+        if (deadline is not None) and (time.time() > deadline):
+            nRunning = sum(not result.ready() for result in asyncResults)
+            raise multiprocessing.TimeoutError(
+                "{} repetitions did not finish within {} s".format(nRunning, timeout)
+            )
+        collectProgress(progressQueue, progress)
+        try:
+            filename, root, pairs, repetition, finished = resultQueue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        key = (Path(filename), root, repetition)
+        if key in finishedRepetitions:
+            continue
+        job = next((job for job in jobs if job.matches(filename, root, repetition)), None)
+        if (job is not None) and not job.accept(repetition, finished):
+            continue
+        if finished:
+            finishedRepetitions.add(key)
+        try:
+            storeKVPairs(filename, PurePosixPath("/"), pairs)
+        except Exception as e:
+            print(f"{filename}: {e}: {str(e)}\n")
+    collectProgress(progressQueue, progress)
+
+
+def runOnceInThread(hat: McHat, *args) -> Optional[str]:
+    """runs a repetition (see McHat.runOnce) in a worker thread, on a copy of the McHat, as the
+    optimization state of a repetition cannot be shared with others running at the same time"""
+    hat = copy.copy(hat)
+    hat._opt, hat._model = None, None
+    return hat.runOnce(*args)
+
+
+def sendProgress(progressQueue: queue.Queue, filename: Path, event: dict) -> None:
+    """sends a progress event of an optimization of a worker to the parent"""
+    progressQueue.put(dict(event, filename=str(filename)))
+
+
+def collectProgress(progressQueue: Optional[queue.Queue], progress: Optional[McProgress]) -> None:
+    """passes on the progress events waiting in the queue"""
+    while progressQueue is not None:
+        try:
+            event = progressQueue.get_nowait()
+        except queue.Empty:
+            return
+        if progress is not None:
+            progress.update(event)
+
+
+class McHatPool:
+    """
+    A persistent pool of worker processes for running the repetitions of many McHat jobs, e.g.
+    for processing a large number of datasets in batch. The workers stay warm between jobs,
+    so the start-up of the processes and the loading of the models is not repeated for every
+    dataset, and the repetitions of all submitted jobs are scheduled across all cores.
+    The results are stored by this (parent) process as they arrive, see collectResults.
+    With shareMeasData, the measurement data arrays are passed to the workers in shared memory,
+    instead of being pickled for every repetition. The progress of the running optimizations is
+    shown in a live status line with showProgress, and logged to the JSON-lines file progressLog
+    if set, see McProgress. With nCores = 0, a worker is started for every CPU this process may
+    use, according to its affinity and the CPU quota of its control group (container). The BLAS
+    and OpenMP threads per worker are limited to threadsPerWorker, and with pinWorkers, every
+    worker runs on its own CPU. This layout is recorded with the results, see mc_cpu.cpuLayout.
+
+    With executor = "threads", the repetitions run in a pool of threads of this process instead,
+    which avoids starting processes and copying the data to them. Every repetition has its own
+    model instance, kernel and random generator, the loaded SasModels model is shared. This
+    only runs in parallel where the GIL is released, i.e. in the compiled (DLL) kernels of
+    SasModels, and pays off for models and data that are expensive to calculate. The threads
+    cannot be pinned, and the BLAS and OpenMP threads of this process are limited (with
+    threadpoolctl, if installed) only until the pool is closed.
+
+    With executor = "cluster", the repetitions are distributed to worker agents, which may run
+    on several machines (see mc_cluster.runAgent and the mcsas3-worker command). They connect to
+    the job server started by this pool at address, (host, port) or the path of a Unix socket,
+    using authkey. The results are stored by this process, as for the other executors. The
+    repetitions of agents that stop sending heartbeats are run by the others, see McTaskBoard.
+
+    Whichever the executor, every repetition draws its own random stream, spawned from the seed
+    of the run (see McModel.spawnKey), so that the results do not depend on which worker runs
+    which repetition, and match those of a serial run with the same seed.
+
+    Usage example:
+
+        with McHatPool(nCores=8) as pool:
+            for measData, filename in datasets:
+                pool.submit(McHat(**optDict), measData, filename)
+            outputs = pool.wait()
+    """
+
+    executors = ["processes", "threads", "cluster"]  # available kinds of workers
+    nCores = 0  # number of worker processes, 0: autodetect
+    executor = "processes"  # kind of workers, one of executors
+    shareMeasData = True  # pass the measurement data arrays to the workers in shared memory
+    _pool = None  # multiprocessing Pool instance
+    _manager = None  # multiprocessing Manager, hosting the result queue
+    _resultQueue = None  # queue of (filename, key-value pairs) sent by the workers
+    _pending = None  # list of AsyncResults of the submitted repetitions
+    _shared = None  # list of SharedMeasData of the submitted repetitions, released after wait
+    _jobs = None  # list of McHatJobs of the submitted speculative runs
+    _progressQueue = None  # queue of progress events sent by the workers
+    _progress = None  # McProgress instance, aggregating the progress events
+    threadsPerWorker = 1  # limit of the BLAS/OpenMP threads per worker process, 0: no limit
+    pinWorkers = False  # pin every worker process to a single CPU
+    _threadLimits = None  # threadpoolctl limits of this process while the threads run
+    layout = None  # dict describing the CPU budget and the workers, see mc_cpu.cpuLayout
+
+    def __init__(
+        self,
+        nCores: int = 0,
+        shareMeasData: bool = True,
+        showProgress: bool = True,
+        progressLog: Optional[Path] = None,
+        threadsPerWorker: int = 1,
+        pinWorkers: bool = False,
+        executor: str = "processes",
+        address: Optional[Union[tuple, str]] = None,
+        authkey: Optional[bytes] = None,
+    ) -> None:
+        assert executor in self.executors, "executor must be one of {}".format(self.executors)
+        self.executor = executor
+        self.nCores = nCores if nCores > 0 else effectiveCpuCount()
+        self.threadsPerWorker = threadsPerWorker
+        self.pinWorkers = pinWorkers
+        self._threadLimits = None
+        assert (not pinWorkers) or hasattr(
+            os, "sched_setaffinity"
+        ), "Pinning workers to CPUs is not supported on this platform"
+        assert (not pinWorkers) or (
+            executor != "threads"
+        ), "Only worker processes can be pinned to CPUs, not the threads of this process"
+        if self.nCores > effectiveCpuCount():
+            print(
+                "Note: {} workers for {} available CPUs, the CPUs are oversubscribed".format(
+                    self.nCores, effectiveCpuCount()
+                )
+            )
+        self.layout = cpuLayout(self.nCores, threadsPerWorker, pinWorkers)
+        if executor == "cluster":
+            assert (address is not None) and (
+                authkey is not None
+            ), "the cluster executor needs the address and authkey for the agents to connect"
+        # threads access the data directly:
+        self.shareMeasData = shareMeasData and (executor == "processes")
+        self._shared = []
+        self._jobs = []
+        if self.shareMeasData and (os.name == "posix"):
+            # the workers should use the resource tracker of this process, which tracks the
+            # shared memory blocks. Otherwise, each worker starts its own tracker, which would
+            # remove the blocks when the worker exits.
+            multiprocessing.resource_tracker.ensure_running()
+        self._progress = McProgress(
+            logFile=progressLog, statusStream=sys.stderr if showProgress else None
+        )
+        self._pending = []
+        if executor == "cluster":
+            self._pool = McClusterPool(address, authkey)
+            self._manager = self._pool.server  # hosts the queues and events for the agents
+            self._resultQueue = self._manager.Queue()
+            self._progressQueue = self._manager.Queue()
+            # the CPU layout is up to the agents:
+            self.layout = {"address": formatAddress(self._pool.address)}
+            print("Job server for worker agents at {}".format(self.layout["address"]))
+            return
+        if executor == "threads":
+            self._resultQueue, self._progressQueue = queue.Queue(), queue.Queue()
+            # no initializer, it would run in this process and limit its threads and environment
+            # for good. The native libraries are limited only until the pool is closed instead:
+            self._threadLimits = scopedThreadLimits(threadsPerWorker)
+            self._pool = multiprocessing.pool.ThreadPool(self.nCores)
+            return
+        self._manager = multiprocessing.Manager()
+        self._resultQueue = self._manager.Queue()
+        self._progressQueue = self._manager.Queue()
+        self._pool = multiprocessing.Pool(
+            self.nCores,
+            initializer=initWorker,
+            initargs=(
+                multiprocessing.Value("i", 0),  # counts the workers, to assign their CPUs
+                allowedCpus() if pinWorkers else None,
+                threadsPerWorker,
+            ),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, *args) -> None:
+        # after an error (e.g. a timeout of wait), the running repetitions are not waited for:
+        self.close(wait=excType is None)
+
+    def submit(self, hat: McHat, measData: dict, filename: Path, resultIndex: int = 1) -> None:
+        """schedules all repetitions of an optimization of measData, stored in filename"""
+        hat.prepare(measData)
+        self.submitRepetitions(
+            hat,
+            measData,
+            filename,
+            range(hat.nRep + hat.nSpare),
+            resultIndex=resultIndex,
+            nNeeded=hat.nRep,
+        )
+
+    def submitRepetitions(
+        self,
+        hat: McHat,
+        measData: dict,
+        filename: Path,
+        repetitions: list,
+        resultIndex: int = 1,
+        resume: bool = False,
+        nNeeded: Optional[int] = None,
+    ) -> None:
+        """schedules the given repetitions of a prepared McHat. With resume, repetitions with a
+        stored checkpoint continue from there. With nNeeded, only the first nNeeded repetitions
+        to finish are kept, the others are cancelled, see McHatJob"""
+        hat.cpuLayout = self.layout  # recorded with the results
+        if self.shareMeasData and isinstance(measData, dict):
+            measData = SharedMeasData(measData)  # copied once, for all repetitions
+            self._shared += [measData]
+        cancelEvent = None
+        if (nNeeded is not None) and (nNeeded < len(repetitions)):
+            cancelEvent = threading.Event() if self._manager is None else self._manager.Event()
+            self._jobs += [
+                McHatJob(
+                    filename,
+                    ResultIndex(resultIndex).nxsEntryPoint,
+                    repetitions,
+                    nNeeded,
+                    cancelEvent,
+                )
+            ]
+        for r in repetitions:
+            resumeFrom = None
+            if resume and (hat.storedFinished(filename, r) is False):
+                resumeFrom = hat.storedRepetition(filename, r)
+            threads = self.executor == "threads"
+            self._pending += [
+                self._pool.apply_async(
+                    functools.partial(runOnceInThread, hat) if threads else hat.runOnce,
+                    (
+                        measData,
+                        filename,
+                        r,
+                        not threads,  # stdout cannot be buffered per thread
+                        resultIndex,
+                        resumeFrom,
+                        self._resultQueue,
+                        cancelEvent,
+                        self._progressQueue,
+                    ),
+                )
+            ]
+
+    def wait(self, timeout: Optional[float] = None) -> list:
+        """stores the results until all submitted repetitions are done, returns their outputs
+        in the order of submission. Raises a multiprocessing.TimeoutError if they are not done
+        within timeout seconds (None: waits as long as it takes), after which wait can be called
+        again, or the pool closed without waiting"""
+        try:
+            collectResults(
+                self._resultQueue,
+                self._pending,
+                self._jobs,
+                self._progressQueue,
+                self._progress,
+                timeout=timeout,
+            )
+        except multiprocessing.TimeoutError as e:
+            if self.executor == "cluster":
+                raise multiprocessing.TimeoutError(
+                    "{}, with {} worker agents connected to {}".format(
+                        e, self._pool.nAgents(), self.layout["address"]
+                    )
+                ) from None
+            raise
+        self._progress.close()
+        try:
+            outputs = [result.get() for result in self._pending]
+            for job in self._jobs:
+                job.record()
+        finally:
+            self._pending, self._jobs = [], []
+            for shared in self._shared:
+                shared.unlink()
+            self._shared = []
+        return outputs
+
+    def close(self, wait: bool = True) -> None:
+        """waits for the submitted repetitions and shuts down the workers. Without wait, the
+        repetitions that have not finished are abandoned"""
+        if self._pool is None:
+            return
+        if wait:
+            self.wait()
+            self._pool.close()
+        else:
+            self._pool.terminate()
+            self._progress.close()
+            for shared in self._shared:
+                shared.unlink()
+            self._pending, self._jobs, self._shared = [], [], []
+        self._pool.join()
+        if self._manager is not None:
+            self._manager.shutdown()
+        if self._threadLimits is not None:
+            self._threadLimits.restore_original_limits()
+            self._threadLimits = None
+        self._pool = None
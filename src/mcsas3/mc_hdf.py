@@ -91,12 +91,40 @@ def loadKV(filename: Path, path: PurePosixPath, datatype=None, default=None, dbg
     return value
 
 
+class KVBuffer(object):
+    """
+    Collects the key-value pairs to store in memory, instead of writing them to a file directly.
+    Can be passed as filename to storeKVPairs and storeKV (and the store methods using them), e.g.
+    to send the results of a worker process to a single writer, which stores the collected pairs
+    in one file session using write.
+    """
+
+    def __init__(self) -> None:
+        self.pairs = []  # list of (absolute path, value) pairs, in the order they were stored
+
+    def append(self, path: PurePosixPath, value) -> None:
+        if isinstance(value, (list, tuple)):
+            value = np.array(value)  # as it would be stored, compact for transport
+        self.pairs.append((path, value))
+
+    def write(self, filename: Path) -> None:
+        """stores the collected pairs in an HDF5 file, opened only once"""
+        storeKVPairs(filename, PurePosixPath("/"), self.pairs)
+
+
 def storeKVPairs(filename: Path, path: PurePosixPath, pairs: Iterable) -> None:
+    """stores key-value pairs below path, in a single file session"""
     assert filename is not None
     assert path is not None
-    try:
+    if isinstance(filename, KVBuffer):
         for key, value in pairs:
             storeKV(filename=filename, path=path / key, value=value)
+        return
+    key, value = None, None
+    try:
+        with h5py.File(filename, "a") as h5f:
+            for key, value in pairs:
+                storeKVInFile(h5f, path=path / key, value=value)
     except Exception:
         print(f"Error for path {key} and value '{value}' of type {type(value)}.")
         raise
@@ -106,38 +134,54 @@ def storeKV(filename: Path, path: PurePosixPath, value=None) -> None:
     assert filename is not None, "filename (output filename) cannot be empty"
     assert path is not None, "HDF5 path cannot be empty"
 
-    if isinstance(value, (dict, pandas.DataFrame)):
-        storeKVPairs(filename, path, value.items())
+    if isinstance(filename, KVBuffer):
+        if isinstance(value, (dict, pandas.DataFrame)):
+            for key, subValue in value.items():
+                storeKV(filename, path / key, subValue)
+        else:
+            filename.append(path, value)
         return
 
-    path, key = path.parent, path.name
     with h5py.File(filename, "a") as h5f:
-        h5g = h5f.require_group(str(path))
-        dset, unit = None, None
-        if isinstance(value, pint.Quantity):
-            value, unit = value.m, value.u
-        if isinstance(value, Path):
-            value = value.as_posix()
-        if isinstance(value, pandas.Timestamp):
-            value = value.timestamp()
-        if isinstance(value, (list, tuple)):
-            value = np.array(value)
-        if isinstance(value, (np.ndarray, pandas.Series)):
-            if str(value.dtype).startswith("<U") or str(value.dtype).startswith("object"):
-                value = value.astype(h5py.special_dtype(vlen=str))
-
-            try:
-                dset = h5g.require_dataset(key, data=value, shape=value.shape, dtype=value.dtype)
-            except TypeError:
-                del h5g[key]
-                dset = h5g.require_dataset(key, data=value, shape=value.shape, dtype=value.dtype)
-
-        elif value is not None:
-            dset = h5g.get(key, None)
-            if dset is None:
-                dset = h5g.create_dataset(key, data=value)
-            else:
-                dset[()] = value
+        storeKVInFile(h5f, path, value)
 
-        if unit is not None:
-            dset.attrs["unit"] = str(unit)
+
+def storeKVInFile(h5f: h5py.File, path: PurePosixPath, value=None) -> None:
+    """stores a single key-value pair in an HDF5 file that is already open for writing"""
+    if isinstance(value, (dict, pandas.DataFrame)):
+        for key, subValue in value.items():
+            storeKVInFile(h5f, path / key, subValue)
+        return
+
+    path, key = path.parent, path.name
+    h5g = h5f.require_group(str(path))
+    dset, unit = None, None
+    if isinstance(value, pint.Quantity):
+        value, unit = value.m, value.u
+    if isinstance(value, Path):
+        value = value.as_posix()
+    if isinstance(value, pandas.Timestamp):
+        value = value.timestamp()
+    if isinstance(value, (list, tuple)):
+        value = np.array(value)
+    if isinstance(value, (np.ndarray, pandas.Series)):
+        if str(value.dtype).startswith("<U") or str(value.dtype).startswith("object"):
+            value = value.astype(h5py.special_dtype(vlen=str))
+
+        try:
+            dset = h5g.require_dataset(key, data=value, shape=value.shape, dtype=value.dtype)
+            # an existing dataset is returned as-is, make sure it is overwritten:
+            dset[()] = value
+        except TypeError:
+            del h5g[key]
+            dset = h5g.require_dataset(key, data=value, shape=value.shape, dtype=value.dtype)
+
+    elif value is not None:
+        dset = h5g.get(key, None)
+        if dset is None:
+            dset = h5g.create_dataset(key, data=value)
+        else:
+            dset[()] = value
+
+    if unit is not None:
+        dset.attrs["unit"] = str(unit)
@@ -1,3 +1,6 @@
+import json
+import logging
+import threading
 from pathlib import Path
 from typing import List, Optional, Tuple
 
@@ -10,6 +13,13 @@ from scipy import interpolate
 
 from mcsas3.mc_hdf import ResultIndex, loadKV, storeKV, storeKVPairs
 
+# loaded SasModels functions and their default parameters, by (modelName, modelDType), so that
+# long-lived (worker) processes do not need to reload the models for every repetition:
+MODEL_CACHE = {}
+# serializes loading the models and making their kernels, which is not thread-safe in SasModels,
+# for repetitions running in threads (the kernel calls themselves run concurrently):
+MODEL_LOCK = threading.Lock()
+
 
 # TODO: perhaps better defined as a dataclass with attrs
 class sphereParameters(object):
@@ -239,7 +249,11 @@ class McModel:
     staticParameters: dict of parameter-value pairs {"param2": value, ...}
         to keep static during the fit
     seed:
-        random number generator seed, should vary for parallel execution
+        random number generator seed, the same for all repetitions of a run
+    spawnKey:
+        the random stream of this model among those spawned from the seed, e.g. the repetition
+        number, so that parallel repetitions draw independent streams. None: the stream of the
+        seed itself
     nContrib:
         number of individual SasModel contributions
         from which the total model intensity is calculated
@@ -257,9 +271,13 @@ class McModel:
     modelName = "sphere"  # SasModels model name
     modelDType = "fast"  # model data type, choose 'fast' for single precision
     kernel = object  # SasModels kernel pointer
-    parameterSet = None  # pandas dataFrame of length nContrib, with column names of parameters
+    # (nContrib x nFitParameters) array with the parameter values of all contributions,
+    # a pandas dataFrame view is available as parameterSet:
+    parameterArray = None
+    parameterColumns = None  # list of parameter names for the columns of parameterArray
     staticParameters = None  # dictionary of static parameter-value pairs during MC optimization
     pickParameters = None  # dict of values with new random picks, named by parameter names
+    pickParametersBatch = None  # as pickParameters, but with arrays of picks for batched picking
     pickIndex = None  # int showing the running number of the current contribution being tested
     # dict of value pairs (tuples) *for fit parameters only* with lower, upper limits for the
     # random function generator, named by parameter names
@@ -272,8 +290,18 @@ class McModel:
     # generators. This will change in the future to a cleaner, per-parameter config
     logRandom = False
     volumes = None  # array of volumes for each model contribution, calculated during execution
-    seed = 12345  # random generator seed, should vary for parallel execution
+    seed = 12345  # random generator seed, the same for all repetitions of a run
+    spawnKey = None  # index of the random stream spawned from the seed, None: the seed's own
     nContrib = 300  # number of contributions that make up the entire model
+    # BETA: serve picks by interpolation in a precomputed table of intensities and volumes over
+    # the range of the (single) fit parameter, instead of calling the model kernel every time
+    tabulate = False
+    tabulationTolerance = 1e-3  # maximum relative interpolation error, checked on building
+    tabulationPoints = 513  # initial number of table points, refined until the tolerance is met
+    maxTabulationPoints = 2**16 + 1  # refinement stops here to limit the table size
+    ivTable = None  # dict with the table, can be passed on to avoid rebuilding for the same Q
+    # JSON-encoded state of the random generators loaded from a file, to continue from:
+    loadedRandomState = None
 
     settables = [
         "nContrib",  # these are the allowed input arguments, can also be used later for storage
@@ -282,9 +310,65 @@ class McModel:
         "modelName",
         "modelDType",
         "seed",
+        "spawnKey",
         "logRandom",
+        "tabulate",
+        "tabulationTolerance",
+        "tabulationPoints",
+        "ivTable",
     ]
 
+    @property
+    def parameterSet(self) -> pandas.DataFrame:
+        """pandas dataFrame of length nContrib, with column names of parameters. This is a view
+        for storing and histogramming, use contribParameters and setContribParameters otherwise"""
+        if self.parameterArray is None:
+            return None
+        return pandas.DataFrame(data=self.parameterArray, columns=self.parameterColumns)
+
+    @parameterSet.setter
+    def parameterSet(self, parameterSet: Optional[pandas.DataFrame]) -> None:
+        if parameterSet is None:
+            self.parameterArray, self.parameterColumns = None, None
+            return
+        self.parameterColumns = [
+            (colname.decode("utf8") if isinstance(colname, bytes) else str(colname))
+            for colname in parameterSet.columns
+        ]
+        # a writable copy, the dataFrame may only provide a read-only view:
+        self.parameterArray = np.array(parameterSet.to_numpy(dtype=float), order="C")
+
+    def contribParameters(self, contribi: int) -> dict:
+        """returns the parameter-value pairs of a single contribution"""
+        return dict(zip(self.parameterColumns, self.parameterArray[contribi].tolist()))
+
+    def setContribParameters(self, contribi: int, parameters: dict) -> None:
+        """sets the parameter values of a single contribution from parameter-value pairs"""
+        self.parameterArray[contribi] = [parameters[key] for key in self.parameterColumns]
+
+    @property
+    def randomState(self) -> str:
+        """JSON-encoded bit generator states of the random generators, named by parameter names.
+        Setting it continues the random sequence exactly where it was stored"""
+        return json.dumps(
+            {
+                key: generator.__self__.bit_generator.state
+                for key, generator in self.randomGenerators.items()
+            }
+        )
+
+    @randomState.setter
+    def randomState(self, state: str) -> None:
+        for key, generatorState in json.loads(state).items():
+            self.randomGenerators[key].__self__.bit_generator.state = generatorState
+
+    def seedSequence(self) -> np.random.SeedSequence:
+        """the seed sequence of the random generators: the child spawnKey of those spawned from
+        the seed (as by SeedSequence(seed).spawn), so that the stream of a repetition does not
+        depend on the others, nor on where or when it runs"""
+        spawnKey = () if self.spawnKey is None else (int(self.spawnKey),)
+        return np.random.SeedSequence(self.seed, spawn_key=spawnKey)
+
     def fitKeys(self) -> List[str]:
         return [key for key in self.fitParameterLimits.keys()]
 
@@ -311,14 +395,14 @@ class McModel:
         self.modelName = "sphere"  # SasModels model name
         self.modelDType = "fast"  # model data type, choose 'fast' for single precision
         self.kernel = object  # SasModels kernel pointer
-        self.parameterSet = (
-            None  # pandas dataFrame of length nContrib, with column names of parameters
-        )
+        self.parameterArray = None  # array of parameter values of all contributions
+        self.parameterColumns = None  # list of parameter names for the parameterArray columns
         self.staticParameters = (
             None  # dictionary of static parameter-value pairs during MC optimization
         )
         self.pickParameters = None  # dict of values with new random picks,
         # named by parameter names
+        self.pickParametersBatch = None  # as pickParameters, with arrays of picks
         self.pickIndex = (
             None  # int showing the running number of the current contribution being tested
         )
@@ -329,8 +413,14 @@ class McModel:
         self.volumes = (
             None  # array of volumes for each model contribution, calculated during execution
         )
-        self.seed = 12345  # random generator seed, should vary for parallel execution
+        self.seed = 12345  # random generator seed, the same for all repetitions of a run
+        self.spawnKey = None  # index of the random stream spawned from the seed
         self.nContrib = 300  # number of contributions that make up the entire model
+        self.tabulate = False  # serve picks by interpolation in a precomputed table
+        self.tabulationTolerance = 1e-3  # maximum relative interpolation error
+        self.tabulationPoints = 513  # initial number of table points
+        self.ivTable = None  # dict with the table of intensities and volumes
+        self.loadedRandomState = None  # random generator state loaded from a file
 
         # make sure we store and read from the right place.
         self.resultIndex = ResultIndex(resultIndex)  # defines the HDF5 root path
@@ -351,12 +441,15 @@ class McModel:
         if self.randomGenerators is None:
             self.randomGenerators = dict.fromkeys(
                 [key for key in self.fitKeys()],
-                np.random.default_rng(self.seed).uniform,
+                np.random.default_rng(self.seedSequence()).uniform,
             )
             self.logRandoms = dict.fromkeys([key for key in self.fitKeys()], self.logRandom)
+        if self.loadedRandomState is not None:
+            # continue the random sequence of a stored (checkpointed) optimization:
+            self.randomState = self.loadedRandomState
 
-        if self.parameterSet is None:
-            self.parameterSet = pandas.DataFrame(index=range(self.nContrib), columns=self.fitKeys())
+        if self.parameterArray is None:
+            self.parameterColumns = self.fitKeys()
             self.resetParameterSet()
 
         if self.modelName.lower() == "sim":
@@ -370,15 +463,21 @@ class McModel:
 
     def checkSettings(self) -> None:
         for key in self.settables:
-            if key in ("seed",):
+            if key in ("seed", "spawnKey", "ivTable"):
                 continue
             val = getattr(self, key, None)
             assert val is not None, "required McModel setting {} has not been defined..".format(key)
 
         assert self.func is not None, "SasModels function has not been loaded"
-        assert self.parameterSet is not None, "parameterSet has not been initialized"
+        assert self.parameterArray is not None, "parameterSet has not been initialized"
 
     def calcModelIV(self, parameters: dict) -> Tuple[np.ndarray, np.ndarray]:
+        if self.tabulate and (self.ivTable is not None):
+            Int, V = self.interpolateIV(parameters[self.fitKeys()[0]])
+            return Int[0], V[0]
+        return self.calcModelIVDirect(parameters)
+
+    def calcModelIVDirect(self, parameters: dict) -> Tuple[np.ndarray, np.ndarray]:
         # moved from McCore
         kernelParams = dict(self.staticParameters, **parameters)
         if (self.modelName.lower() != "sim") and (self.modelName.lower() != "mcsas_sphere"):
@@ -418,33 +517,125 @@ class McModel:
         # return Fsq / V_shell / (4 / 3 * np.pi), V_shell
         return Fsq / V_shell, V_shell
 
+    def calcModelIVBatch(self, parameters: dict) -> Tuple[np.ndarray, np.ndarray]:
+        """Calculates the intensities (nPicks x nQ) and volumes (nPicks) of a batch of picks,
+        with parameters given as equal-length arrays. The internal sphere and simulation models
+        are evaluated in a single vectorized call, SasModels kernels one pick at a time."""
+        nPicks = len(next(iter(parameters.values())))
+        if self.tabulate and (self.ivTable is not None):
+            return self.interpolateIV(parameters[self.fitKeys()[0]])
+        if self.modelName.lower() in ("sim", "mcsas_sphere"):
+            # column vectors broadcast against the Q vector in the kernel:
+            I, V = self.calcModelIVDirect(
+                {key: np.reshape(val, (-1, 1)) for key, val in parameters.items()}
+            )
+            return (
+                np.broadcast_to(I, (nPicks, np.shape(I)[-1])),
+                np.broadcast_to(np.ravel(V), (nPicks,)),
+            )
+        IV = [
+            self.calcModelIVDirect({key: val[picki] for key, val in parameters.items()})
+            for picki in range(nPicks)
+        ]
+        return np.stack([Int for Int, _ in IV]), np.array([V for _, V in IV], dtype=float)
+
+    def tabulateIV(self, measQ: list) -> None:
+        """Tabulates the intensity and volume over the range of the fit parameter for the given Q,
+        on a logarithmic grid for positive limits, otherwise linear. Interpolation errors are
+        determined at the centres between table points by direct evaluation, and the table is
+        refined until these are below tabulationTolerance, relative to the maximum intensity at
+        each Q.
+        The kernel must be available already. Only one fit parameter is supported."""
+        assert len(self.fitKeys()) == 1, "tabulation is only available for a single fit parameter"
+        Q = np.asarray(measQ)
+        if (self.ivTable is not None) and np.array_equal(self.ivTable["Q"], Q):
+            return  # already tabulated for this Q, e.g. in a previous repetition
+        self.ivTable = None  # make sure we evaluate directly while building
+
+        parName = self.fitKeys()[0]
+        lower, upper = sorted(self.fitParameterLimits[parName])
+        logGrid = lower > 0
+        toGrid = np.log if logGrid else (lambda x: x)
+        fromGrid = np.exp if logGrid else (lambda x: x)
+        grid = np.linspace(toGrid(lower), toGrid(upper), self.tabulationPoints)
+        Int, V = self.calcModelIVBatch({parName: fromGrid(grid)})
+        Int, V = np.array(Int, dtype=float), np.array(V, dtype=float)
+        while True:
+            centres = (grid[:-1] + grid[1:]) / 2
+            IntC, VC = self.calcModelIVBatch({parName: fromGrid(centres)})
+            # relative to the largest intensity at each Q, i.e. the scale relevant for the total:
+            maxI = np.maximum(np.abs(Int).max(axis=0), np.abs(IntC).max(axis=0))
+            error = max(
+                np.max(np.abs((Int[:-1] + Int[1:]) / 2 - IntC) / np.maximum(maxI, 1e-300)),
+                np.max(np.abs((V[:-1] + V[1:]) / 2 - VC) / np.maximum(np.abs(VC), 1e-300)),
+            )
+            if (error <= self.tabulationTolerance) or (
+                2 * len(grid) - 1 > self.maxTabulationPoints
+            ):
+                break
+            # refine by adding the centres, which have been calculated already:
+            grid = np.insert(grid, np.arange(1, len(grid)), centres)
+            Int = np.insert(Int, np.arange(1, len(Int)), IntC, axis=0)
+            V = np.insert(V, np.arange(1, len(V)), VC)
+
+        if error > self.tabulationTolerance:
+            logging.warning(
+                f"tabulated model reached a relative interpolation error of {error:.2e} with"
+                f" {len(grid)} points, above the tolerance of {self.tabulationTolerance:.2e}"
+            )
+        self.ivTable = dict(Q=Q, grid=grid, I=Int, V=V, logGrid=logGrid, error=error)
+
+    def interpolateIV(self, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """linear interpolation of intensities (nValues x nQ) and volumes from the table,
+        for (an array of) fit parameter values"""
+        values = np.atleast_1d(values)
+        grid = self.ivTable["grid"]
+        x = (np.log(values) if self.ivTable["logGrid"] else values) - grid[0]
+        x /= grid[1] - grid[0]
+        index = np.clip(np.floor(x).astype(int), 0, len(grid) - 2)
+        frac = x - index
+        Int, V = self.ivTable["I"], self.ivTable["V"]
+        return (
+            Int[index] + frac[:, np.newaxis] * (Int[index + 1] - Int[index]),
+            V[index] + frac * (V[index + 1] - V[index]),
+        )
+
     def pick(self) -> None:
         """pick new random model parameter"""
         self.pickParameters = self.generateRandomParameterValues()
 
-    def generateRandomParameterValues(self) -> None:
+    def pickBatch(self, nPicks: int) -> None:
+        """pick a batch of new random model parameters, as arrays of length nPicks"""
+        self.pickParametersBatch = self.generateRandomParameterValues(size=nPicks)
+
+    def generateRandomParameterValues(self, size: Optional[int] = None) -> dict:
         """to be depreciated as soon as models can generate their own..."""
         # initialize dict with parameter-value pairs defaulting to None
         returnDict = dict.fromkeys([key for key in self.fitParameterLimits])
         # fill:
         for parName in self.fitParameterLimits.keys():
             # can be replaced by a loop over iteritems:
-            (lower, upper) = self.fitParameterLimits[parName]
+            lower, upper = self.fitParameterLimits[parName]
             if self.logRandoms[parName]:
                 # use log-uniform distribution
                 returnDict[parName] = self.log_transform_generator(
-                    self.randomGenerators[parName], lower, upper
+                    self.randomGenerators[parName], lower, upper, size=size
                 )
             else:
                 # use uniform distribution
-                returnDict[parName] = self.randomGenerators[parName](low=lower, high=upper)
+                returnDict[parName] = self.randomGenerators[parName](
+                    low=lower, high=upper, size=size
+                )
         return returnDict
 
     def resetParameterSet(self) -> None:
         """fills the model parameter values with random values"""
-        for contribi in range(self.nContrib):
-            # can be improved with a list comprehension, but this only executes once..
-            self.parameterSet.loc[contribi] = self.generateRandomParameterValues()
+        if self.parameterColumns is None:
+            self.parameterColumns = self.fitKeys()
+        values = self.generateRandomParameterValues(size=self.nContrib)
+        self.parameterArray = np.stack(
+            [np.asarray(values[key], dtype=float) for key in self.parameterColumns], axis=1
+        )
 
     # Loading and Storing functions:
 
@@ -467,13 +658,12 @@ class McModel:
         self.modelName = loadKV(loadFromFile, path / "modelName", datatype="str")  # .decode('utf8')
         path /= f"repetition{loadFromRepetition}"
         self.parameterSet = loadKV(loadFromFile, path / "parameterSet", datatype="dictToPandas")
-        self.parameterSet.columns = [
-            colname for colname in self.parameterSet.columns
-        ]  # what does this do, a no-op?
         self.volumes = loadKV(loadFromFile, path / "volumes")
         self.seed = loadKV(loadFromFile, path / "seed")
+        self.spawnKey = loadKV(loadFromFile, path / "spawnKey", default=None)
         self.modelDType = loadKV(loadFromFile, path / "modelDType", datatype="str")
-        self.nContrib = self.parameterSet.shape[0]
+        self.loadedRandomState = loadKV(loadFromFile, path / "randomState", datatype="str")
+        self.nContrib = self.parameterArray.shape[0]
 
     def store(self, filename: Path, repetition: int) -> None:
         assert (
@@ -486,12 +676,18 @@ class McModel:
         storeKVPairs(filename, path / "staticParameters", self.staticParameters.items())
         storeKV(filename, path=path / "modelName", value=str(self.modelName))  # store modelName
 
-        psDict = self.parameterSet.copy().to_dict(orient="split")
+        psDict = self.parameterSet.to_dict(orient="split")
         storeKVPairs(filename, path / f"repetition{repetition}" / "parameterSet", psDict.items())
         storeKVPairs(
             filename,
             path / f"repetition{repetition}",
-            [("seed", self.seed), ("volumes", self.volumes), ("modelDType", self.modelDType)],
+            [
+                ("seed", self.seed),
+                ("spawnKey", self.spawnKey),
+                ("volumes", self.volumes),
+                ("modelDType", self.modelDType),
+                ("randomState", self.randomState),
+            ],
         )
 
     # SasView SasModel helper functions:
@@ -525,7 +721,16 @@ class McModel:
     def loadModel(self) -> None:
         # loads sasView model and puts the handle in the right place:
         self.modelExists()  # check if model exists
-        self.func = sasmodels.core.load_model(self.modelName, dtype=self.modelDType)
+        key = (self.modelName, self.modelDType)
+        with MODEL_LOCK:
+            if key not in MODEL_CACHE:
+                func = sasmodels.core.load_model(self.modelName, dtype=self.modelDType)
+                MODEL_CACHE[key] = (func, dict(func.info.parameters.defaults))
+            self.func, defaults = MODEL_CACHE[key]
+            # the defaults are updated with the static parameters of every use, start clean.
+            # Static parameters are passed explicitly in calcModelIVDirect, so concurrent
+            # uses with other static parameters (in threads) do not depend on these:
+            self.func.info.parameters.defaults = dict(defaults)
 
     def loadMcsasSphereModel(self) -> None:
         self.func = mcsasSphereModel(
@@ -3,7 +3,7 @@ from typing import Optional
 
 import numpy as np
 
-from mcsas3.mc_hdf import ResultIndex, loadKVPairs, storeKVPairs
+from mcsas3.mc_hdf import ResultIndex, loadKV, loadKVPairs, storeKVPairs
 
 # TODO: refactor this using attrs @define for clearer handling.
 
@@ -20,13 +20,25 @@ class McOpt:
     repetition = None  # Optimization instance repetition number (defines storage location)
     step = None  # number of iteration steps, should be renamed "iteration"
     testX0 = None  # X0 if test is accepted.
-    testModelI = None  # internal, updated intensity after replacing with pick
     testModelV = None  # volume of test object, optionally used for weighted histogramming later on.
     weighting = 0.5  # NOT USED, set to default = volume-weighted.
     # volume-weighting / compensation factor for the contributions
     x0 = None  # continually updated new guess for total scaling, background values.
     acceptedSteps = []  # for each accepted pick, write the iteration step number here
     acceptedGofs = []  # for each accepted pick, write the reached GOF here.
+    osbEngine = "analytic"  # scaling and background matching: "analytic" or "scipy" (slower)
+    batchSize = 1  # number of picks evaluated together per iteration, best improvement is accepted
+    acceptanceRate = None  # fraction of accepted picks in the last optimization
+    pickRate = None  # throughput in evaluated picks per second in the last optimization
+    resyncInterval = 0  # recalculate modelI exactly every this many accepted picks, 0: never
+    resyncTolerance = 0.0  # or when the estimated relative round-off drift exceeds this, 0: off
+    resyncSteps = []  # for each recalculation of modelI, write the iteration step number here
+    resyncDrifts = []  # for each recalculation of modelI, write the measured relative drift here
+    checkpointSteps = 0  # store the running state every this many iteration steps, 0: never
+    checkpointInterval = 0.0  # or every this many seconds, 0: never
+    finished = False  # False for a stored checkpoint of an optimization that is still running
+    recordTiming = False  # record the wall time per phase of the optimization loop, see McTiming
+    progressInterval = 5.0  # report the progress of the optimization every this many seconds
 
     storeKeys = [  # keys to store in an output file
         "accepted",
@@ -41,6 +53,19 @@ class McOpt:
         "x0",
         "acceptedSteps",
         "acceptedGofs",
+        "osbEngine",
+        "batchSize",
+        "acceptanceRate",
+        "pickRate",
+        "resyncInterval",
+        "resyncTolerance",
+        "resyncSteps",
+        "resyncDrifts",
+        "checkpointSteps",
+        "checkpointInterval",
+        "finished",
+        "recordTiming",
+        "progressInterval",
     ]
     loadKeys = [  # load (and replace) these settings from a previous run into the current settings
         "accepted",
@@ -54,6 +79,21 @@ class McOpt:
         "acceptedSteps",
         "acceptedGofs",
     ]
+    # also loaded if available, these are not present in files from older versions. Together with
+    # the loadKeys, these allow a checkpointed optimization to be continued:
+    optionalLoadKeys = [
+        "osbEngine",
+        "batchSize",
+        "resyncInterval",
+        "resyncTolerance",
+        "resyncSteps",
+        "resyncDrifts",
+        "checkpointSteps",
+        "checkpointInterval",
+        "finished",
+        "recordTiming",
+        "progressInterval",
+    ]
 
     # Multiple types (e.g. Path|None ) only supported from Python 3.10
     def __init__(
@@ -73,7 +113,6 @@ class McOpt:
         self.repetition = None  # Optimization instance repetition number (defines storage location)
         self.step = None  # number of iteration steps, should be renamed "iteration"
         self.testX0 = None  # X0 if test is accepted.
-        self.testModelI = None  # internal, updated intensity after replacing with pick
         self.testModelV = (
             None  # volume of test object, optionally used for weighted histogramming later on.
         )
@@ -82,6 +121,19 @@ class McOpt:
         self.x0 = None  # continually updated new guess for total scaling, background values.
         self.acceptedSteps = []  # for each accepted pick, write the iteration step number here
         self.acceptedGofs = []  # for each accepted pick, write the reached GOF here.
+        self.osbEngine = "analytic"  # scaling and background matching: "analytic" or "scipy"
+        self.batchSize = 1  # number of picks evaluated together per iteration
+        self.acceptanceRate = None  # fraction of accepted picks in the last optimization
+        self.pickRate = None  # throughput in evaluated picks per second in the last optimization
+        self.resyncInterval = 0  # recalculate modelI exactly every this many accepted picks
+        self.resyncTolerance = 0.0  # or when the estimated relative round-off drift exceeds this
+        self.resyncSteps = []  # for each recalculation of modelI, the iteration step number
+        self.resyncDrifts = []  # for each recalculation of modelI, the measured relative drift
+        self.checkpointSteps = 0  # store the running state every this many iteration steps
+        self.checkpointInterval = 0.0  # or every this many seconds
+        self.finished = False  # False for a checkpoint of an optimization that is still running
+        self.recordTiming = False  # record the wall time per phase of the optimization loop
+        self.progressInterval = 5.0  # report the progress every this many seconds
 
         self.resultIndex = ResultIndex(resultIndex)  # defines the HDF5 root path
         self.repetition = kwargs.pop("loadFromRepetition", 0)
@@ -111,4 +163,19 @@ class McOpt:
         if path is None:
             path = self.resultIndex.nxsEntryPoint / "optimization" / f"repetition{repetition}"
         for key, value in loadKVPairs(filename, path, self.loadKeys):
-            setattr(self, key, value)
+            setattr(self, key, self.castLoaded(key, value))
+        for key in self.optionalLoadKeys:
+            value = loadKV(filename, path / key, default=None)
+            if value is not None:
+                setattr(self, key, self.castLoaded(key, value))
+
+    def castLoaded(self, key: str, value):
+        """restores the types that do not survive the round-trip through HDF5"""
+        if isinstance(value, bytes):
+            return value.decode("utf8")
+        if isinstance(McOpt.__dict__.get(key, None), list):
+            # lists are stored as arrays, but are appended to during the optimization:
+            return np.atleast_1d(value).tolist()
+        if isinstance(McOpt.__dict__.get(key, None), bool):
+            return bool(value)
+        return value
@@ -0,0 +1,102 @@
+# src/mcsas3/mc_progress.py
+
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Optional, TextIO
+
+import numpy as np
+
+
+class McProgress:
+    """
+    Aggregates the progress events of the optimizations running in the worker processes, as sent
+    by McCore.optimize through a queue (see McHatPool). The latest event of every repetition is
+    kept, every event is appended to a JSON-lines log if logFile is set, and a single status line
+    summarizing all repetitions is refreshed at most every refreshInterval seconds.
+
+    Usage example:
+
+        progress = McProgress(logFile="progress.jsonl")
+        for event in events:
+            progress.update(event)
+        progress.close()
+
+    Each line of the log is the JSON of an event with its time added, e.g.:
+
+        {"repetition": 3, "step": 52000, "accepted": 1187, "gof": 1.42, "elapsed": 30.1,
+         "state": "running", "filename": "result.h5", "time": 1760000000.0}
+    """
+
+    logFile = None  # path of the JSON-lines log of all events, None: no log
+    statusStream = None  # stream for the live status line, None: no status line
+    refreshInterval = 0.5  # minimum time in seconds between updates of the status line
+    latest = None  # dict with the latest event per (filename, repetition)
+    _log = None  # log file, opened at the first event
+    _lastRefresh = 0.0  # time of the latest update of the status line
+    _lineLength = 0  # length of the status line shown, to overwrite it completely
+
+    def __init__(
+        self,
+        logFile: Optional[Path] = None,
+        statusStream: Optional[TextIO] = sys.stderr,
+        refreshInterval: float = 0.5,
+    ) -> None:
+        self.logFile = logFile
+        self.statusStream = statusStream
+        self.refreshInterval = refreshInterval
+        self.latest = {}
+        self._log = None
+        self._lastRefresh = 0.0
+        self._lineLength = 0
+
+    def update(self, event: dict) -> None:
+        """adds a progress event (a dict as returned by McCore.progressEvent, with filename)"""
+        self.latest[(event.get("filename", None), event["repetition"])] = event
+        if self.logFile is not None:
+            if self._log is None:
+                self._log = open(self.logFile, "a")
+            self._log.write(json.dumps(dict(event, time=time.time())) + "\n")
+        if (self.statusStream is not None) and (
+            time.time() - self._lastRefresh >= self.refreshInterval
+        ):
+            self.refresh()
+
+    def statusLine(self) -> str:
+        """summary of the latest progress of all repetitions"""
+        events = list(self.latest.values())
+        running = [event for event in events if event["state"] == "running"]
+        line = "{} / {} repetitions finished".format(
+            sum(event["state"] == "finished" for event in events), len(events)
+        )
+        nCancelled = sum(event["state"] == "cancelled" for event in events)
+        if nCancelled > 0:
+            line += ", {} cancelled".format(nCancelled)
+        if len(running) > 0:
+            gofs = [event["gof"] for event in running]
+            line += ", {} running: chiSqr {:.3g} (median), {:.3g} (max), step {} - {}".format(
+                len(running),
+                np.median(gofs),
+                np.max(gofs),
+                min(event["step"] for event in running),
+                max(event["step"] for event in running),
+            )
+        return line
+
+    def refresh(self) -> None:
+        """(over)writes the status line"""
+        line = self.statusLine()
+        self.statusStream.write("\r" + line.ljust(self._lineLength))
+        self.statusStream.flush()
+        self._lineLength, self._lastRefresh = len(line), time.time()
+
+    def close(self) -> None:
+        """shows the final status and closes the log, further events start a new summary"""
+        if (self.statusStream is not None) and (len(self.latest) > 0):
+            self.refresh()
+            self.statusStream.write("\n")
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        self.latest, self._lineLength = {}, 0
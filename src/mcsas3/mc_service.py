@@ -0,0 +1,234 @@
+# src/mcsas3/mc_service.py
+
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from attrs import define, field
+
+from mcsas3.cli_tools import McSAS3_cli_histogram, McSAS3_cli_optimize
+from mcsas3.mc_cache import fileDigest
+
+JOB_STATES = ["queued", "optimizing", "histogramming", "finished", "failed"]
+
+
+@define
+class McServiceJob(object):
+    """A job of the McService: the optimization and histogramming of a data file"""
+
+    jobId: str = field(kw_only=True)  # derived from the content of the submission, see jobKey
+    request: dict = field(kw_only=True)  # the submission, with absolute paths
+    state: str = field(kw_only=True, default="queued")  # one of JOB_STATES
+    submitted: float = field(kw_only=True, factory=time.time)  # time of submission
+    started: Optional[float] = field(kw_only=True, default=None)  # time the optimization started
+    finished: Optional[float] = field(kw_only=True, default=None)  # time the job ended
+    error: Optional[str] = field(kw_only=True, default=None)  # traceback of a failed job
+
+    def status(self) -> dict:
+        """the public status of the job, as returned by the API"""
+        status = dict(
+            jobId=self.jobId,
+            state=self.state,
+            submitted=self.submitted,
+            started=self.started,
+            finished=self.finished,
+            resultFile=self.request["resultFile"],
+        )
+        if self.state == "finished":
+            status["histogramFile"] = str(Path(self.request["resultFile"]).with_suffix(".pdf"))
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+
+def optimizeJob(request: dict) -> None:
+    """runs the optimization of a job, in a worker process of the McService"""
+    McSAS3_cli_optimize(
+        dataFile=Path(request["dataFile"]),
+        resultFile=Path(request["resultFile"]),
+        readConfigFile=Path(request["readConfigFile"]),
+        runConfigFile=Path(request["runConfigFile"]),
+        resultIndex=request["resultIndex"],
+        deleteIfExists=True,
+        nThreads=request["nThreads"],
+    )
+
+
+def histogramJob(request: dict) -> None:
+    """runs the histogramming of an optimized job, in a worker process of the McService"""
+    McSAS3_cli_histogram(
+        resultFile=Path(request["resultFile"]),
+        histConfigFile=Path(request["histConfigFile"]),
+        resultIndex=request["resultIndex"],
+    )
+
+
+class McService:
+    """
+    Asynchronous job service running the McSAS3 pipeline (optimization and histogramming, as
+    the mcsas3-runner and mcsas3-histogrammer commands) for submitted data files, e.g. from a
+    beamline data pipeline. At most maxJobs jobs run at the same time, in worker processes, the
+    others are queued. Identical submissions (same request and same content of the data and
+    configuration files) are run only once, they return the existing job. A submission with the
+    resultFile of a job that is still queued or running is refused.
+
+    The API is served over HTTP, on a local TCP port or a Unix socket, with JSON bodies:
+
+        POST /jobs            submits a job: {"dataFile": ..., "readConfigFile": ...,
+                              "runConfigFile": ..., "histConfigFile": ..., optional:
+                              "resultFile", "resultIndex" (1), "nThreads" (0: from the config)}
+        GET  /jobs            status of all jobs
+        GET  /jobs/<jobId>    status of a job, with its result and histogram files when finished
+
+    Usage example:
+
+        service = McService(resultDir=Path("results"), maxJobs=2)
+        asyncio.run(service.serve(unixSocket="mcsas3.sock"))
+    """
+
+    requiredKeys = ["dataFile", "readConfigFile", "runConfigFile", "histConfigFile"]
+    resultDir = None  # directory for the result files of jobs submitted without resultFile
+    maxJobs = 1  # maximum number of jobs running at the same time
+    jobs = None  # dict of McServiceJobs by jobId
+    _executor = None  # ProcessPoolExecutor running the jobs
+    _slots = None  # asyncio.Semaphore limiting the number of running jobs
+    _tasks = None  # set of the asyncio tasks of the queued and running jobs
+
+    def __init__(self, resultDir: Path, maxJobs: int = 1) -> None:
+        self.resultDir = Path(resultDir)
+        self.maxJobs = maxJobs
+        self.jobs = {}
+        # spawned rather than forked: forked workers would inherit the open client connections,
+        # which are then never closed. The workers may start the processes of McHat themselves.
+        self._executor = ProcessPoolExecutor(
+            max_workers=maxJobs, mp_context=multiprocessing.get_context("spawn")
+        )
+        self._slots = None  # created in the event loop
+        self._tasks = set()
+
+    def jobKey(self, request: dict) -> str:
+        """identifies a submission by its settings and the content of its input files, which are
+        read in blocks. Blocks for large files, see submit"""
+        digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode())
+        for key in self.requiredKeys:
+            digest.update(fileDigest(Path(request[key])).encode())
+        return digest.hexdigest()[:16]
+
+    async def submit(self, request: dict) -> McServiceJob:
+        """adds a job, or returns the existing one for an identical submission. The input files
+        are hashed in a thread, so that other requests are answered meanwhile"""
+        missing = [key for key in self.requiredKeys if key not in request]
+        assert len(missing) == 0, "missing job settings: {}".format(", ".join(missing))
+        unknown = set(request) - set(self.requiredKeys + ["resultFile", "resultIndex", "nThreads"])
+        assert len(unknown) == 0, "unknown job settings: {}".format(", ".join(sorted(unknown)))
+        request = dict(request)
+        for key in self.requiredKeys:
+            request[key] = str(Path(request[key]).absolute())
+            assert Path(request[key]).is_file(), "{} {} does not exist".format(key, request[key])
+        request.setdefault("resultIndex", 1)
+        request.setdefault("nThreads", 0)
+        if request.get("resultFile", None) is not None:
+            request["resultFile"] = str(Path(request["resultFile"]).absolute())
+        jobId = await asyncio.to_thread(self.jobKey, request)
+        if (jobId in self.jobs) and (self.jobs[jobId].state != "failed"):
+            return self.jobs[jobId]  # identical to a previous submission
+        if request.get("resultFile", None) is None:
+            request["resultFile"] = str((self.resultDir / jobId).with_suffix(".nxs").absolute())
+        # the optimization replaces the result file, which another job may still be writing:
+        busy = [
+            other.jobId
+            for other in self.jobs.values()
+            if (other.state not in ["finished", "failed"])
+            and (other.request["resultFile"] == request["resultFile"])
+        ]
+        assert len(busy) == 0, "resultFile {} is in use by job {}".format(
+            request["resultFile"], ", ".join(busy)
+        )
+        job = McServiceJob(jobId=jobId, request=request)
+        self.jobs[jobId] = job
+        task = asyncio.get_running_loop().create_task(self.runJob(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def runJob(self, job: McServiceJob) -> None:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.maxJobs)
+        loop = asyncio.get_running_loop()
+        async with self._slots:
+            job.started = time.time()
+            try:
+                job.state = "optimizing"
+                await loop.run_in_executor(self._executor, optimizeJob, job.request)
+                job.state = "histogramming"
+                await loop.run_in_executor(self._executor, histogramJob, job.request)
+                job.state = "finished"
+            except Exception:
+                job.state, job.error = "failed", traceback.format_exc()
+            job.finished = time.time()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """answers a single HTTP request"""
+        try:
+            method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if line == "":
+                    break
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            code, response = await self.route(method, target, body)
+        except Exception as e:
+            code, response = 400, {"error": str(e)}
+        content = json.dumps(response).encode()
+        writer.write(
+            "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+            "Connection: close\r\n\r\n".format(
+                code,
+                {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found"}[code],
+                len(content),
+            ).encode()
+            + content
+        )
+        await writer.drain()
+        writer.close()
+
+    async def route(self, method: str, target: str, body: bytes) -> tuple:
+        """(HTTP status code, response) for a request"""
+        parts = [part for part in target.split("?")[0].split("/") if part != ""]
+        if (method == "POST") and (parts == ["jobs"]):
+            try:
+                job = await self.submit(json.loads(body))
+            except AssertionError as e:
+                return 400, {"error": str(e)}
+            return 202, job.status()
+        if (method == "GET") and (parts == ["jobs"]):
+            return 200, [job.status() for job in self.jobs.values()]
+        if (method == "GET") and (len(parts) == 2) and (parts[0] == "jobs"):
+            if parts[1] not in self.jobs:
+                return 404, {"error": "unknown job {}".format(parts[1])}
+            return 200, self.jobs[parts[1]].status()
+        return 404, {"error": "unknown endpoint {} {}".format(method, target)}
+
+    async def serve(
+        self, host: str = "127.0.0.1", port: int = 8080, unixSocket: Optional[Path] = None
+    ) -> None:
+        """serves the API until cancelled, on the Unix socket if given, else on host:port"""
+        self.resultDir.mkdir(parents=True, exist_ok=True)
+        if unixSocket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=str(unixSocket))
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
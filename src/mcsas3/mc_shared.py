@@ -0,0 +1,91 @@
+# src/mcsas3/mc_shared.py
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class SharedDict(dict):
+    """dict with views of shared memory blocks, which keeps the blocks open while it exists"""
+
+    blocks = None  # list of SharedMemory instances the views in this dict refer to
+
+
+class SharedMeasData:
+    """
+    Measurement data dict (with entries for Q, I, ISigma) with its arrays in shared memory blocks,
+    for passing large (2D) datasets to the worker processes without copying them. Pickling only
+    transfers the names, shapes and dtypes of the blocks, the unpickled instance attaches to the
+    same blocks, and its measData contains zero-copy NumPy views of them. Other (non-array)
+    entries are passed on as-is. As Q is a list of arrays, lists of arrays are shared per array.
+
+    The views in measData are valid as long as measData exists, as the blocks are closed when it
+    is garbage collected. The blocks are owned by the creating instance, which should release them
+    when the workers are done, using unlink.
+
+    Usage example:
+
+        shared = SharedMeasData(measData)
+        pool.apply_async(worker, (shared,))  # in the worker: shared.measData["I"], ...
+        ...
+        shared.unlink()
+    """
+
+    measData = None  # SharedDict with the same entries as the original, arrays are shared views
+    _blocks = None  # list of SharedMemory instances, to keep them open while in use
+    _layout = None  # dict with (block name, shape, dtype) per array, lists thereof for lists
+    _owner = False  # True for the creating instance, which releases the blocks
+
+    def __init__(self, measData: dict) -> None:
+        self._blocks, self._layout, self._owner = [], {}, True
+        self.measData = SharedDict()
+        self.measData.blocks = self._blocks
+        for key, value in measData.items():
+            if isinstance(value, np.ndarray):
+                self.measData[key], self._layout[key] = self.share(value)
+            elif isinstance(value, (list, tuple)) and all(isinstance(v, np.ndarray) for v in value):
+                shared = [self.share(v) for v in value]
+                self.measData[key] = [view for view, _ in shared]
+                self._layout[key] = [layout for _, layout in shared]
+            else:
+                self.measData[key] = value
+
+    def share(self, array: np.ndarray) -> tuple:
+        """copies an array into a new shared memory block, returns a view and its layout"""
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self._blocks.append(block)
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[...] = array
+        return view, (block.name, array.shape, array.dtype.str)
+
+    def attach(self, layout: tuple) -> np.ndarray:
+        """returns a view of an existing shared memory block"""
+        name, shape, dtype = layout
+        block = shared_memory.SharedMemory(name=name)
+        self._blocks.append(block)
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+    def __getstate__(self) -> dict:
+        # only the layout of the shared arrays is transferred, not the arrays themselves:
+        other = {key: value for key, value in self.measData.items() if key not in self._layout}
+        return {"layout": self._layout, "other": other}
+
+    def __setstate__(self, state: dict) -> None:
+        self._blocks, self._layout, self._owner = [], state["layout"], False
+        self.measData = SharedDict(state["other"])
+        self.measData.blocks = self._blocks
+        for key, layout in self._layout.items():
+            if isinstance(layout, list):
+                self.measData[key] = [self.attach(item) for item in layout]
+            else:
+                self.measData[key] = self.attach(layout)
+
+    def unlink(self) -> None:
+        """releases the shared memory blocks, to be called by the owner when no longer needed.
+        Views of the data remain valid until garbage collected"""
+        if not self._owner:
+            return
+        for block in self._blocks:
+            block.unlink()
+        self._owner = False
@@ -0,0 +1,70 @@
+# src/mcsas3/mc_timing.py
+
+import time
+from typing import Optional
+
+import numpy as np
+
+
+class McTiming:
+    """
+    Low-overhead wall time accumulation for the phases of the optimization loop, enabled with the
+    recordTiming setting of McOpt. For every phase, the number of timed calls, the cumulative time
+    and a histogram of the individual durations are kept. Durations are in nanoseconds from
+    time.perf_counter_ns, histogram bin k counts the durations d with 2**(k-1) <= d < 2**k
+    (bin 0: d < 1 ns), the last bin also counts anything longer.
+
+    Usage example:
+
+        timing = McTiming()
+        t = timing.lap()
+        doSomething()
+        t = timing.lap("pick", t)
+    """
+
+    phases = ["pick", "kernel", "match", "accept", "store"]  # phases timed by McCore
+    nBins = 48  # number of histogram bins, the last bin starts at 2**46 ns (about 20 hours)
+    counts = None  # dict with the number of timed calls per phase
+    totalNs = None  # dict with the cumulative duration per phase
+    histograms = None  # dict with lists of histogram counts of the durations per phase
+
+    def __init__(self) -> None:
+        self.counts = dict.fromkeys(self.phases, 0)
+        self.totalNs = dict.fromkeys(self.phases, 0)
+        self.histograms = {phase: [0] * self.nBins for phase in self.phases}
+
+    def lap(self, phase: Optional[str] = None, since: int = 0) -> int:
+        """returns the current time, and adds the time passed since the given time to a phase"""
+        now = time.perf_counter_ns()
+        if phase is not None:
+            duration = now - since
+            self.counts[phase] += 1
+            self.totalNs[phase] += duration
+            self.histograms[phase][min(duration.bit_length(), self.nBins - 1)] += 1
+        return now
+
+    @property
+    def binEdgesNs(self) -> np.ndarray:
+        """lower edges of the histogram bins in nanoseconds"""
+        return np.array([0] + [2**k for k in range(self.nBins - 1)], dtype=np.int64)
+
+    def asDict(self) -> dict:
+        """nested dict with the timing results per phase, for storing in HDF5"""
+        timing = {
+            phase: {
+                "count": self.counts[phase],
+                "totalNs": self.totalNs[phase],
+                "histogram": np.array(self.histograms[phase], dtype=np.int64),
+            }
+            for phase in self.phases
+        }
+        timing["binEdgesNs"] = self.binEdgesNs
+        return timing
+
+    def summary(self) -> str:
+        """one line with the mean duration per call for every timed phase"""
+        return ", ".join(
+            "{}: {:.1f} µs".format(phase, self.totalNs[phase] / self.counts[phase] / 1e3)
+            for phase in self.phases
+            if self.counts[phase] > 0
+        )
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+from mcsas3.mc_cache import McDataCache
+
+
+def printEntries(entries: list) -> None:
+    for entry in entries:
+        print(
+            "{}  {:10.1f} kB  used {}  {}".format(
+                entry["key"][:16],
+                entry["size"] / 1024,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["lastUsed"])),
+                entry["filename"],
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="""
+            Inspects and purges a cache of prepared McSAS data, as enabled by the cacheDir
+            setting of the read configuration. Without options, the entries are listed, least
+            recently used first.
+
+            Released under a GPLv3+ license.
+            """
+    )
+    parser.add_argument(
+        "-d",
+        "--cacheDir",
+        type=lambda p: Path(p).absolute(),
+        default=os.environ.get("MCSAS3_CACHE_DIR", None),
+        help="The cache directory, taken from the MCSAS3_CACHE_DIR environment variable if omitted",
+    )
+    parser.add_argument(
+        "-p",
+        "--purge",
+        action="store_true",
+        help="Remove all entries, or those not used for --olderThan days",
+    )
+    parser.add_argument(
+        "-o",
+        "--olderThan",
+        type=float,
+        default=None,
+        help="With --purge, only remove the entries not used for this number of days",
+    )
+    parser.add_argument(
+        "-s",
+        "--shrinkTo",
+        type=float,
+        default=None,
+        help="Remove the least recently used entries until the rest fit in this number of MB",
+    )
+    args = parser.parse_args()
+    if args.cacheDir is None:
+        parser.error("the cache directory is required")
+    if (args.olderThan is not None) and not args.purge:
+        parser.error("--olderThan applies to --purge only")
+
+    cache = McDataCache(Path(args.cacheDir))
+    removed = []
+    if args.purge:
+        olderThan = None if args.olderThan is None else args.olderThan * 86400
+        removed += cache.purge(olderThan=olderThan)
+    if args.shrinkTo is not None:
+        removed += cache.evict(maxBytes=int(args.shrinkTo * 2**20))
+    if len(removed) > 0:
+        print(f"removed {len(removed)} entries:")
+        printEntries(removed)
+    entries = cache.entries()
+    printEntries(entries)
+    print(
+        "{} entries, {:.1f} MB in {}".format(
+            len(entries), sum(entry["size"] for entry in entries) / 2**20, cache.cacheDir
+        )
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import sys
+from pathlib import Path
+
+from mcsas3.mc_service import McService
+
+
+def main():
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(
+        description="""
+            Runs the McSAS3 job service: data files submitted through its HTTP API are
+            optimized and histogrammed, as with the mcsas3-runner and mcsas3-histogrammer
+            commands. Submit a job with POST /jobs, with a JSON body containing dataFile,
+            readConfigFile, runConfigFile and histConfigFile, and follow it with GET /jobs/<jobId>.
+
+            Released under a GPLv3+ license.
+            """
+    )
+    parser.add_argument(
+        "-r",
+        "--resultDir",
+        type=lambda p: Path(p).absolute(),
+        default=Path("mcsas3_results").absolute(),
+        help="Directory to store the results in, for jobs submitted without resultFile",
+    )
+    parser.add_argument(
+        "-j",
+        "--maxJobs",
+        type=int,
+        default=1,
+        help="The maximum number of jobs running at the same time, the others are queued",
+    )
+    parser.add_argument(
+        "-H",
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The host (interface) to serve the API on",
+    )
+    parser.add_argument(
+        "-p",
+        "--port",
+        type=int,
+        default=8080,
+        help="The TCP port to serve the API on",
+    )
+    parser.add_argument(
+        "-u",
+        "--unixSocket",
+        type=lambda p: Path(p).absolute(),
+        default=None,
+        help="Path of a Unix socket to serve the API on, instead of a TCP port",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    service = McService(resultDir=args.resultDir, maxJobs=args.maxJobs)
+    try:
+        asyncio.run(service.serve(host=args.host, port=args.port, unixSocket=args.unixSocket))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
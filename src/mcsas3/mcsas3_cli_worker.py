@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+
+from mcsas3.mc_cluster import parseAddress, startAgents
+
+
+def main():
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(
+        description="""
+            Runs McSAS worker agents, which optimize the repetitions distributed by a McHatPool
+            with the cluster executor, e.g. on other machines. The agents connect to the job
+            server of the pool, and stop when it shuts down. The results are sent back to the
+            pool, which stores them.
+
+            Released under a GPLv3+ license.
+            """
+    )
+    parser.add_argument(
+        "-a",
+        "--address",
+        type=parseAddress,
+        required=True,
+        help="Address of the job server, host:port for TCP or the path of a Unix socket",
+    )
+    parser.add_argument(
+        "-k",
+        "--authkey",
+        type=lambda key: key.encode(),
+        default=os.environ.get("MCSAS3_AUTHKEY", None),
+        help=(
+            "Authentication key of the job server,"
+            " taken from the MCSAS3_AUTHKEY environment variable if omitted"
+        ),
+    )
+    parser.add_argument(
+        "-w",
+        "--nWorkers",
+        type=int,
+        default=1,
+        help="The number of worker processes to run on this machine",
+    )
+    parser.add_argument(
+        "-t",
+        "--threadsPerWorker",
+        type=int,
+        default=1,
+        help="Limit of the BLAS/OpenMP threads per worker process, 0: no limit",
+    )
+    args = parser.parse_args()
+    if isinstance(args.authkey, str):  # from the environment
+        args.authkey = args.authkey.encode()
+    if args.authkey is None:
+        parser.error("the authentication key of the job server is required")
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    agents = startAgents(args.address, args.authkey, args.nWorkers, args.threadsPerWorker)
+    for agent in agents:
+        agent.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
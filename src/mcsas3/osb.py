@@ -23,6 +23,9 @@ class optimizeScalingAndBackground(object):
     xBounds:
         optional, constraints to the optimization,
         speeds up when appropriate constraints are given
+    engine:
+        optional, "analytic" (default) solves the bounded linear least-squares problem
+        in closed form, "scipy" uses the (slower) iterative scipy.optimize.minimize TNC method
 
     Returns
     -------
@@ -41,10 +44,15 @@ class optimizeScalingAndBackground(object):
     measDataI = None
     measDataISigma = None
     xBounds = None
+    engine = "analytic"
+    engines = ["analytic", "scipy"]
 
-    def __init__(self, measDataI=None, measDataISigma=None, xBounds=None):
+    def __init__(self, measDataI=None, measDataISigma=None, xBounds=None, engine="analytic"):
         self.measDataI = measDataI
         self.measDataISigma = measDataISigma
+        self.xBounds = xBounds
+        assert engine in self.engines, "engine must be one of {}".format(self.engines)
+        self.engine = engine
         self.validate()
         if xBounds is None:
             self.xBounds = [
@@ -56,11 +64,27 @@ class optimizeScalingAndBackground(object):
             ]
             # [self.measDataI[np.isfinite(self.measDataI)].min(),
             # self.measDataI[np.isfinite(self.measDataI)].max()]]
+        # data-only sums for the closed-form solution, weights are the inverse variances:
+        self._w = self.measDataISigma ** (-2.0)
+        self._sumW = self._w.sum()
+        self._sumWI = (self._w * self.measDataI).sum()
+        self._sumWII = np.dot(self._w * self.measDataI, self.measDataI)
+        # rows w, w*I and w*m (set in setModel), to get the weighted sums of a model change at once
+        self._wStack = np.stack((self._w, self._w * self.measDataI, np.zeros_like(self._w)))
+        self._modelI = None  # current total model intensity, set with setModel
+        self._sumWM, self._sumWMM, self._sumWMI = None, None, None
+        # background estimate from the tail of the data, for the initial guess:
+        self._bgndGuess = np.clip(
+            self.measDataI[-int(np.floor(4 * len(self.measDataI) / 5)) :].mean(),
+            self.xBounds[1][0],
+            self.xBounds[1][1],
+        )
+        self._scratch = np.empty_like(self.measDataI, dtype=float)  # for chiSqr
 
     def initialGuess(self, optI):
         # new guess:
         sc = np.median(self.measDataI / optI)
-        bgnd = self.measDataI[-int(np.floor(4 * len(self.measDataI) / 5)) :].mean()
+        bgnd = self._bgndGuess  # clipped to within bounds already
 
         # bgnd = self.measDataI[np.isfinite(self.measDataI)].min()
         # sc = ((self.measDataI - bgnd) / optI).mean()
@@ -68,7 +92,6 @@ class optimizeScalingAndBackground(object):
             sc = 1.0  # auto-determination failed, but we need to stay within bounds
         # x0 = np.array([self.measDataI.mean() / optI.mean(), self.measDataI.min()])
         # sc = ((self.measDataI) / optI).mean()
-        bgnd = np.clip(bgnd, self.xBounds[1][0], self.xBounds[1][1])
         return np.array([sc, bgnd])
 
     def validate(self):
@@ -85,23 +108,145 @@ class optimizeScalingAndBackground(object):
 
     @staticmethod
     def optFunc(sc, measDataI, measDataISigma, modelDataI):
-        # reduced chi-square; normalized by uncertainty.
+        # reduced chi-square; normalized by uncertainty. Reference implementation, see chiSqr
+        cs = np.sum(((measDataI - (modelDataI * sc[0] + sc[1])) / measDataISigma) ** 2)
+        return cs / measDataI.size
+
+    def chiSqr(self, sc, modelDataI):
+        """reduced chi-square as in optFunc, but using the precomputed inverse variances and a
+        preallocated buffer, so no temporary arrays are created"""
+        residual = np.multiply(modelDataI, sc[0], out=self._scratch)
+        residual += sc[1]
+        residual -= self.measDataI
+        residual *= residual
+        return np.dot(residual, self._w) / self.measDataI.size
+
+    def match(self, modelDataI, x0=None):
+        if self.engine == "analytic":
+            return self.matchAnalytic(modelDataI)
+        return self.matchScipy(modelDataI, x0)
+
+    def setModel(self, modelDataI):
+        """Sets the current total model intensity and its weighted sums, so that the effect of
+        replacing a single contribution can be evaluated incrementally using matchDelta"""
+        self._modelI = modelDataI
+        wm = np.multiply(self._w, modelDataI, out=self._wStack[2])
+        self._sumWM = wm.sum()
+        self._sumWMM = np.dot(wm, modelDataI)
+        self._sumWMI = np.dot(wm, self.measDataI)
+
+    def matchDelta(self, deltaI, x0=None):
+        """Same as match for the model intensity (modelDataI + deltaI), with modelDataI set in
+        setModel. For the analytic engine, the new weighted sums are updated from the change in
+        intensity only, without constructing the new model intensity."""
+        assert self._modelI is not None, "the current model intensity must be set using setModel"
+        if self.engine != "analytic":
+            return self.match(self._modelI + deltaI, x0)
+        sumWD, sumWDI, sumWMD = self._wStack @ deltaI
+        sums = dict(
+            sumWM=self._sumWM + sumWD,
+            sumWMM=self._sumWMM + 2 * sumWMD + np.einsum("i,i,i", self._w, deltaI, deltaI),
+            sumWMI=self._sumWMI + sumWDI,
+        )
+        x = self.solveBounded(**sums)
+        return x, self.sumsChiSqr(x, **sums)
+
+    def matchDeltaBatch(self, deltaI, x0=None):
+        """matchDelta for a (nPicks x nQ) array of intensity changes, each applied separately.
+        Returns an (nPicks x 2) array of scaling and background values, and nPicks reduced
+        chi-square values"""
+        if self.engine != "analytic":
+            results = [self.matchDelta(dI, x0) for dI in deltaI]
+            return np.array([x for x, _ in results]), np.array([cs for _, cs in results])
+        # weighted sums for all changes at once:
+        sumWD, sumWDI, sumWMD = self._wStack @ deltaI.T
+        sumWDD = np.einsum("i,ki,ki->k", self._w, deltaI, deltaI)
+        x, cs = np.empty((len(deltaI), 2)), np.empty(len(deltaI))
+        for k in range(len(deltaI)):
+            sums = dict(
+                sumWM=self._sumWM + sumWD[k],
+                sumWMM=self._sumWMM + 2 * sumWMD[k] + sumWDD[k],
+                sumWMI=self._sumWMI + sumWDI[k],
+            )
+            x[k] = self.solveBounded(**sums)
+            cs[k] = self.sumsChiSqr(x[k], **sums)
+        return x, cs
+
+    def sumsChiSqr(self, x, sumWM, sumWMM, sumWMI):
+        """reduced chi-square of the scaled model, expanded in the weighted sums"""
+        sc, bgnd = x
         cs = (
-            sum(((measDataI - (modelDataI * sc[0] + sc[1])) / measDataISigma) ** 2) / measDataI.size
+            self._sumWII
+            + sc * sc * sumWMM
+            + 2 * sc * bgnd * sumWM
+            + bgnd * bgnd * self._sumW
+            - 2 * sc * sumWMI
+            - 2 * bgnd * self._sumWI
         )
-        return cs
+        # can become (slightly) negative by round-off for near-perfect fits
+        return max(cs, 0.0) / self.measDataI.size
 
-    def match(self, modelDataI, x0=None):
+    def matchScipy(self, modelDataI, x0=None):
         if x0 is None:  # optional argument with starting guess..
             # some initial guess
             x0 = self.initialGuess(modelDataI)
         # adapt bounds to modelData:
         # self._xBounds[0][1] /= modelDataI.mean()
         opt = scipy.optimize.minimize(
-            self.optFunc,
+            self.chiSqr,
             x0,
-            args=(self.measDataI, self.measDataISigma, modelDataI),
+            args=(modelDataI,),
             method="TNC",
             bounds=self.xBounds,
         )
         return opt["x"], opt["fun"]
+
+    def matchAnalytic(self, modelDataI):
+        """Closed-form solution of the weighted linear least-squares problem
+        I = sc * modelDataI + bgnd, subject to the box constraints in xBounds."""
+        x = self.solveBounded(
+            sumWM=np.dot(self._w, modelDataI),
+            sumWMM=np.einsum("i,i,i", self._w, modelDataI, modelDataI),
+            sumWMI=np.dot(self._wStack[1], modelDataI),
+        )
+        return x, self.chiSqr(x, modelDataI)
+
+    def solveBounded(self, sumWM, sumWMM, sumWMI):
+        """Minimizes the chi-square quadratic form given by the weighted sums over the box in
+        xBounds. If the unconstrained optimum is infeasible, the bounded optimum lies on an
+        edge of the box, where the 1D solutions are simply clipped to the edge limits."""
+        sumW, sumWI = self._sumW, self._sumWI
+        (scMin, scMax), (bgMin, bgMax) = [
+            (-np.inf if lo is None else lo, np.inf if hi is None else hi) for lo, hi in self.xBounds
+        ]
+
+        def chiSqr(sc, bgnd):  # up to a data-only constant, which does not affect the optimum
+            return (
+                sc * sc * sumWMM
+                + 2 * sc * bgnd * sumWM
+                + bgnd * bgnd * sumW
+                - 2 * sc * sumWMI
+                - 2 * bgnd * sumWI
+            )
+
+        det = sumW * sumWMM - sumWM**2
+        if det > 0:
+            sc = (sumW * sumWMI - sumWM * sumWI) / det
+            bgnd = (sumWMM * sumWI - sumWM * sumWMI) / det
+            if (scMin <= sc <= scMax) and (bgMin <= bgnd <= bgMax):
+                return np.array([sc, bgnd])
+
+        # fallback in case of a degenerate model intensity, the origin of the scaling:
+        sc = np.clip(0.0, scMin, scMax)
+        candidates = [(sc, np.clip((sumWI - sc * sumWM) / sumW, bgMin, bgMax))]
+        # scaling fixed at one of its limits, background free within its limits:
+        for sc in (scMin, scMax):
+            if np.isfinite(sc):
+                candidates += [(sc, np.clip((sumWI - sc * sumWM) / sumW, bgMin, bgMax))]
+        # background fixed at one of its limits, scaling free within its limits:
+        for bgnd in (bgMin, bgMax):
+            if np.isfinite(bgnd):
+                sc = (sumWMI - bgnd * sumWM) / sumWMM if sumWMM > 0 else 0.0
+                candidates += [(np.clip(sc, scMin, scMax), bgnd)]
+        sc, bgnd = min(candidates, key=lambda x: chiSqr(*x))
+        return np.array([sc, bgnd], dtype=float)
@@ -0,0 +1,422 @@
+# these need to be loaded at the beginning to avoid errors related to relative imports
+# (ImportWarning in h5py), might be related to the change of import style for Python 3.5+.
+import json
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+from mcsas3.mc_cluster import McClusterPool, startAgents
+from mcsas3.mc_core import McCore
+from mcsas3.mc_cpu import THREAD_LIMIT_VARIABLES, allowedCpus
+from mcsas3.mc_hat import McHat, McHatJob, McHatPool, collectResults
+from mcsas3.mc_hdf import ResultIndex, loadKV
+from mcsas3.mc_model import McModel
+from mcsas3.mc_opt import McOpt
+
+
+def sphereTestData():
+    # simulated scattering of a narrow distribution of spheres, internal sphere model
+    Q = np.logspace(-2, 0, 100)
+    qr = Q * 25.0
+    Int = (3.0 * (np.sin(qr) - qr * np.cos(qr)) / qr**3.0) ** 2 * 1e3 + 0.1
+    return dict(Q=[Q], I=Int, ISigma=Int * 0.01)
+
+
+def sphereModel(nContrib: int = 20, seed: int = 42, **kwargs) -> McModel:
+    return McModel(
+        modelName="mcsas_sphere",
+        nContrib=nContrib,
+        fitParameterLimits={"radius": (3.14, 314)},
+        staticParameters={"sld": 33.4, "sld_solvent": 0},
+        seed=seed,
+        **kwargs,
+    )
+
+
+def sphereHatArgs() -> dict:
+    return dict(
+        modelName="mcsas_sphere",
+        nContrib=20,
+        fitParameterLimits={"radius": (3.14, 314)},
+        staticParameters={"sld": 33.4, "sld_solvent": 0},
+        seed=42,
+        maxIter=500,
+        convCrit=0,
+        checkpointSteps=100,
+        nRep=1,
+        nCores=1,
+    )
+
+
+class interruptedHat(McHat):
+    # simulates a worker that dies after storing its second checkpoint
+    nStored = 0
+
+    def storeResults(self, mc: McCore, filename: Path, resultQueue=None) -> None:
+        super().storeResults(mc, filename, resultQueue)
+        self.nStored += 1
+        if self.nStored == 2:
+            raise KeyboardInterrupt
+
+
+class slowHat(McHat):
+    # simulates a repetition that takes much longer than the others
+    def runOnce(self, measData, filename, repetition=0, *args):
+        if repetition == 2:
+            self._optArgs = dict(self._optArgs, maxIter=10**8)
+        return super().runOnce(measData, filename, repetition, *args)
+
+
+class testMcCore(unittest.TestCase):
+    def test_contribution_intensity_cache(self):
+        mc = McCore(sphereTestData(), model=sphereModel(), opt=McOpt(maxIter=300, convCrit=0))
+        self.assertEqual(mc._contribI.shape, (20, 100))
+        mc.optimize()
+        self.assertGreater(mc._opt.accepted, 0, "no picks were accepted during optimization")
+        # the cache must still describe the current parameter set:
+        for contribi in range(mc._model.nContrib):
+            I, _ = mc._model.calcModelIV(mc._model.contribParameters(contribi))
+            np.testing.assert_allclose(mc._contribI[contribi], I)
+        np.testing.assert_allclose(mc._opt.modelI, mc._contribI.sum(axis=0), rtol=1e-10)
+
+    def test_batched_picks(self):
+        opt = McOpt(maxIter=302, convCrit=0, batchSize=8)
+        mc = McCore(sphereTestData(), model=sphereModel(), opt=opt)
+        mc.optimize()
+        self.assertEqual(mc._opt.step, 302, "maxIter should be honoured by the last batch")
+        self.assertGreater(mc._opt.accepted, 0, "no picks were accepted during optimization")
+        self.assertGreater(mc._opt.pickRate, 0)
+        self.assertAlmostEqual(mc._opt.acceptanceRate, mc._opt.accepted / 302)
+        # every accepted candidate must have improved the fit:
+        self.assertTrue(np.all(np.diff(mc._opt.acceptedGofs) <= 0))
+        for contribi in range(mc._model.nContrib):
+            I, V = mc._model.calcModelIV(mc._model.contribParameters(contribi))
+            np.testing.assert_allclose(mc._contribI[contribi], I)
+            self.assertAlmostEqual(mc._model.volumes[contribi], V)
+        np.testing.assert_allclose(mc._opt.modelI, mc._contribI.sum(axis=0), rtol=1e-10)
+
+    def test_tabulated_model(self):
+        model = sphereModel(tabulate=True, tabulationTolerance=1e-4)
+        mc = McCore(sphereTestData(), model=model, opt=McOpt(maxIter=200, convCrit=0))
+        self.assertIsNotNone(model.ivTable, "model has not been tabulated")
+        self.assertLessEqual(model.ivTable["error"], 1e-4)
+        radii = np.random.default_rng(0).uniform(3.14, 314, 50)
+        Int, V = model.calcModelIVBatch({"radius": radii})
+        for radius, IntTab, VTab in zip(radii, Int, V):
+            IntDirect, VDirect = model.calcModelIVDirect({"radius": radius})
+            np.testing.assert_allclose(IntTab, IntDirect, atol=1e-4 * np.abs(Int).max())
+            self.assertAlmostEqual(VTab / VDirect, 1, places=3)
+        # table is not rebuilt for the same Q:
+        table = model.ivTable
+        mc = McCore(sphereTestData(), model=model, opt=McOpt(maxIter=200, convCrit=0))
+        self.assertIs(model.ivTable, table)
+        mc.optimize()
+        self.assertGreater(mc._opt.accepted, 0, "no picks were accepted during optimization")
+
+    def test_resync_model_intensity(self):
+        opt = McOpt(maxIter=500, convCrit=0, resyncInterval=10)
+        mc = McCore(sphereTestData(), model=sphereModel(), opt=opt)
+        mc.optimize()
+        self.assertEqual(len(mc._opt.resyncSteps), mc._opt.accepted // 10)
+        self.assertTrue(np.all(np.array(mc._opt.resyncDrifts) < 1e-10))
+        np.testing.assert_allclose(mc._opt.modelI, mc.compensatedSum(mc._contribI), rtol=1e-12)
+
+    def test_checkpoint_resume(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            refFile, resumeFile = Path(tempDir) / "ref.h5", Path(tempDir) / "resume.h5"
+            McHat(**sphereHatArgs()).run(sphereTestData(), refFile)
+            with self.assertRaises(KeyboardInterrupt):
+                interruptedHat(**sphereHatArgs()).run(sphereTestData(), resumeFile)
+            opt = McOpt(loadFromFile=resumeFile, loadFromRepetition=0)
+            self.assertEqual(opt.step, 200)
+            self.assertFalse(opt.finished)
+            McHat(**sphereHatArgs()).resume(sphereTestData(), resumeFile)
+            # the resumed optimization continues identically to the uninterrupted one:
+            ref, resumed = [
+                (McModel(loadFromFile=f, loadFromRepetition=0), McOpt(loadFromFile=f))
+                for f in (refFile, resumeFile)
+            ]
+            self.assertTrue(resumed[1].finished)
+            self.assertEqual(resumed[1].step, 500)
+            np.testing.assert_array_equal(ref[0].parameterArray, resumed[0].parameterArray)
+            np.testing.assert_array_equal(ref[1].modelI, resumed[1].modelI)
+            self.assertEqual(ref[1].gof, resumed[1].gof)
+            self.assertEqual(ref[1].acceptedSteps, resumed[1].acceptedSteps)
+            self.assertEqual(ref[0].randomState, resumed[0].randomState)
+
+    def test_parallel_results_collected(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filename = Path(tempDir) / "parallel.h5"
+            hatArgs = sphereHatArgs()
+            hatArgs.update(nRep=3, nCores=2, maxIter=300)
+            McHat(**hatArgs).run(sphereTestData(), filename)
+            for repetition in range(3):
+                opt = McOpt(loadFromFile=filename, loadFromRepetition=repetition)
+                self.assertTrue(opt.finished)
+                self.assertEqual(opt.step, 300)
+                model = McModel(loadFromFile=filename, loadFromRepetition=repetition)
+                self.assertEqual(model.parameterArray.shape, (20, 1))
+            self.assertEqual(loadKV(filename, "/analyses/MCResult1/optimization/nRep"), 3)
+            layout = loadKV(filename, "/analyses/MCResult1/optimization/cpuLayout", "dict")
+            self.assertEqual(layout["nWorkers"], 2)
+            self.assertEqual(layout["threadsPerWorker"], 1)
+
+    def test_hat_pool_batch(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filenames = [Path(tempDir) / f"batch{i}.h5" for i in range(3)]
+            hatArgs = sphereHatArgs()
+            hatArgs.update(nRep=2, maxIter=200)
+            with McHatPool(nCores=2) as pool:
+                for i, filename in enumerate(filenames):
+                    pool.submit(McHat(**hatArgs), sphereTestData(), filename, resultIndex=i + 1)
+                outputs = pool.wait()
+                self.assertEqual(len(outputs), 6)
+                # the pool can be reused after waiting:
+                pool.submit(McHat(**hatArgs), sphereTestData(), filenames[0], resultIndex=4)
+            for i, filename in enumerate(filenames + [filenames[0]]):
+                for repetition in range(2):
+                    opt = McOpt(
+                        loadFromFile=filename, loadFromRepetition=repetition, resultIndex=i + 1
+                    )
+                    self.assertTrue(opt.finished)
+                    self.assertEqual(opt.step, 200)
+
+    def test_spare_repetitions(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filename = Path(tempDir) / "spare.h5"
+            hatArgs = sphereHatArgs()
+            hatArgs.update(nRep=2, nSpare=1, nCores=3, maxIter=300)
+            start = time.time()
+            slowHat(**hatArgs).run(sphereTestData(), filename)
+            self.assertLess(time.time() - start, 60, "the slow repetition was not cancelled")
+            for repetition in range(2):
+                self.assertTrue(
+                    McOpt(loadFromFile=filename, loadFromRepetition=repetition).finished
+                )
+            # the checkpoints of the cancelled repetition are removed, and it is recorded:
+            path = "/analyses/MCResult1/{}/repetition2"
+            self.assertIsNone(loadKV(filename, path.format("optimization"), default=None))
+            self.assertIsNone(loadKV(filename, path.format("model"), default=None))
+            cancelled = loadKV(filename, "/analyses/MCResult1/optimization/cancelledRepetitions")
+            self.assertEqual(list(cancelled), [2])
+
+    def test_progress_events(self):
+        events = []
+        opt = McOpt(maxIter=300, convCrit=0, progressInterval=0)
+        mc = McCore(sphereTestData(), model=sphereModel(), opt=opt)
+        mc.optimize(progress=events.append)
+        # one at the start, one per step, and the final one:
+        self.assertEqual(len(events), 302)
+        self.assertEqual([event["step"] for event in events[:3]], [0, 1, 2])
+        self.assertEqual(events[-1]["state"], "finished")
+        self.assertEqual(events[-1]["accepted"], mc._opt.accepted)
+        self.assertEqual(events[-1]["gof"], mc._opt.gof)
+
+    def test_progress_log(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filename, logFile = Path(tempDir) / "progress.h5", Path(tempDir) / "progress.jsonl"
+            hatArgs = sphereHatArgs()
+            hatArgs.update(nRep=2, maxIter=300, progressInterval=0.01)
+            with McHatPool(nCores=2, showProgress=False, progressLog=logFile) as pool:
+                pool.submit(McHat(**hatArgs), sphereTestData(), filename)
+                pool.wait()
+            with open(logFile) as log:
+                events = [json.loads(line) for line in log]
+        finished = [event for event in events if event["state"] == "finished"]
+        self.assertEqual(sorted(event["repetition"] for event in finished), [0, 1])
+        self.assertTrue(all(event["step"] == 300 for event in finished))
+        self.assertTrue(all(event["filename"] == str(filename) for event in events))
+
+    def test_thread_executor(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            processFile, threadFile = Path(tempDir) / "proc.h5", Path(tempDir) / "threads.h5"
+            hatArgs = sphereHatArgs()
+            # a compiled SasModels model, of which the kernel calls run concurrently:
+            hatArgs.update(modelName="sphere", nRep=3, nCores=2, maxIter=200)
+            McHat(**hatArgs).run(sphereTestData(), processFile)
+            hatArgs.update(executor="threads")
+            McHat(**hatArgs).run(sphereTestData(), threadFile)
+            # every repetition has its own model and random generator, as in a worker process:
+            for repetition in range(3):
+                processes, threads = [
+                    (
+                        McModel(loadFromFile=f, loadFromRepetition=repetition),
+                        McOpt(loadFromFile=f, loadFromRepetition=repetition),
+                    )
+                    for f in (processFile, threadFile)
+                ]
+                np.testing.assert_array_equal(
+                    processes[0].parameterArray, threads[0].parameterArray
+                )
+                self.assertEqual(processes[1].gof, threads[1].gof)
+                self.assertTrue(threads[1].finished)
+            self.assertEqual(
+                loadKV(threadFile, "/analyses/MCResult1/optimization/executor"), b"threads"
+            )
+
+    def test_thread_executor_environment(self):
+        # the workers are threads of this process, which must not be limited beyond the run:
+        environment = {variable: os.environ.get(variable) for variable in THREAD_LIMIT_VARIABLES}
+        affinity = allowedCpus()
+        with tempfile.TemporaryDirectory() as tempDir:
+            hatArgs = sphereHatArgs()
+            hatArgs.update(nRep=2, nCores=2, maxIter=100, executor="threads")
+            McHat(**hatArgs).run(sphereTestData(), Path(tempDir) / "threads.h5")
+        self.assertEqual(
+            {variable: os.environ.get(variable) for variable in THREAD_LIMIT_VARIABLES},
+            environment,
+        )
+        self.assertEqual(allowedCpus(), affinity)
+        with self.assertRaises(AssertionError):
+            McHatPool(nCores=2, executor="threads", pinWorkers=True)
+
+    def test_cluster_executor(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            clusterFile, serialFile = Path(tempDir) / "cluster.h5", Path(tempDir) / "serial.h5"
+            hatArgs = sphereHatArgs()
+            hatArgs.update(nRep=3, maxIter=200)
+            authkey = b"mcsas3-test"
+            with McHatPool(
+                executor="cluster", address=str(Path(tempDir) / "jobs.sock"), authkey=authkey
+            ) as pool:
+                # several agents, as if on different machines:
+                agents = startAgents(pool._pool.address, authkey, nWorkers=2)
+                McHat(**hatArgs).run(sphereTestData(), clusterFile, pool=pool)
+            for agent in agents:
+                agent.join(timeout=10)
+                self.assertFalse(agent.is_alive(), "agent did not stop with the job server")
+            # the streams derive from the seed, the same results wherever a repetition ran:
+            McHat(**hatArgs).run(sphereTestData(), serialFile)
+            for repetition in range(3):
+                cluster, serial = [
+                    McModel(loadFromFile=f, loadFromRepetition=repetition)
+                    for f in (clusterFile, serialFile)
+                ]
+                np.testing.assert_array_equal(cluster.parameterArray, serial.parameterArray)
+                self.assertEqual(cluster.spawnKey, repetition)
+                self.assertTrue(
+                    McOpt(loadFromFile=clusterFile, loadFromRepetition=repetition).finished
+                )
+
+    def test_cluster_lost_agent(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            authkey = b"mcsas3-test"
+            pool = McClusterPool(str(Path(tempDir) / "jobs.sock"), authkey, heartbeatTimeout=3)
+            result = pool.apply_async(time.sleep, (2,))
+            # no agent is connected:
+            with self.assertRaises(multiprocessing.TimeoutError):
+                result.get(timeout=1)
+            agent = startAgents(pool.address, authkey)[0]
+            while pool.nAgents() == 0:
+                time.sleep(0.1)
+            time.sleep(0.5)
+            agent.kill()  # dies while running the task
+            agent.join()
+            start = time.time()
+            agent = startAgents(pool.address, authkey)[0]
+            # the task is run again by the other agent, once the first is given up:
+            self.assertIsNone(result.get(timeout=60))
+            self.assertGreater(time.time() - start, 2)
+            pool.server.shutdown()
+            agent.join(timeout=10)
+            self.assertFalse(agent.is_alive(), "agent did not stop with the job server")
+
+    def test_duplicate_finished_results(self):
+        # a repetition run to the end by two agents, when the task of one was queued again:
+        with tempfile.TemporaryDirectory() as tempDir:
+            filename = Path(tempDir) / "duplicate.h5"
+            root = ResultIndex(1).nxsEntryPoint
+            job = McHatJob(filename, root, [0, 1, 2], 2, threading.Event())
+            results = queue.Queue()
+            for repetition, finished in [(0, True), (0, True), (1, False)]:
+                pairs = [(root / "optimization" / f"repetition{repetition}" / "step", 1)]
+                results.put((filename, str(root), pairs, repetition, finished))
+            collectResults(results, [], [job])
+            self.assertEqual(job.finished, [0])
+            self.assertFalse(job.cancelEvent.is_set())
+            self.assertEqual(job.cancelled, [])
+            results.put((filename, str(root), [], 1, True))
+            collectResults(results, [], [job])
+            self.assertTrue(job.cancelEvent.is_set())
+            self.assertEqual(job.cancelled, [2])
+
+    def test_cluster_wait_timeout(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            pool = McHatPool(
+                executor="cluster",
+                address=str(Path(tempDir) / "jobs.sock"),
+                authkey=b"mcsas3-test",
+                showProgress=False,
+            )
+            pool.submit(McHat(**sphereHatArgs()), sphereTestData(), Path(tempDir) / "c.h5")
+            with self.assertRaisesRegex(multiprocessing.TimeoutError, "0 worker agents"):
+                pool.wait(timeout=1)
+            pool.close(wait=False)
+
+    def test_repetition_streams(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            serialFile, parallelFile = Path(tempDir) / "serial.h5", Path(tempDir) / "parallel.h5"
+            hatArgs = sphereHatArgs()
+            hatArgs.update(nRep=3, maxIter=200, seed=None)
+            McHat(**hatArgs).run(sphereTestData(), serialFile)
+            models = [McModel(loadFromFile=serialFile, loadFromRepetition=r) for r in range(3)]
+            # a seed is drawn for the run, and every repetition has its own stream:
+            self.assertIsNotNone(models[0].seed)
+            self.assertEqual(len(set(model.seed for model in models)), 1)
+            self.assertEqual([model.spawnKey for model in models], [0, 1, 2])
+            self.assertEqual(len(set(model.parameterArray[0, 0] for model in models)), 3)
+            # the recorded seed reproduces the run bit for bit, also in parallel:
+            hatArgs.update(seed=models[0].seed, nCores=2)
+            McHat(**hatArgs).run(sphereTestData(), parallelFile)
+            for repetition, model in enumerate(models):
+                parallel = McModel(loadFromFile=parallelFile, loadFromRepetition=repetition)
+                np.testing.assert_array_equal(parallel.parameterArray, model.parameterArray)
+                self.assertEqual(parallel.randomState, model.randomState)
+
+    def test_model_cache(self):
+        modelArgs = dict(modelName="sphere", nContrib=5, fitParameterLimits={"radius": (3.14, 314)})
+        first = McModel(staticParameters={"sld": 33.4, "sld_solvent": 5}, **modelArgs)
+        first.func.info.parameters.defaults.update(first.staticParameters)
+        second = McModel(staticParameters={"sld": 33.4}, **modelArgs)
+        self.assertIs(first.func, second.func, "the loaded model has not been reused")
+        # settings of a previous use of the model do not carry over:
+        self.assertNotEqual(second.func.info.parameters.defaults["sld_solvent"], 5)
+
+    def test_timing(self):
+        opt = McOpt(maxIter=300, convCrit=0, recordTiming=True)
+        mc = McCore(sphereTestData(), model=sphereModel(), opt=opt)
+        mc.optimize()
+        with tempfile.TemporaryDirectory() as tempDir:
+            filename = Path(tempDir) / "timing.h5"
+            mc.store(filename)
+            timing = loadKV(
+                filename, mc.resultIndex.nxsEntryPoint / "optimization/repetition0/timing", "dict"
+            )
+        self.assertEqual(timing["pick"]["count"], 300)
+        self.assertEqual(timing["kernel"]["count"], 300)
+        self.assertEqual(timing["match"]["count"], 300)
+        self.assertEqual(timing["accept"]["count"], mc._opt.accepted)
+        self.assertEqual(timing["store"]["count"], 1)
+        self.assertEqual(len(timing["binEdgesNs"]), len(timing["pick"]["histogram"]))
+        for phase in mc._timing.phases:
+            self.assertEqual(timing[phase]["histogram"].sum(), timing[phase]["count"])
+            self.assertGreater(timing[phase]["totalNs"], 0)
+        # without timing, nothing is recorded:
+        mc = McCore(sphereTestData(), model=sphereModel(), opt=McOpt(maxIter=10, convCrit=0))
+        mc.optimize()
+        self.assertIsNone(mc._timing)
+
+    def test_compensated_sum(self):
+        rows = np.array([[1.0, 1e100], [1e-16, 1.0], [-1.0, -1e100]])
+        np.testing.assert_array_equal(McCore.compensatedSum(rows), [1e-16, 1.0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,12 +15,121 @@ import yaml
 
 # %matplotlib inline
 # import matplotlib.pyplot as plt
-from mcsas3 import mc_data_1d
+from mcsas3 import mc_azimuthal, mc_data_1d
 
 # import warnings
 # warnings.filterwarnings('error')
 
 
+def reBinPerBin(
+    clippedData: pandas.DataFrame, nbins: int, IEmin: float, QEMin: float = 0.01
+) -> pandas.DataFrame:
+    # the previous, per-bin implementation of McData1D.reBin, as reference
+    qMin = clippedData.Q.dropna().min()
+    qMax = clippedData.Q.dropna().max()
+
+    # prepare bin edges:
+    binEdges = np.logspace(np.log10(qMin), np.log10(qMax), num=nbins + 1)
+    binDat = pandas.DataFrame(
+        data={
+            "Q": np.full(nbins, np.nan),  # mean Q
+            "I": np.full(nbins, np.nan),  # mean intensity
+            "IStd": np.full(nbins, np.nan),  # standard deviation of the mean intensity
+            "ISEM": np.full(
+                nbins, np.nan
+            ),  # standard error on mean of the mean intensity (maybe, but weighted is hard.)
+            "IError": np.full(nbins, np.nan),  # Propagated errors of the intensity
+            "ISigma": np.full(nbins, np.nan),  # Combined error estimate of the intensity
+            "QStd": np.full(nbins, np.nan),  # standard deviation of the mean Q
+            "QSEM": np.full(nbins, np.nan),  # standard error on the mean Q
+            "QError": np.full(nbins, np.nan),  # Propagated errors on the mean Q
+            "QSigma": np.full(nbins, np.nan),  # Combined error estimate on the mean Q
+        }
+    )
+
+    # add a little to the end to ensure the last datapoint is captured:
+    binEdges[-1] = binEdges[-1] + 1e-3 * (binEdges[-1] - binEdges[-2])
+
+    # now do the binning per bin.
+    for binN in range(len(binEdges) - 1):
+        dfRange = clippedData.query(
+            "{} <= Q < {}".format(binEdges[binN], binEdges[binN + 1])
+        ).copy()
+        if len(dfRange) == 0:
+            # no datapoints in the range
+            pass
+
+        elif len(dfRange) == 1:
+            # only one datapoint in the range
+            # might not be necessary to do this..
+            # can't do stats on this:
+            # FutureWarning fix:
+            binDat.loc[binN, "Q"] = float(dfRange.Q.iloc[0])
+            binDat.loc[binN, "QStd"] = binDat.loc[binN, "Q"] * QEMin
+            binDat.loc[binN, "QSEM"] = binDat.loc[binN, "Q"] * QEMin
+            binDat.loc[binN, "QError"] = binDat.loc[binN, "Q"] * QEMin
+
+            binDat.loc[binN, "I"] = float(dfRange.I.iloc[0])
+            binDat.loc[binN, "IStd"] = float(dfRange.ISigma.iloc[0])
+            binDat.loc[binN, "ISEM"] = float(dfRange.ISigma.iloc[0])
+            binDat.loc[binN, "IError"] = float(dfRange.ISigma.iloc[0])
+            binDat.loc[binN, "ISigma"] = np.max(
+                [binDat.loc[binN, "ISEM"], float(dfRange.I.iloc[0]) * IEmin]
+            )
+
+            if "QSigma" in dfRange.keys():
+                binDat.loc[binN, "QError"] = float(dfRange.QSigma.iloc[0])
+                binDat.loc[binN, "QStd"] = float(dfRange.QSigma.iloc[0])
+                binDat.loc[binN, "QSEM"] = float(dfRange.QSigma.iloc[0])
+
+            binDat.loc[binN, "QSigma"] = np.max(
+                [
+                    binDat.loc[binN, "QSEM"],
+                    binDat.loc[binN, "QError"],
+                    binDat.loc[binN, "Q"] * QEMin,
+                ]
+            )
+
+            # binDat.QSigma.loc[binN] = np.max(
+            #     [float(binDat.QSEM.loc[binN]), float(dfRange.Q.iloc[0]) * QEMin]
+            # )
+
+        else:
+            # multiple datapoints in the range
+            # fixing FutureWarning
+            binDat.loc[binN, "I"] = dfRange.I.mean(skipna=True)
+            binDat.loc[binN, "IStd"] = dfRange.I.std(ddof=1, skipna=True)
+            binDat.loc[binN, "ISEM"] = dfRange.I.sem(ddof=1, skipna=True)
+            binDat.loc[binN, "IError"] = np.sqrt(((dfRange.ISigma) ** 2).sum()) / len(dfRange)
+            binDat.loc[binN, "ISigma"] = np.max(
+                [
+                    binDat.loc[binN, "ISEM"],
+                    binDat.loc[binN, "IError"],
+                    binDat.loc[binN, "I"] * IEmin,
+                ]
+            )
+
+            binDat.loc[binN, "Q"] = dfRange.Q.mean(skipna=True)
+            binDat.loc[binN, "QStd"] = dfRange.Q.std(ddof=1, skipna=True)
+            binDat.loc[binN, "QSEM"] = dfRange.Q.sem(ddof=1, skipna=True)
+            binDat.loc[binN, "QError"] = binDat.loc[binN, "Q"] * QEMin
+
+            if "QSigma" in dfRange.keys():
+                binDat.loc[binN, "QError"] = np.sqrt(((dfRange.QSigma) ** 2).sum()) / len(dfRange)
+
+            binDat.loc[binN, "QSigma"] = np.max(
+                [
+                    binDat.loc[binN, "QSEM"],
+                    binDat.loc[binN, "QError"],
+                    binDat.loc[binN, "Q"] * QEMin,
+                ]
+            )
+
+    # remove empty bins
+    binDat.dropna(thresh=4, inplace=True)
+    return binDat
+
+
 class testMcData1D(unittest.TestCase):
     def test_mcdata1d_instantiated(self):
         md = mc_data_1d.McData1D()
@@ -136,6 +245,48 @@ class testMcData1D(unittest.TestCase):
         hpath = Path("testdata", "datamerge.nxs")
         _ = mc_data_1d.McData1D(filename=hpath)
 
+    def test_rebin_matches_per_bin(self):
+        rng = np.random.default_rng(1)
+        # sparse at low Q, for empty and single-point bins, and a datapoint with NaN intensity:
+        Q = np.sort(np.concatenate([[0.01, 0.0107, 0.02], rng.uniform(0.05, 1, 2000)]))
+        Int = 1 / Q**2 + rng.normal(0, 0.1, len(Q))
+        Int[500] = np.nan
+        df = pandas.DataFrame(data={"Q": Q, "I": Int, "ISigma": 0.05 * np.abs(Int)})
+        for clippedData in [df, df.assign(QSigma=0.02 * Q)]:
+            md = mc_data_1d.McData1D()
+            md.clippedData = clippedData
+            for nbins, IEmin in [(100, 0.01), (500, 0.05)]:
+                md.reBin(nbins=nbins, IEmin=IEmin)
+                expected = reBinPerBin(clippedData, nbins, IEmin)
+                self.assertListEqual(list(md.binnedData.index), list(expected.index))
+                self.assertListEqual(list(md.binnedData.columns), list(expected.columns))
+                np.testing.assert_allclose(
+                    md.binnedData.to_numpy(), expected.to_numpy(), rtol=1e-12, equal_nan=True
+                )
+
+    def test_azimuthal_average(self):
+        Qx, Qy = np.meshgrid(np.linspace(-1, 1, 64), np.linspace(-1, 1, 64))
+        Int = np.ones(Qx.shape)
+        mask = np.zeros(Qx.shape, dtype=bool)
+        mask[30:34, :] = True
+        Int[mask] = 1e6  # masked pixels do not contribute
+        raw = dict(I=Int, ISigma=np.full(Qx.shape, 0.1), Qx=Qx, Qy=Qy, mask=mask)
+        averaged = mc_azimuthal.azimuthalAverage(raw, 20)
+        np.testing.assert_allclose(averaged.I, 1)
+        # propagated uncertainties, for the unmasked pixels of every bin:
+        binIndex, Q = mc_azimuthal.radialBinMap(Qx, Qy, 20)
+        nPixels = np.array([((binIndex == i) & ~mask).sum() for i in range(20)])
+        np.testing.assert_allclose(averaged.ISigma, 0.1 / np.sqrt(nPixels[nPixels > 0]))
+        self.assertTrue((np.diff(averaged.Q) > 0).all())
+        # the map is reused for the same detector geometry:
+        self.assertIs(mc_azimuthal.radialBinMap(Qx.copy(), Qy.copy(), 20)[0], binIndex)
+
+    def test_azimuthal_average_from_nexus(self):
+        md = mc_data_1d.McData1D(filename=Path("testdata", "009766_forSasView.h5"), nbins=50)
+        self.assertListEqual(list(md.rawData.columns), ["Q", "I", "ISigma"])
+        self.assertLessEqual(len(md.measData["Q"][0]), 50)
+        self.assertTrue((np.diff(md.measData["Q"][0]) > 0).all())
+
 
 if __name__ == "__main__":
     unittest.main()
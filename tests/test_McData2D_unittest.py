@@ -1,12 +1,18 @@
 # these need to be loaded at the beginning to avoid errors related to relative imports
 # (ImportWarning in h5py), might be related to the change of import style for Python 3.5+.
 # Tested on Python 3.7 at 20200417
+import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
+
+import h5py
+import numpy as np
 
 # %matplotlib inline
 # import matplotlib.pyplot as plt
 from mcsas3 import mc_data_2d
+from mcsas3.mc_data import readDataset
 
 # import warnings
 # warnings.filterwarnings('error')
@@ -19,6 +25,112 @@ class testMcData2D(unittest.TestCase):
         self.assertIsNotNone(md.measData, "measData is not populated")
         self.assertTrue("Q" in md.measData.keys())
 
+    def test_block_rebinning(self):
+        Qx, Qy = np.meshgrid(np.linspace(-1, 1, 9), np.linspace(-1, 1, 9))
+        mask = np.zeros(Qx.shape, dtype=bool)
+        mask[2, 2] = True
+        md = mc_data_2d.McData2D(binFactor=2)
+        md.rawData2D = dict(
+            I=np.ones(Qx.shape), ISigma=np.full(Qx.shape, 0.1), Qx=Qx, Qy=Qy, mask=mask
+        )
+        md.prepare()
+        binned = md.binnedData
+        # the cropped 8 x 8 pixels without the centre and the masked pixel, in 4 x 4 blocks:
+        self.assertEqual(len(md.measData["I"]), 16)
+        self.assertEqual(binned["nPixels"].sum(), md.clippedData["invMask"].sum())
+        np.testing.assert_allclose(binned["I"], 1)
+        # propagated uncertainties of the means, larger than the spread and IEmin:
+        for nPixels in [2, 3, 4]:
+            np.testing.assert_allclose(
+                binned["ISigma"][binned["nPixels"] == nPixels], np.sqrt(nPixels * 0.01) / nPixels
+            )
+        # every unmasked pixel gets the intensity of its bin:
+        reconstructed = md.reconstruct2D(np.arange(16))
+        self.assertTrue(np.isnan(reconstructed[2, 2]))
+        self.assertEqual(reconstructed[3, 3], reconstructed[2, 3])
+
+    def test_block_rebinning_without_nbins(self):
+        Qx, Qy = np.meshgrid(np.linspace(-1, 1, 9), np.linspace(-1, 1, 9))
+        rawData2D = dict(I=np.ones(Qx.shape), ISigma=np.full(Qx.shape, 0.1), Qx=Qx, Qy=Qy)
+        # the blocks do not depend on the number of |Q| bins:
+        md = mc_data_2d.McData2D(binFactor=2, nbins=0)
+        md.rawData2D = rawData2D
+        md.prepare()
+        self.assertEqual(len(md.measData["I"]), 16)
+        # the (|Q|, psi) bins do:
+        md = mc_data_2d.McData2D(nAzimuthalBins=8, nbins=0)
+        md.rawData2D = rawData2D
+        with self.assertRaises(AssertionError):
+            md.prepare()
+
+    def test_azimuthal_rebinning(self):
+        md = mc_data_2d.McData2D(nAzimuthalBins=8, nbins=20)
+        md.from_nexus(filename=Path(r"testdata/009766_forSasView.h5"))
+        binned = md.binnedData
+        self.assertLessEqual(len(md.measData["I"]), 8 * 20)
+        self.assertEqual(binned["nPixels"].sum(), md.clippedData["invMask"].sum())
+        Q = np.sqrt(md.clippedData["Q"][0] ** 2 + md.clippedData["Q"][1] ** 2)
+        QBinned = np.sqrt(binned["Q"][0] ** 2 + binned["Q"][1] ** 2)
+        self.assertTrue((QBinned >= Q.min()).all() and (QBinned <= Q.max()).all())
+        reconstructed = md.reconstruct2D(md.measData["I"])
+        self.assertEqual(np.isnan(reconstructed).sum(), (~md.clippedData["invMask"]).sum())
+
+    def test_cropped_loading(self):
+        filename = Path(r"testdata/009766_forSasView.h5")
+        md = mc_data_2d.McData2D()
+        md.orthoQ0Range = [0, 0.01]
+        names = []
+
+        def recordedRead(dataset, *args, **kwargs):
+            names.append(dataset.name)
+            return readDataset(dataset, *args, **kwargs)
+
+        with mock.patch("mcsas3.mc_data.readDataset", side_effect=recordedRead):
+            md.from_nexus(filename=filename)
+        # the mask is read once, for the crop window, and cropped in memory:
+        self.assertEqual(len([name for name in names if name.endswith("Imask")]), 1)
+        # only the crop envelope of the images has been read:
+        self.assertLess(md.rawData2D["I"].size, 256 * 128 / 2)
+        # the same result as clipping the full images:
+        full = mc_data_2d.McData2D()
+        full.orthoQ0Range = [0, 0.01]
+        with h5py.File(filename, "r") as h5f:
+            group = h5f["sasentry01/sasdata01"]
+            Qx, Qy = full.QxQy(group["Q"][()])
+            full.rawData2D = dict(
+                I=group["I"][()], ISigma=group["Idev"][()], mask=group["Imask"][()], Qx=Qx, Qy=Qy
+            )
+        full.prepare()
+        for key in ["I", "ISigma"]:
+            np.testing.assert_array_equal(md.measData[key], full.measData[key])
+        np.testing.assert_array_equal(md.measData["Q"], full.measData["Q"])
+
+    def test_memory_mapped_loading(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            # a copy with contiguous, uncompressed datasets:
+            filename = Path(tempDir) / "contiguous.h5"
+            with h5py.File("testdata/009766_forSasView.h5", "r") as h5f, h5py.File(
+                filename, "w"
+            ) as h5c:
+
+                def copy(name, item):
+                    if isinstance(item, h5py.Dataset):
+                        h5c.create_dataset(name, data=item[()])
+                    else:
+                        h5c.require_group(name)
+                    h5c[name].attrs.update(item.attrs)
+
+                h5c.attrs.update(h5f.attrs)
+                h5f.visititems(copy)
+                self.assertIsInstance(
+                    readDataset(h5c["sasentry01/sasdata01/I"], (), True), np.memmap
+                )
+            mapped = mc_data_2d.McData2D(memoryMap=True)
+            mapped.from_nexus(filename=filename)
+            md = mc_data_2d.McData2D()
+            md.from_nexus(filename=Path(r"testdata/009766_forSasView.h5"))
+            np.testing.assert_array_equal(mapped.measData["I"], md.measData["I"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+from mcsas3 import mc_data_1d, mc_data_2d
+from mcsas3.mc_cache import McDataCache
+
+
+class testMcDataCache(unittest.TestCase):
+    def test_cached_1d(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = Path(tempDir) / "cache"
+            filename = Path(tempDir) / "data.csv"
+            shutil.copy(Path("testdata", "quickstartdemo1.csv"), filename)
+            settings = dict(
+                filename=filename,
+                nbins=50,
+                dataRange=[0.01, 0.3],
+                csvargs={"sep": ";", "header": None, "names": ["Q", "I", "ISigma"]},
+                cacheDir=cacheDir,
+            )
+            md = mc_data_1d.McData1D(**settings)
+            self.assertEqual(len(McDataCache(cacheDir).entries()), 1)
+            # the second time, the data are not read nor prepared:
+            with mock.patch.object(mc_data_1d.McData1D, "from_csv", side_effect=AssertionError):
+                cached = mc_data_1d.McData1D(**settings)
+            self.assertEqual(cached.loader, "from_csv")
+            for key in ["Q", "I", "ISigma"]:
+                np.testing.assert_array_equal(cached.binnedData[key], md.binnedData[key])
+                np.testing.assert_array_equal(cached.clippedData[key], md.clippedData[key])
+            np.testing.assert_array_equal(cached.clippedData.index, md.clippedData.index)
+            np.testing.assert_array_equal(cached.measData["Q"][0], md.measData["Q"][0])
+            np.testing.assert_array_equal(cached.measData["I"], md.measData["I"])
+            cached.store(Path(tempDir) / "result.h5")
+            # other settings, or another file content, are other entries:
+            mc_data_1d.McData1D(**dict(settings, nbins=40))
+            self.assertEqual(len(McDataCache(cacheDir).entries()), 2)
+            filename.write_bytes(filename.read_bytes().replace(b"1.89E+10", b"1.88E+10", 1))
+            mc_data_1d.McData1D(**settings)
+            self.assertEqual(len(McDataCache(cacheDir).entries()), 3)
+
+    def test_cached_2d(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            settings = dict(
+                filename=Path("testdata", "009766_forSasView.h5"),
+                nAzimuthalBins=8,
+                nbins=20,
+                cacheDir=Path(tempDir),
+            )
+            md = mc_data_2d.McData2D(**settings)
+            with mock.patch.object(mc_data_2d.McData2D, "prepare", side_effect=AssertionError):
+                cached = mc_data_2d.McData2D(**settings)
+            self.assertEqual(cached.clippedData["kansas"], md.clippedData["kansas"])
+            self.assertIsInstance(cached.clippedData["kansas"], tuple)
+            self.assertEqual(cached.binnedData["Qextent"], md.binnedData["Qextent"])
+            for key in ["I", "ISigma", "Q"]:
+                np.testing.assert_array_equal(cached.measData[key], md.measData[key])
+            for key in ["I", "mask", "Qx", "Qy"]:
+                np.testing.assert_array_equal(cached.rawData2D[key], md.rawData2D[key])
+            np.testing.assert_array_equal(
+                cached.reconstruct2D(cached.measData["I"]), md.reconstruct2D(md.measData["I"])
+            )
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = Path(tempDir)
+            filename = Path("testdata", "S2870 BSA THF 1 1 d.pdh")
+            keys = []
+            for nbins in [30, 40, 50]:
+                md = mc_data_1d.McData1D(filename=filename, nbins=nbins, cacheDir=cacheDir)
+                keys += [McDataCache(cacheDir).key(md)]
+            cache = McDataCache(cacheDir)
+            past = time.time() - 10
+            for age, key in enumerate(keys):
+                os.utime(cache.entryPath(key), (past + age, past + age))
+            entries = cache.entries()
+            self.assertEqual([entry["key"] for entry in entries], keys)
+            # the first entry is used again, the second is now the least recently used:
+            mc_data_1d.McData1D(filename=filename, nbins=30, cacheDir=cacheDir)
+            removed = cache.evict(maxBytes=sum(entry["size"] for entry in entries[1:]))
+            self.assertEqual([entry["key"] for entry in removed], [keys[1]])
+            # the size limit of the cache applies when storing:
+            mc_data_1d.McData1D(filename=filename, nbins=60, cacheDir=cacheDir, cacheSize=1)
+            self.assertEqual(len(cache.entries()), 0)
+
+    def test_purge(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = Path(tempDir)
+            filename = Path("testdata", "S2870 BSA THF 1 1 d.pdh")
+            for nbins in [30, 40]:
+                mc_data_1d.McData1D(filename=filename, nbins=nbins, cacheDir=cacheDir)
+            cache = McDataCache(cacheDir)
+            old = cache.entries()[0]
+            past = time.time() - 3 * 86400
+            os.utime(cache.entryPath(old["key"]), (past, past))
+            removed = cache.purge(olderThan=86400)
+            self.assertEqual([entry["key"] for entry in removed], [old["key"]])
+            self.assertEqual(len(cache.purge()), 1)
+            self.assertEqual(list(cacheDir.iterdir()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import asyncio
+import json
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+import yaml
+
+from mcsas3.mc_service import McService
+
+
+async def request(socket: Path, method: str, target: str, body=None):
+    reader, writer = await asyncio.open_unix_connection(str(socket))
+    content = b"" if body is None else json.dumps(body).encode()
+    writer.write(
+        "{} {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(method, target, len(content)).encode()
+        + content
+    )
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), json.loads(content)
+
+
+class testMcService(unittest.IsolatedAsyncioTestCase):
+    async def test_submit_and_dedupe(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            tempDir = Path(tempDir)
+            runConfig = yaml.safe_load(
+                Path("example_configurations/run_config_spheres.yaml").read_text()
+            )
+            runConfig.update(nContrib=50, maxIter=500, nRep=2, nCores=1)
+            (tempDir / "run.yaml").write_text(yaml.safe_dump(runConfig))
+            shutil.copy("testdata/quickstartdemo1.csv", tempDir / "data.csv")
+            job = dict(
+                dataFile=str(tempDir / "data.csv"),
+                readConfigFile="example_configurations/read_config_csv.yaml",
+                runConfigFile=str(tempDir / "run.yaml"),
+                histConfigFile="example_configurations/hist_config_dual.yaml",
+            )
+            service = McService(resultDir=tempDir / "results", maxJobs=1)
+            socket = tempDir / "service.sock"
+            server = asyncio.create_task(service.serve(unixSocket=socket))
+            try:
+                while not socket.exists():
+                    await asyncio.sleep(0.05)
+                code, status = await request(socket, "POST", "/jobs", job)
+                self.assertEqual(code, 202)
+                # identical submissions run once:
+                code, again = await request(socket, "POST", "/jobs", job)
+                self.assertEqual(again["jobId"], status["jobId"])
+                # another submission cannot replace the result file while it is being written:
+                code, error = await request(
+                    socket,
+                    "POST",
+                    "/jobs",
+                    dict(job, resultIndex=2, resultFile=status["resultFile"]),
+                )
+                self.assertEqual(code, 400)
+                self.assertIn("in use", error["error"])
+                code, jobs = await request(socket, "GET", "/jobs")
+                self.assertEqual(len(jobs), 1)
+                for _ in range(1200):
+                    code, status = await request(socket, "GET", "/jobs/" + status["jobId"])
+                    if status["state"] in ("finished", "failed"):
+                        break
+                    await asyncio.sleep(0.1)
+                self.assertEqual(status["state"], "finished", status.get("error", None))
+                self.assertTrue(Path(status["resultFile"]).is_file())
+                self.assertTrue(Path(status["histogramFile"]).is_file())
+                code, _ = await request(socket, "GET", "/jobs/unknown")
+                self.assertEqual(code, 404)
+                code, error = await request(socket, "POST", "/jobs", {"dataFile": "x"})
+                self.assertEqual(code, 400)
+            finally:
+                server.cancel()
+
+    async def test_hashing_does_not_block(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            tempDir = Path(tempDir)
+            service = McService(resultDir=tempDir / "results", maxJobs=1)
+            socket = tempDir / "service.sock"
+
+            def slowJobKey(request: dict) -> str:
+                time.sleep(2)  # as for a large input file
+                raise AssertionError("stop after hashing")
+
+            service.jobKey = slowJobKey
+            job = {key: "testdata/quickstartdemo1.csv" for key in service.requiredKeys}
+            server = asyncio.create_task(service.serve(unixSocket=socket))
+            try:
+                while not socket.exists():
+                    await asyncio.sleep(0.05)
+                submission = asyncio.create_task(request(socket, "POST", "/jobs", job))
+                await asyncio.sleep(0.2)
+                # the status is answered while the input files are hashed:
+                start = time.time()
+                code, jobs = await request(socket, "GET", "/jobs")
+                self.assertEqual((code, jobs), (200, []))
+                self.assertLess(time.time() - start, 1)
+                self.assertFalse(submission.done())
+                code, error = await submission
+                self.assertEqual(code, 400)
+            finally:
+                server.cancel()
+
+
+if __name__ == "__main__":
+    unittest.main()
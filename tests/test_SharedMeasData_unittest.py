@@ -0,0 +1,41 @@
+import pickle
+import unittest
+
+import numpy as np
+
+from mcsas3.mc_shared import SharedMeasData
+
+
+class testSharedMeasData(unittest.TestCase):
+    def test_pickle_shares_arrays(self):
+        rng = np.random.default_rng(0)
+        n = 512 * 512  # a modest 2D detector image
+        measData = dict(
+            Q=[rng.uniform(size=n), rng.uniform(size=n)],
+            I=rng.uniform(size=n),
+            ISigma=rng.uniform(size=n).astype(np.float32),
+            note="not an array",
+        )
+        shared = SharedMeasData(measData)
+        try:
+            transported = pickle.dumps(shared)
+            # only the block layout is pickled, not the data:
+            self.assertLess(len(transported), 1000)
+            self.assertGreater(len(pickle.dumps(measData)), 3 * 8 * n)
+            # as in a worker, the views remain valid when the unpickled instance is discarded:
+            attached = pickle.loads(transported).measData
+            for key in ["I", "ISigma"]:
+                np.testing.assert_array_equal(attached[key], measData[key])
+                self.assertEqual(attached[key].dtype, measData[key].dtype)
+            for QAttached, Q in zip(attached["Q"], measData["Q"]):
+                np.testing.assert_array_equal(QAttached, Q)
+            self.assertEqual(attached["note"], "not an array")
+            # the attached arrays are views of the same memory, not copies:
+            shared.measData["I"][0] = -1.0
+            self.assertEqual(attached["I"][0], -1.0)
+        finally:
+            shared.unlink()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from mcsas3.mc_cpu import cgroupCpuLimit, cpuLayout, effectiveCpuCount, limitThreads
+
+
+def writeFiles(root: Path, files: dict) -> None:
+    for name, content in files.items():
+        (root / name).parent.mkdir(parents=True, exist_ok=True)
+        (root / name).write_text(content)
+
+
+class testMcCpu(unittest.TestCase):
+    def test_cgroup_v2_limit(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            root = Path(tempDir)
+            writeFiles(
+                root,
+                {
+                    "proc": "0::/kubepods/pod1\n",
+                    "cgroup/cpu.max": "max 100000\n",
+                    "cgroup/kubepods/cpu.max": "800000 100000\n",
+                    "cgroup/kubepods/pod1/cpu.max": "250000 100000\n",
+                },
+            )
+            self.assertEqual(cgroupCpuLimit(root / "cgroup", root / "proc"), 2.5)
+            (root / "cgroup/kubepods/pod1/cpu.max").write_text("max 100000\n")
+            # the limit of the parent cgroup applies:
+            self.assertEqual(cgroupCpuLimit(root / "cgroup", root / "proc"), 8.0)
+            (root / "cgroup/kubepods/cpu.max").write_text("max 100000\n")
+            self.assertIsNone(cgroupCpuLimit(root / "cgroup", root / "proc"))
+
+    def test_cgroup_v1_limit(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            root = Path(tempDir)
+            writeFiles(
+                root,
+                {
+                    # as seen within a container, where its cgroup is mounted at the root:
+                    "proc": "3:memory:/docker/abc\n2:cpu,cpuacct:/docker/abc\n",
+                    "cgroup/cpu,cpuacct/cpu.cfs_quota_us": "400000\n",
+                    "cgroup/cpu,cpuacct/cpu.cfs_period_us": "100000\n",
+                },
+            )
+            self.assertEqual(cgroupCpuLimit(root / "cgroup", root / "proc"), 4.0)
+            (root / "cgroup/cpu,cpuacct/cpu.cfs_quota_us").write_text("-1\n")
+            self.assertIsNone(cgroupCpuLimit(root / "cgroup", root / "proc"))
+
+    def test_layout(self):
+        self.assertGreaterEqual(effectiveCpuCount(), 1)
+        self.assertLessEqual(effectiveCpuCount(), os.cpu_count())
+        layout = cpuLayout(3, 1, False)
+        self.assertEqual(layout["nWorkers"], 3)
+        self.assertEqual(layout["effectiveCpuCount"], effectiveCpuCount())
+
+    def test_limit_threads(self):
+        previous = {
+            key: os.environ.get(key, None) for key in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]
+        }
+        try:
+            limitThreads(2)
+            self.assertEqual(os.environ["OMP_NUM_THREADS"], "2")
+            self.assertEqual(os.environ["MKL_NUM_THREADS"], "2")
+        finally:
+            for key, value in previous.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+import numpy as np
+
+from mcsas3.osb import optimizeScalingAndBackground
+
+
+def osbCorpus(nSets: int = 50, seed: int = 1):
+    # random power-law and Guinier-like curves with noise, scaling and (sometimes negative)
+    # background offsets, matched against model intensities of a different shape
+    rng = np.random.default_rng(seed)
+    Q = np.logspace(-2, 0, 120)
+    for _ in range(nSets):
+        modelI = np.exp(-((Q * rng.uniform(5, 50)) ** 2) / 3) + rng.uniform(1e-4, 1e-2) * Q**-2
+        measI = rng.uniform(0.1, 100) * modelI + rng.uniform(-0.5, 2) * modelI.mean()
+        measI *= rng.normal(1, 0.05, size=Q.size) * np.exp(rng.uniform(-0.3, 0.3) * np.log(Q))
+        yield measI, np.abs(measI) * 0.01 + 1e-6, modelI
+
+
+class testOSB(unittest.TestCase):
+    def test_analytic_unbounded_matches_lstsq(self):
+        for measI, measISigma, modelI in osbCorpus(10):
+            o = optimizeScalingAndBackground(
+                measI, measISigma, xBounds=[[None, None], [None, None]]
+            )
+            x, gof = o.match(modelI)
+            A = np.stack([modelI / measISigma, 1 / measISigma], axis=1)
+            xRef = np.linalg.lstsq(A, measI / measISigma, rcond=None)[0]
+            np.testing.assert_allclose(x, xRef, rtol=1e-6)
+            np.testing.assert_allclose(gof, o.optFunc(xRef, measI, measISigma, modelI), rtol=1e-8)
+
+    def test_analytic_against_scipy(self):
+        for measI, measISigma, modelI in osbCorpus():
+            oAna = optimizeScalingAndBackground(measI, measISigma)
+            oSci = optimizeScalingAndBackground(measI, measISigma, engine="scipy")
+            xAna, gofAna = oAna.match(modelI)
+            xSci, gofSci = oSci.match(modelI)
+            # must respect the bounds:
+            self.assertGreaterEqual(xAna[0], oAna.xBounds[0][0])
+            self.assertGreaterEqual(xAna[1], oAna.xBounds[1][0])
+            self.assertLessEqual(xAna[1], oAna.xBounds[1][1])
+            # exact solution is never worse than the iterative one:
+            self.assertLessEqual(gofAna, gofSci * (1 + 1e-6))
+            np.testing.assert_allclose(
+                gofAna, oAna.optFunc(xAna, measI, measISigma, modelI), rtol=1e-8
+            )
+
+    def test_incremental_delta_matches_full(self):
+        rng = np.random.default_rng(3)
+        for measI, measISigma, modelI in osbCorpus(20):
+            deltaI = modelI * rng.normal(0, 0.2, size=modelI.size)
+            for engine in ["analytic", "scipy"]:
+                o = optimizeScalingAndBackground(measI, measISigma, engine=engine)
+                o.setModel(modelI)
+                xDelta, gofDelta = o.matchDelta(deltaI)
+                xFull, gofFull = o.match(modelI + deltaI)
+                np.testing.assert_allclose(xDelta, xFull, rtol=1e-8)
+                np.testing.assert_allclose(gofDelta, gofFull, rtol=1e-6)
+
+    def test_chisqr_matches_reference(self):
+        rng = np.random.default_rng(5)
+        for measI, measISigma, modelI in osbCorpus(10):
+            o = optimizeScalingAndBackground(measI, measISigma)
+            measIRef = measI.copy()
+            x = np.array([rng.uniform(0, 100), rng.uniform(-1, 1)])
+            np.testing.assert_allclose(
+                o.chiSqr(x, modelI), o.optFunc(x, measI, measISigma, modelI), rtol=1e-12
+            )
+            # the measured data must not be touched by the in-place operations:
+            np.testing.assert_array_equal(o.measDataI, measIRef)
+
+    def test_analytic_degenerate_model(self):
+        measI = np.linspace(1, 2, 50)
+        o = optimizeScalingAndBackground(measI, measI * 0.01)
+        x, gof = o.match(np.zeros(50))
+        self.assertTrue(np.all(np.isfinite(x)))
+        self.assertTrue(np.isfinite(gof))
+
+
+if __name__ == "__main__":
+    unittest.main()